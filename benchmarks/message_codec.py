@@ -0,0 +1,70 @@
+"""
+Benchmark encoding and decoding messages with the message codecs.
+
+Compares :class:`vumi.message.JSONMessageCodec` with
+:class:`vumi.message.SchemaMessageCodec`, with and without ``ujson``, on
+inbound messages and delivery report events.
+"""
+
+import sys
+import time
+
+from vumi.message import (
+    TransportUserMessage, TransportEvent, JSONMessageCodec,
+    SchemaMessageCodec, ujson)
+
+
+def make_msg():
+    return TransportUserMessage(
+        to_addr='+27831234567', from_addr='12345', transport_name='sphex',
+        transport_type='sms', content='hello world',
+        transport_metadata={'foo': {'bar': 'baz'}},
+        helper_metadata={
+            'tag': {'tag': ['pool', 'tag1']},
+            'go': {'user_account': 'account-1', 'conversation_key': 'conv-1'},
+        },
+        routing_metadata={'endpoint_name': 'default'})
+
+
+def make_event():
+    return TransportEvent(
+        event_type='delivery_report', user_message_id='abc',
+        sent_message_id='def', delivery_status='delivered',
+        transport_name='sphex', transport_metadata={'foo': 'bar'},
+        helper_metadata={'go': {'user_account': 'account-1'}})
+
+
+def run_bench(name, func, count):
+    start = time.time()
+    for _ in xrange(count):
+        func()
+    elapsed = time.time() - start
+    print "%s: %d iterations in %.3fs (%.0f/s)" % (
+        name, count, elapsed, count / elapsed)
+
+
+def bench_codec(name, codec, msg, count):
+    data = codec.encode(msg)
+    message_class = type(msg)
+    run_bench("%s encode" % (name,), lambda: codec.encode(msg), count)
+    run_bench(
+        "%s decode" % (name,), lambda: codec.decode(data, message_class),
+        count)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args:
+        count = int(args[0])
+    else:
+        count = 20000
+    codecs = [
+        ("JSONMessageCodec", JSONMessageCodec()),
+        ("SchemaMessageCodec (json)", SchemaMessageCodec(use_ujson=False)),
+    ]
+    if ujson is not None:
+        codecs.append(("SchemaMessageCodec (ujson)", SchemaMessageCodec()))
+    for msg in [make_msg(), make_event()]:
+        print "%s, %d iterations" % (type(msg).__name__, count)
+        for name, codec in codecs:
+            bench_codec(name, codec, msg, count)
@@ -0,0 +1,65 @@
+"""
+Benchmark copying messages and fanning them out to several endpoints.
+
+Compares the old approach of round-tripping the payload through JSON with
+:meth:`vumi.message.Message.copy`.
+"""
+
+import sys
+import time
+
+from vumi.message import TransportUserMessage
+
+
+def make_msg():
+    return TransportUserMessage(
+        to_addr='+27831234567', from_addr='12345', transport_name='sphex',
+        transport_type='sms', content='hello world',
+        transport_metadata={'foo': {'bar': 'baz'}},
+        helper_metadata={'tag': {'tag': ['pool', 'tag1']}},
+        routing_metadata={'endpoint_name': 'default'})
+
+
+def json_copy(msg):
+    return msg.from_json(msg.to_json())
+
+
+def structural_copy(msg):
+    return msg.copy()
+
+
+def fan_out(copy_func, endpoints):
+    def fan_out_msg(msg):
+        for endpoint in endpoints:
+            msg_copy = copy_func(msg)
+            msg_copy.set_routing_endpoint(endpoint)
+            msg_copy.to_json()
+    return fan_out_msg
+
+
+def run_bench(name, func, msg, count):
+    start = time.time()
+    for _ in xrange(count):
+        func(msg)
+    elapsed = time.time() - start
+    print "%s: %d iterations in %.3fs (%.0f/s)" % (
+        name, count, elapsed, count / elapsed)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args:
+        count = int(args[0])
+    else:
+        count = 20000
+    msg = make_msg()
+    endpoints = ['endpoint%d' % (i,) for i in range(5)]
+    print "Copying a message %d times" % (count,)
+    run_bench("JSON round trip", json_copy, msg, count)
+    run_bench("Message.copy", structural_copy, msg, count)
+    print "Fanning a message out to %d endpoints %d times" % (
+        len(endpoints), count / 10)
+    run_bench(
+        "JSON round trip", fan_out(json_copy, endpoints), msg, count / 10)
+    run_bench(
+        "Message.copy", fan_out(structural_copy, endpoints), msg, count / 10)
@@ -0,0 +1,61 @@
+"""
+Benchmark framing a large burst of SMPP PDUs received in a single read.
+
+Compares the old approach of repeatedly chopping the head off a byte string
+with :class:`vumi.transports.smpp.pdu_utils.PDUBuffer`.
+"""
+
+import sys
+import time
+
+from smpp.pdu_builder import DeliverSM
+
+from vumi.transports.smpp.pdu_utils import chop_pdu_stream, PDUBuffer
+
+
+def make_burst(count):
+    return ''.join(
+        DeliverSM(i, short_message='Message number %s' % (i,)).get_bin()
+        for i in xrange(1, count + 1))
+
+
+def frame_with_chop(data):
+    count = 0
+    buf = b''
+    buf += data
+    pdu_found = chop_pdu_stream(buf)
+    while pdu_found is not None:
+        pdu, buf = pdu_found
+        count += 1
+        pdu_found = chop_pdu_stream(buf)
+    return count
+
+
+def frame_with_buffer(data):
+    count = 0
+    buf = PDUBuffer()
+    buf.feed(data)
+    for pdu in buf.pdus():
+        count += 1
+    return count
+
+
+def run_bench(name, func, data, expected):
+    start = time.time()
+    count = func(data)
+    elapsed = time.time() - start
+    assert count == expected, (count, expected)
+    print "%s: %d PDUs in %.3fs (%.0f PDU/s)" % (
+        name, count, elapsed, count / elapsed)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args:
+        count = int(args[0])
+    else:
+        count = 20000
+    data = make_burst(count)
+    print "Burst of %d PDUs, %d bytes" % (count, len(data))
+    run_bench("chop_pdu_stream", frame_with_chop, data, count)
+    run_bench("PDUBuffer", frame_with_buffer, data, count)
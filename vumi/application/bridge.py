@@ -105,7 +105,8 @@ class BridgeApplication(ApplicationWorker):
         headers.update(self.get_content_type_headers(config))
 
         response = http_request_full(config.url.geturl(), message.to_json(),
-                                     headers, config.http_method)
+                                     headers, config.http_method,
+                                     pool=self.http_pool)
 
         response.addCallback(lambda response:
                              self._handle_good_response(
@@ -78,8 +78,9 @@ class HTTPRelayApplication(ApplicationWorker):
         config = yield self.get_config(message)
         headers = self.get_auth_headers(config)
         headers.update(self.get_content_type_headers(config))
-        response = yield http_request_full(config.url.geturl(),
-                            message.to_json(), headers, config.http_method)
+        response = yield http_request_full(
+            config.url.geturl(), message.to_json(), headers,
+            config.http_method, pool=self.http_pool)
         headers = response.headers
         if response.code == http.OK:
             if headers.hasHeader(self.reply_header):
@@ -102,8 +103,9 @@ class HTTPRelayApplication(ApplicationWorker):
     def relay_event(self, event):
         config = yield self.get_config(event)
         headers = self.get_auth_headers(config)
-        yield http_request_full(config.event_url.geturl(),
-            event.to_json(), headers, config.http_method)
+        yield http_request_full(
+            config.event_url.geturl(), event.to_json(), headers,
+            config.http_method, pool=self.http_pool)
 
     @inlineCallbacks
     def consume_ack(self, event):
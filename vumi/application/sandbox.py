@@ -9,6 +9,7 @@ import json
 import pkg_resources
 import logging
 import operator
+import time
 from uuid import uuid4
 from StringIO import StringIO
 import warnings
@@ -21,6 +22,7 @@ from twisted.internet.defer import (
     Deferred, inlineCallbacks, maybeDeferred, returnValue, DeferredList,
     succeed)
 from twisted.internet.error import ProcessDone
+from twisted.internet.task import LoopingCall
 from twisted.python.failure import Failure
 from twisted.web.client import WebClientContextFactory, Agent
 
@@ -30,10 +32,12 @@ from OpenSSL.SSL import (
 
 from vumi.config import ConfigText, ConfigInt, ConfigList, ConfigDict
 from vumi.application.base import ApplicationWorker
+from vumi.blinkenlights.metrics import MetricManager, Count
 from vumi.message import Message
 from vumi.errors import ConfigError
 from vumi.persist.txredis_manager import TxRedisManager
-from vumi.utils import load_class_by_string, HttpDataLimitError, to_kwargs
+from vumi.utils import (
+    load_class_by_string, HttpDataLimitError, to_kwargs, build_agent)
 from vumi import log
 from vumi.application.sandbox_rlimiter import SandboxRlimiter
 
@@ -163,18 +167,20 @@ class SandboxProtocol(ProcessProtocol):
         except Exception, e:
             return SandboxCommand(cmd="unknown", line=line, exception=e)
 
+    def _dispatch_command(self, command):
+        d = self.api.dispatch_request(command)
+        self._pending_requests.append(d)
+
     def outReceived(self, data):
         lines = self._process_data(self.chunk, data)
         for i in range(len(lines) - 1):
-            d = self.api.dispatch_request(self._parse_command(lines[i]))
-            self._pending_requests.append(d)
+            self._dispatch_command(self._parse_command(lines[i]))
         self.chunk = lines[-1]
 
     def outConnectionLost(self):
         if self.chunk:
             line, self.chunk = self.chunk, ""
-            d = self.api.dispatch_request(self._parse_command(line))
-            self._pending_requests.append(d)
+            self._dispatch_command(self._parse_command(line))
 
     def errReceived(self, data):
         lines = self._process_data(self.error_chunk, data)
@@ -187,7 +193,9 @@ class SandboxProtocol(ProcessProtocol):
             self.error_lines.append(self.error_chunk)
             self.error_chunk = ""
 
-    def _process_request_results(self, results):
+    def _process_request_results(self, results, api=None):
+        if api is None:
+            api = self.api
         for success, result in results:
             if not success:
                 # errors here are bugs in Vumi and thus should always
@@ -195,7 +203,7 @@ class SandboxProtocol(ProcessProtocol):
                 log.error(result)
                 # we log them again in a simplified form via the sandbox
                 # api so that the sandbox owner gets to see them too
-                self.api.log(result.getErrorMessage(), logging.ERROR)
+                api.log(result.getErrorMessage(), logging.ERROR)
 
     def processEnded(self, reason):
         if self.timeout_task.active():
@@ -215,6 +223,315 @@ class SandboxProtocol(ProcessProtocol):
         requests_done.addCallback(lambda _r: self._done.callback(result))
 
 
+class PooledSandboxProtocol(SandboxProtocol):
+    """A protocol for a long-lived sandboxed process that handles many
+    messages, one after another.
+
+    Instead of exiting once it has processed a message, a pooled sandbox
+    process writes a ``done`` command and waits for the next one. The
+    process is told that it is pooled by the ``VUMI_SANDBOX_POOLED``
+    environment variable.
+
+    A fresh :class:`SandboxApi` is attached for each message by calling
+    :meth:`process`, but the sandbox is only initialized (e.g. sent the app
+    code) for the first message, so the app stays loaded between messages.
+    The ``timeout`` and ``recv_limit`` apply to each message rather than to
+    the whole lifetime of the process. Note that rlimits (``RLIMIT_CPU`` in
+    particular) still apply to the whole process.
+    """
+
+    POOLED_ENV_VAR = 'VUMI_SANDBOX_POOLED'
+
+    def __init__(self, sandbox_id, executable, spawn_kwargs, rlimits,
+                 timeout, recv_limit, max_messages, max_rss=None):
+        self.sandbox_id = sandbox_id
+        self.api = None
+        self.executable = executable
+        env = dict(spawn_kwargs.get('env') or {})
+        env[self.POOLED_ENV_VAR] = '1'
+        self.spawn_kwargs = dict(spawn_kwargs, env=env)
+        self.rlimits = rlimits
+        self.timeout = timeout
+        self.recv_limit = recv_limit
+        self.max_messages = max_messages
+        self.max_rss = max_rss
+        self.messages_processed = 0
+        self.initialized = False
+        self.retired = False
+        self.last_used = time.time()
+        self._started = MultiDeferred()
+        self._done = MultiDeferred()
+        self._message_done = None
+        self._pending_requests = []
+        self._queued_commands = []
+        self.exit_reason = None
+        self.timeout_task = None
+        self.recv_bytes = 0
+        self.chunk = ''
+        self.error_chunk = ''
+        self.error_lines = []
+
+    def process(self, api, api_callback):
+        """Process a single message.
+
+        :param SandboxApi api:
+            The API to dispatch this message's commands to.
+        :param api_callback:
+            Called with no arguments once the sandbox has been initialized.
+            It should send the message to the sandbox.
+
+        Returns a deferred that fires once the sandbox reports that it is
+        done with the message, or fails if the process ends first.
+        """
+        api.set_sandbox(self)
+        self.api = api
+        self.recv_bytes = 0
+        self.messages_processed += 1
+        self._message_done = Deferred()
+        self.timeout_task = reactor.callLater(self.timeout, self.kill)
+        queued, self._queued_commands = self._queued_commands, []
+        for command in queued:
+            self._dispatch_command(command)
+        if not self.initialized:
+            self.initialized = True
+            api.sandbox_init()
+        api_callback()
+        return self._message_done
+
+    def _dispatch_command(self, command):
+        if self.api is None:
+            # Commands sent between messages (such as log messages written
+            # while starting up) are handled with the next message.
+            self._queued_commands.append(command)
+        elif command['cmd'] == 'done' and not command['reply']:
+            self._finish_message(0)
+        else:
+            SandboxProtocol._dispatch_command(self, command)
+
+    def _finish_message(self, result):
+        if self.timeout_task is not None and self.timeout_task.active():
+            self.timeout_task.cancel()
+        self.timeout_task = None
+        message_done, self._message_done = self._message_done, None
+        if message_done is None:
+            return
+        api, self.api = self.api, None
+        if self.error_lines:
+            api.log("\n".join(self.error_lines), logging.ERROR)
+            self.error_lines = []
+        pending, self._pending_requests = self._pending_requests, []
+        self.last_used = time.time()
+        requests_done = DeferredList(pending)
+        requests_done.addCallback(self._process_request_results, api)
+        requests_done.addCallback(lambda _r: message_done.callback(result))
+
+    def rss(self):
+        """Return the resident memory size of the process in bytes, or
+        ``None`` if it cannot be determined."""
+        if self.transport is None or self.transport.pid is None:
+            return None
+        try:
+            with open('/proc/%s/status' % (self.transport.pid,)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, ValueError):
+            pass
+        return None
+
+    def should_recycle(self):
+        """Return ``True`` if this process should not be reused."""
+        if self.retired:
+            return True
+        if self.messages_processed >= self.max_messages:
+            return True
+        if self.max_rss is not None:
+            rss = self.rss()
+            if rss is not None and rss > self.max_rss:
+                return True
+        return False
+
+    def retire(self):
+        """Ask the process to exit by closing its stdin.
+
+        It is killed if it has not exited within the timeout. Returns a
+        deferred that fires once the process has ended.
+        """
+        self.retired = True
+        if self.transport is not None and self.transport.pid is not None:
+            self.transport.closeStdin()
+            self.timeout_task = reactor.callLater(self.timeout, self.kill)
+        d = self.done()
+        d.addErrback(lambda _f: None)
+        return d
+
+    def processEnded(self, reason):
+        self.retired = True
+        if self.timeout_task is not None and self.timeout_task.active():
+            self.timeout_task.cancel()
+        self.timeout_task = None
+        if isinstance(reason.value, ProcessDone):
+            result = reason.value.status
+        else:
+            result = reason
+        if not self._started.fired():
+            self._started.callback(Failure(
+                SandboxError("Process failed to start.")))
+        if self._message_done is not None:
+            self._finish_message(result)
+        elif self.error_lines:
+            log.error("\n".join(self.error_lines))
+            self.error_lines = []
+        self._done.callback(result)
+
+
+class SandboxPool(object):
+    """A bounded pool of :class:`PooledSandboxProtocol` instances for each
+    sandbox id.
+
+    :param create_protocol:
+        Called with a sandbox config to build a new (unspawned) protocol.
+    :param int max_size:
+        Maximum number of processes per sandbox id. Requests for a sandbox
+        with no idle process once the maximum is reached wait for one to be
+        released.
+    :param int idle_timeout:
+        Seconds a process may sit idle before it is stopped.
+    :param MetricManager metrics:
+        Optional metric manager to report pool activity to.
+    """
+
+    METRIC_NAMES = ('hits', 'misses', 'spawns', 'recycles', 'evictions')
+
+    def __init__(self, create_protocol, max_size, idle_timeout, metrics=None):
+        self.create_protocol = create_protocol
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.metrics = metrics
+        self.stats = dict((name, 0) for name in self.METRIC_NAMES)
+        if metrics is not None:
+            for name in self.METRIC_NAMES:
+                metrics.register(Count('sandbox_pool.%s' % (name,)))
+        self._idle = {}
+        self._busy = {}
+        self._waiting = {}
+        self._eviction_task = None
+
+    def _inc(self, name):
+        self.stats[name] += 1
+        if self.metrics is not None:
+            self.metrics['sandbox_pool.%s' % (name,)].inc()
+
+    def start(self):
+        self._eviction_task = LoopingCall(self.evict_idle)
+        d = self._eviction_task.start(
+            max(self.idle_timeout / 2.0, 1), now=False)
+        d.addErrback(lambda f: log.err(f, "Sandbox pool eviction task died"))
+
+    def stop(self):
+        """Stop all processes, idle or busy."""
+        if self._eviction_task is not None and self._eviction_task.running:
+            self._eviction_task.stop()
+        self._eviction_task = None
+        for waiting in self._waiting.itervalues():
+            for d, _config in waiting:
+                d.errback(SandboxError("Sandbox pool stopped."))
+        self._waiting.clear()
+        protocols = []
+        for idle in self._idle.itervalues():
+            protocols.extend(idle)
+        for busy in self._busy.itervalues():
+            protocols.extend(busy)
+        self._idle.clear()
+        self._busy.clear()
+        return DeferredList([p.retire() for p in protocols])
+
+    def idle_count(self, sandbox_id):
+        return len(self._idle.get(sandbox_id, []))
+
+    def busy_count(self, sandbox_id):
+        return len(self._busy.get(sandbox_id, ()))
+
+    def acquire(self, config):
+        """Return a deferred that fires with a started protocol for
+        ``config.sandbox_id``.
+        """
+        sandbox_id = config.sandbox_id
+        idle = self._idle.get(sandbox_id, [])
+        while idle:
+            protocol = idle.pop()
+            if not protocol.retired:
+                self._inc('hits')
+                self._busy.setdefault(sandbox_id, set()).add(protocol)
+                return succeed(protocol)
+        self._inc('misses')
+        if self.busy_count(sandbox_id) < self.max_size:
+            return self._spawn(config)
+        d = Deferred()
+        self._waiting.setdefault(sandbox_id, []).append((d, config))
+        return d
+
+    def _spawn(self, config):
+        protocol = self.create_protocol(config)
+        busy = self._busy.setdefault(config.sandbox_id, set())
+        busy.add(protocol)
+        self._inc('spawns')
+        protocol.spawn()
+
+        def eb(f):
+            busy.discard(protocol)
+            # Nothing will be released to serve the next waiter, so spawn a
+            # process for it (or fail it) now.
+            waiting = self._waiting.get(config.sandbox_id)
+            if waiting:
+                waiting_d, waiting_config = waiting.pop(0)
+                self._spawn(waiting_config).chainDeferred(waiting_d)
+            return f
+
+        return protocol.started().addErrback(eb)
+
+    def release(self, protocol):
+        """Return a protocol to the pool once a message has been processed.
+        """
+        sandbox_id = protocol.sandbox_id
+        self._busy.get(sandbox_id, set()).discard(protocol)
+        if protocol.should_recycle():
+            if not protocol.retired:
+                self._inc('recycles')
+            protocol.retire()
+            protocol = None
+        waiting = self._waiting.get(sandbox_id)
+        if waiting:
+            d, config = waiting.pop(0)
+            if protocol is not None:
+                self._inc('hits')
+                self._busy.setdefault(sandbox_id, set()).add(protocol)
+                d.callback(protocol)
+            else:
+                self._spawn(config).chainDeferred(d)
+        elif protocol is not None:
+            self._idle.setdefault(sandbox_id, []).append(protocol)
+
+    def evict_idle(self):
+        """Stop processes that have been idle for longer than the idle
+        timeout."""
+        cutoff = time.time() - self.idle_timeout
+        for sandbox_id, idle in self._idle.items():
+            keep = []
+            for protocol in idle:
+                if protocol.retired:
+                    continue
+                if protocol.last_used < cutoff:
+                    self._inc('evictions')
+                    protocol.retire()
+                else:
+                    keep.append(protocol)
+            if keep:
+                self._idle[sandbox_id] = keep
+            else:
+                del self._idle[sandbox_id]
+
+
 class SandboxResources(object):
     """Class for holding resources common to a set of sandboxes."""
 
@@ -936,7 +1253,9 @@ class HttpClientResource(SandboxResource):
                      StringIO(base64.b64decode(value['data']))))
                 for key, value in files.iteritems()])
 
-        agent = self.agent_class(reactor, contextFactory=context_factory)
+        agent = build_agent(
+            self.agent_class, context_factory,
+            getattr(self.app_worker, 'http_pool', None))
         http_client = self.http_client_class(agent)
 
         d = http_client.request(method, url, headers=headers, data=data,
@@ -1179,6 +1498,28 @@ class SandboxConfig(ApplicationWorker.CONFIG_CLASS):
         " these directly using Twisted logging instead.",
         default=None)
     sandbox_id = ConfigText("This is set based on individual messages.")
+    pool_size = ConfigInt(
+        "Maximum number of long-lived sandbox processes to keep for each"
+        " sandbox id. Pooled processes handle many messages one after"
+        " another instead of a new process being spawned for each message."
+        " The sandbox is initialized once per process, so apps stay loaded"
+        " between messages and changes to an app only reach processes"
+        " spawned after the change. Set to 0 to disable pooling.",
+        default=0, static=True)
+    pool_max_messages = ConfigInt(
+        "Number of messages a pooled sandbox process handles before it is"
+        " replaced.", default=1000)
+    pool_max_rss = ConfigInt(
+        "Resident memory size (in bytes) above which a pooled sandbox"
+        " process is replaced once it has finished processing a message."
+        " Set to null to disable.", default=None)
+    pool_idle_timeout = ConfigInt(
+        "Number of seconds a pooled sandbox process may sit idle before it"
+        " is stopped.", default=300, static=True)
+    pool_metrics_prefix = ConfigText(
+        "Prefix for sandbox pool metrics (hits, misses, spawns, recycles and"
+        " evictions). Set to null to not publish them.",
+        default=None, static=True)
 
 
 class Sandbox(ApplicationWorker):
@@ -1199,15 +1540,23 @@ class Sandbox(ApplicationWorker):
         resource.RLIMIT_AS: (196 * MB, 196 * MB),
     }
 
+    pool = None
+    metrics = None
+
     def validate_config(self):
         config = self.get_static_config()
         self.resources = self.create_sandbox_resources(config.sandbox)
         self.resources.validate_config()
 
     def get_config(self, msg):
-        config = self.config.copy()
-        config['sandbox_id'] = self.sandbox_id_for_message(msg)
-        return succeed(self.CONFIG_CLASS(config))
+        sandbox_id = self.sandbox_id_for_message(msg)
+
+        def get_config_data():
+            config = self.config.copy()
+            config['sandbox_id'] = sandbox_id
+            return config
+
+        return succeed(self.get_cached_config(sandbox_id, get_config_data))
 
     def _convert_rlimits(self, rlimits_config):
         rlimits = dict((getattr(resource, key, key), value) for key, value in
@@ -1217,11 +1566,26 @@ class Sandbox(ApplicationWorker):
                 raise ConfigError("Unknown resource limit key %r" % (key,))
         return rlimits
 
+    @inlineCallbacks
     def setup_application(self):
-        return self.resources.setup_resources()
+        config = self.get_static_config()
+        if config.pool_size > 0:
+            if config.pool_metrics_prefix is not None:
+                self.metrics = yield self.start_publisher(
+                    MetricManager, config.pool_metrics_prefix)
+            self.pool = SandboxPool(
+                self.create_pooled_sandbox_protocol, config.pool_size,
+                config.pool_idle_timeout, metrics=self.metrics)
+            self.pool.start()
+        yield self.resources.setup_resources()
 
+    @inlineCallbacks
     def teardown_application(self):
-        return self.resources.teardown_resources()
+        if self.pool is not None:
+            yield self.pool.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
+        yield self.resources.teardown_resources()
 
     def setup_connectors(self):
         # Set the default event handler so we can handle events from any
@@ -1254,6 +1618,15 @@ class Sandbox(ApplicationWorker):
             api.config.sandbox_id, api, executable, spawn_kwargs, rlimits,
             api.config.timeout, api.config.recv_limit)
 
+    def create_pooled_sandbox_protocol(self, config):
+        executable, args = self.get_executable_and_args(config)
+        rlimits = self.get_rlimits(config)
+        spawn_kwargs = dict(args=args, env=config.env, path=config.path)
+        return PooledSandboxProtocol(
+            config.sandbox_id, executable, spawn_kwargs, rlimits,
+            config.timeout, config.recv_limit, config.pool_max_messages,
+            config.pool_max_rss)
+
     def create_sandbox_api(self, resources, config):
         return SandboxApi(resources, config)
 
@@ -1287,9 +1660,32 @@ class Sandbox(ApplicationWorker):
         d.addCallbacks(on_start, log.error)
         return d
 
+    @inlineCallbacks
+    def _process_in_pooled_sandbox(self, config, api_callback):
+        api = self.create_sandbox_api(self.resources, config)
+        try:
+            sandbox_protocol = yield self.pool.acquire(config)
+        except Exception:
+            log.error()
+            return
+        try:
+            status = yield sandbox_protocol.process(
+                api, lambda: api_callback(api))
+        except Exception:
+            log.error()
+            status = None
+        finally:
+            self.pool.release(sandbox_protocol)
+        returnValue(status)
+
     @inlineCallbacks
     def process_message_in_sandbox(self, msg):
         config = yield self.get_config(msg)
+        if self.pool is not None:
+            status = yield self._process_in_pooled_sandbox(
+                config, lambda api: api.sandbox_inbound_message(msg))
+            returnValue(status)
+
         sandbox_protocol = yield self.sandbox_protocol_for_message(msg, config)
 
         def sandbox_init():
@@ -1301,6 +1697,11 @@ class Sandbox(ApplicationWorker):
     @inlineCallbacks
     def process_event_in_sandbox(self, event):
         config = yield self.get_config(event)
+        if self.pool is not None:
+            status = yield self._process_in_pooled_sandbox(
+                config, lambda api: api.sandbox_inbound_event(event))
+            returnValue(status)
+
         sandbox_protocol = yield self.sandbox_protocol_for_message(
             event, config)
 
@@ -2,6 +2,11 @@ var vm = require('vm');
 var events = require('events');
 var EventEmitter = events.EventEmitter;
 
+// Pooled sandboxes handle many messages and report when they're done with
+// each one instead of exiting. The app is loaded once and stays loaded for
+// all of them.
+var POOLED = !!process.env.VUMI_SANDBOX_POOLED;
+
 
 var SandboxApi = function () {
     // API for use by applications
@@ -89,13 +94,24 @@ var SandboxRunner = function (api) {
     });
 
     self.api.emitter.on('done', function() {
-        self.exit();
+        if (POOLED) {
+            self.finish();
+        } else {
+            self.exit();
+        }
     });
 
     self.exit = function() {
         process.exit(0);
     };
 
+    self.finish = function() {
+        // Tell the parent we're done with this message and wait for the
+        // next one.
+        self.pending_requests = {};
+        self.send_command(self.api.populate_command("done", {}));
+    };
+
     self.load_code = function (command) {
         self.log("Loading sandboxed code ...");
         var ctxt;
@@ -149,6 +165,10 @@ var SandboxRunner = function (api) {
         process.stdin.setEncoding('ascii');
         process.stdin.on('data', function(data) {
             self.data_from_stdin(data); });
+        if (POOLED) {
+            process.stdin.on('end', function() {
+                self.exit(); });
+        }
     };
 };
 
@@ -16,7 +16,7 @@ from OpenSSL.SSL import (
     SSLv3_METHOD, SSLv23_METHOD, TLSv1_METHOD)
 
 from twisted.internet.defer import (
-    inlineCallbacks, fail, succeed, DeferredQueue)
+    inlineCallbacks, fail, succeed, DeferredQueue, gatherResults)
 from twisted.internet.error import ProcessTerminated
 from twisted.web.http_headers import Headers
 
@@ -398,6 +398,127 @@ class TestSandbox(SandboxTestCaseBase):
         self.assertEqual(cmd['timestamp'], "2014-07-18 15:00:00.000000")
 
 
+class TestPooledSandbox(SandboxTestCaseBase):
+
+    POOLED_SANDBOX = (
+        "import sys, os, json\n"
+        "log = {'cmd': 'log.info', 'cmd_id': '0', 'reply': False,\n"
+        "       'msg': 'pid %s' % (os.getpid(),)}\n"
+        "sys.stdout.write(json.dumps(log) + '\\n')\n"
+        "sys.stdout.flush()\n"
+        "for line in iter(sys.stdin.readline, ''):\n"
+        "    cmd = json.loads(line)\n"
+        "    done = {'cmd': 'done', 'cmd_id': '1', 'reply': False}\n"
+        "    sys.stdout.write(json.dumps(done) + '\\n')\n"
+        "    sys.stdout.flush()\n"
+    )
+
+    def setup_app(self, extra_config=None):
+        config = {
+            'pool_size': 1,
+            'sandbox': {
+                'log': {'cls': 'vumi.application.sandbox.LoggingResource'},
+            },
+        }
+        config.update(extra_config or {})
+        return super(TestPooledSandbox, self).setup_app(
+            sys.executable, ['-c', self.POOLED_SANDBOX], extra_config=config)
+
+    def process_ack(self, app, sandbox_id='sandbox1'):
+        return app.process_event_in_sandbox(
+            self.app_helper.make_ack(sandbox_id=sandbox_id))
+
+    @inlineCallbacks
+    def test_process_reused(self):
+        app = yield self.setup_app()
+        with LogCatcher() as lc:
+            status1 = yield self.process_ack(app)
+            status2 = yield self.process_ack(app)
+            msgs = lc.messages()
+        self.assertEqual([status1, status2], [0, 0])
+        self.assertEqual(len(msgs), 1)
+        self.assertTrue(msgs[0].startswith('pid '))
+        self.assertEqual(app.pool.stats['spawns'], 1)
+        self.assertEqual(app.pool.stats['hits'], 1)
+        self.assertEqual(app.pool.stats['misses'], 1)
+        self.assertEqual(app.pool.idle_count('sandbox1'), 1)
+
+    @inlineCallbacks
+    def test_process_per_sandbox_id(self):
+        app = yield self.setup_app()
+        yield self.process_ack(app, 'sandbox1')
+        yield self.process_ack(app, 'sandbox2')
+        yield self.process_ack(app, 'sandbox1')
+        self.assertEqual(app.pool.stats['spawns'], 2)
+        self.assertEqual(app.pool.idle_count('sandbox1'), 1)
+        self.assertEqual(app.pool.idle_count('sandbox2'), 1)
+
+    @inlineCallbacks
+    def test_recycle_after_max_messages(self):
+        app = yield self.setup_app({'pool_max_messages': 2})
+        statuses = []
+        for i in range(3):
+            statuses.append((yield self.process_ack(app)))
+        self.assertEqual(statuses, [0, 0, 0])
+        self.assertEqual(app.pool.stats['spawns'], 2)
+        self.assertEqual(app.pool.stats['recycles'], 1)
+
+    @inlineCallbacks
+    def test_wait_for_process_when_pool_full(self):
+        app = yield self.setup_app()
+        statuses = yield gatherResults(
+            [self.process_ack(app) for i in range(3)])
+        self.assertEqual(statuses, [0, 0, 0])
+        self.assertEqual(app.pool.stats['spawns'], 1)
+        self.assertEqual(app.pool.busy_count('sandbox1'), 0)
+        self.assertEqual(app.pool.idle_count('sandbox1'), 1)
+
+    @inlineCallbacks
+    def test_evict_idle(self):
+        app = yield self.setup_app()
+        yield self.process_ack(app)
+        [protocol] = app.pool._idle['sandbox1']
+        app.pool.evict_idle()
+        self.assertEqual(app.pool.idle_count('sandbox1'), 1)
+        protocol.last_used -= app.pool.idle_timeout + 1
+        app.pool.evict_idle()
+        self.assertEqual(app.pool.idle_count('sandbox1'), 0)
+        self.assertEqual(app.pool.stats['evictions'], 1)
+        status = yield protocol.done()
+        self.assertEqual(status, 0)
+
+    @inlineCallbacks
+    def test_initialized_once_per_process(self):
+        app = yield self.setup_app()
+        inits = []
+        self.patch(SandboxApi, 'sandbox_init', lambda api: inits.append(api))
+        yield self.process_ack(app)
+        yield self.process_ack(app)
+        self.assertEqual(len(inits), 1)
+
+    @inlineCallbacks
+    def test_spawn_failure_serves_waiters(self):
+        app = yield self.setup_app({
+            'executable': '/nonexistent/sandbox/executable'})
+        statuses = yield gatherResults(
+            [self.process_ack(app) for i in range(3)])
+        self.assertEqual(statuses, [None, None, None])
+        self.assertEqual(len(self.flushLoggedErrors(ProcessTerminated)), 3)
+        self.assertEqual(app.pool.stats['spawns'], 3)
+        self.assertEqual(app.pool.busy_count('sandbox1'), 0)
+
+    @inlineCallbacks
+    def test_process_dies(self):
+        app = yield self.setup_app()
+        yield self.process_ack(app)
+        [protocol] = app.pool._idle['sandbox1']
+        protocol.kill()
+        yield protocol.done().addErrback(lambda f: None)
+        status = yield self.process_ack(app)
+        self.assertEqual(status, 0)
+        self.assertEqual(app.pool.stats['spawns'], 2)
+
+
 class JsSandboxTestMixin(object):
 
     BIGGER_RLIMITS = {
@@ -452,6 +573,37 @@ class JsSandboxTestMixin(object):
             'Done.',
         ])
 
+    @inlineCallbacks
+    def test_js_sandboxer_pooled(self):
+        app_js = pkg_resources.resource_filename('vumi.application.tests',
+                                                 'app.js')
+        javascript = file(app_js).read()
+        app = yield self.setup_app(javascript, extra_config={
+            "pool_size": 1,
+        })
+
+        with LogCatcher() as lc:
+            status1 = yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sandbox1'))
+            status2 = yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("bar", sandbox_id='sandbox1'))
+            failures = [log['failure'].value for log in lc.errors]
+            msgs = lc.messages()
+        self.assertEqual(failures, [])
+        self.assertEqual([status1, status2], [0, 0])
+        self.assertEqual(app.pool.stats['spawns'], 1)
+        self.assertEqual(msgs, [
+            'Starting sandbox ...',
+            'Loading sandboxed code ...',
+            'From init!',
+            'From command: inbound-message',
+            'Log successful: true',
+            'Done.',
+            'From command: inbound-message',
+            'Log successful: true',
+            'Done.',
+        ])
+
     @inlineCallbacks
     def test_js_sandboxer_with_delayed_requests(self):
         app_js = pkg_resources.resource_filename('vumi.application.tests',
@@ -5,6 +5,7 @@
 Includes a publisher, a consumer and a set of simple metrics.
 """
 
+import math
 import time
 import warnings
 
@@ -169,6 +170,195 @@ class AggregatorAlreadyDefinedError(Exception):
     pass
 
 
+class AggregatorState(object):
+    """Incremental state for an aggregator.
+
+    Values are added one at a time and the aggregate is calculated from the
+    state when it is needed, so the values themselves need not be kept.
+    States of the same type may be merged, which allows values to be
+    aggregated in separate pieces and combined later.
+    """
+
+    def add(self, timestamp, value):
+        """Add a value to the state."""
+        raise NotImplementedError()
+
+    def merge(self, other):
+        """Add all the values in another state of the same type to this one.
+        """
+        raise NotImplementedError()
+
+    def result(self):
+        """Return the aggregate of all the values added so far."""
+        raise NotImplementedError()
+
+
+class ValuesState(AggregatorState):
+    """Aggregator state that keeps all the values it is given.
+
+    This is used for aggregators that only have an aggregation function.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.values = []
+
+    def add(self, timestamp, value):
+        self.values.append((timestamp, value))
+
+    def merge(self, other):
+        self.values.extend(other.values)
+
+    def result(self):
+        return self.func([v for t, v in sorted(self.values)])
+
+
+class SumState(AggregatorState):
+    def __init__(self):
+        self.total = 0.0
+
+    def add(self, timestamp, value):
+        self.total += value
+
+    def merge(self, other):
+        self.total += other.total
+
+    def result(self):
+        return self.total
+
+
+class AvgState(AggregatorState):
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, timestamp, value):
+        self.total += value
+        self.count += 1
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+
+    def result(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class MaxState(AggregatorState):
+    def __init__(self):
+        self.value = None
+
+    def add(self, timestamp, value):
+        if self.value is None or value > self.value:
+            self.value = value
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(None, other.value)
+
+    def result(self):
+        return self.value if self.value is not None else 0.0
+
+
+class MinState(MaxState):
+    def add(self, timestamp, value):
+        if self.value is None or value < self.value:
+            self.value = value
+
+
+class LastState(AggregatorState):
+    """Keeps the value with the latest timestamp."""
+
+    def __init__(self):
+        self.last = None
+
+    def add(self, timestamp, value):
+        if self.last is None or (timestamp, value) > self.last:
+            self.last = (timestamp, value)
+
+    def merge(self, other):
+        if other.last is not None:
+            self.add(*other.last)
+
+    def result(self):
+        return self.last[1] if self.last is not None else 0.0
+
+
+class QuantileSketch(AggregatorState):
+    """A mergeable sketch for estimating quantiles.
+
+    Values are counted in logarithmically sized buckets so that any quantile
+    can be estimated to within a relative error of ``relative_accuracy``
+    using an amount of memory that depends only on the range of the values,
+    not on how many there are. (This is the approach taken by DDSketch.)
+
+    :param float quantile:
+        The quantile (between 0 and 1) that :meth:`result` returns.
+    :param float relative_accuracy:
+        The maximum relative error of the estimates.
+    """
+
+    def __init__(self, quantile, relative_accuracy=0.01):
+        self.quantile = quantile
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.count = 0
+        self.zero_count = 0
+        self.positive = {}
+        self.negative = {}
+
+    def _index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _value(self, index):
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def add(self, timestamp, value):
+        self.count += 1
+        if value > 0:
+            index = self._index(value)
+            self.positive[index] = self.positive.get(index, 0) + 1
+        elif value < 0:
+            index = self._index(-value)
+            self.negative[index] = self.negative.get(index, 0) + 1
+        else:
+            self.zero_count += 1
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can't merge sketches with different accuracies.")
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for store, other_store in [(self.positive, other.positive),
+                                   (self.negative, other.negative)]:
+            for index, count in other_store.iteritems():
+                store[index] = store.get(index, 0) + count
+
+    def get_quantile(self, quantile):
+        """Return an estimate of the given quantile, or 0.0 if no values
+        have been added."""
+        if not self.count:
+            return 0.0
+        rank = quantile * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self.positive))
+
+    def result(self):
+        return self.get_quantile(self.quantile)
+
+
 class Aggregator(object):
     """Registry of aggregate functions for metrics.
 
@@ -179,15 +369,21 @@ class Aggregator(object):
     :param func:
        The aggregation function. Should return a default value
        if the list of values is empty (usually this default is 0.0).
+    :type state_factory: f() -> :class:`AggregatorState`
+    :param state_factory:
+       Optional factory for incremental aggregator state. If this is not
+       given, a :class:`ValuesState` that applies ``func`` to all the values
+       is used.
     """
 
     REGISTRY = {}
 
-    def __init__(self, name, func):
+    def __init__(self, name, func, state_factory=None):
         if name in self.REGISTRY:
             raise AggregatorAlreadyDefinedError(name)
         self.name = name
         self.func = func
+        self.state_factory = state_factory
         self.REGISTRY[name] = self
 
     @classmethod
@@ -197,13 +393,35 @@ class Aggregator(object):
     def __call__(self, values):
         return self.func(values)
 
+    def new_state(self):
+        """Return a new :class:`AggregatorState` for this aggregator."""
+        if self.state_factory is None:
+            return ValuesState(self.func)
+        return self.state_factory()
+
+
+def _quantile_func(quantile):
+    def func(values):
+        state = QuantileSketch(quantile)
+        for value in values:
+            state.add(None, value)
+        return state.result()
+    return func
+
 
-SUM = Aggregator("sum", sum)
+SUM = Aggregator("sum", sum, SumState)
 AVG = Aggregator("avg",
-                 lambda values: sum(values) / len(values) if values else 0.0)
-MAX = Aggregator("max", lambda values: max(values) if values else 0.0)
-MIN = Aggregator("min", lambda values: min(values) if values else 0.0)
-LAST = Aggregator("last", lambda values: values[-1] if values else 0.0)
+                 lambda values: sum(values) / len(values) if values else 0.0,
+                 AvgState)
+MAX = Aggregator("max", lambda values: max(values) if values else 0.0,
+                 MaxState)
+MIN = Aggregator("min", lambda values: min(values) if values else 0.0,
+                 MinState)
+LAST = Aggregator("last", lambda values: values[-1] if values else 0.0,
+                  LastState)
+P50 = Aggregator("p50", _quantile_func(0.5), lambda: QuantileSketch(0.5))
+P95 = Aggregator("p95", _quantile_func(0.95), lambda: QuantileSketch(0.95))
+P99 = Aggregator("p99", _quantile_func(0.99), lambda: QuantileSketch(0.99))
 
 
 class MetricRegistrationError(Exception):
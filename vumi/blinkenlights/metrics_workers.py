@@ -196,8 +196,9 @@ class MetricAggregator(Worker):
         log.msg("Bucket size is %d seconds" % self.bucket_size)
         self.lag = float(self.config.get("lag", 5.0))
 
-        # ts_key -> { metric_name -> (aggregate_set, values) }
-        # values is a list of (timestamp, value) pairs
+        # ts_key -> { metric_name -> { aggregator_name -> state } }
+        # state is an AggregatorState that values are added to as they
+        # arrive, so we don't need to keep the values themselves.
         self.buckets = {}
         # initialize last processed bucket
         self._last_ts_key = self._ts_key(self._time() - self.lag) - 2
@@ -224,13 +225,10 @@ class MetricAggregator(Worker):
                 aggregates = []
                 ts = ts_key * self.bucket_size
                 items = self.buckets[ts_key].iteritems()
-                for metric_name, (agg_set, values) in items:
-                    values = [v for t, v in sorted(values)]
-                    for agg_name in agg_set:
+                for metric_name, agg_states in items:
+                    for agg_name, agg_state in agg_states.iteritems():
                         agg_metric = "%s.%s" % (metric_name, agg_name)
-                        agg_func = Aggregator.from_name(agg_name)
-                        agg_value = agg_func(values)
-                        aggregates.append((agg_metric, agg_value))
+                        aggregates.append((agg_metric, agg_state.result()))
 
                 for agg_metric, agg_value in aggregates:
                     self.publisher.publish_aggregate(agg_metric, ts,
@@ -245,12 +243,20 @@ class MetricAggregator(Worker):
         metrics = self.buckets.get(ts_key, None)
         if metrics is None:
             metrics = self.buckets[ts_key] = {}
-        metric = metrics.get(metric_name)
-        if metric is None:
-            metric = metrics[metric_name] = (set(), [])
-        existing_aggregates, existing_values = metric
-        existing_aggregates.update(aggregates)
-        existing_values.extend(values)
+        agg_states = metrics.get(metric_name)
+        if agg_states is None:
+            agg_states = metrics[metric_name] = {}
+        # Aggregators are normally fixed for a given metric, but if a new one
+        # turns up part way through a bucket it only sees the values that
+        # arrive after it.
+        for agg_name in aggregates:
+            if agg_name not in agg_states:
+                agg_states[agg_name] = Aggregator.from_name(
+                    agg_name).new_state()
+        states = agg_states.values()
+        for timestamp, value in values:
+            for state in states:
+                state.add(timestamp, value)
 
     def stopWorker(self):
         self._task.stop()
@@ -311,6 +311,71 @@ class TestAggregators(VumiTestCase):
         self.assertRaises(metrics.AggregatorAlreadyDefinedError,
                           metrics.Aggregator, "sum", sum)
 
+    def test_percentiles(self):
+        values = [float(v) for v in range(1, 101)]
+        for agg, expected in [(metrics.P50, 50.0), (metrics.P95, 95.0),
+                              (metrics.P99, 99.0)]:
+            self.assertEqual(agg([]), 0.0)
+            self.assertApproximates(agg(values), expected, expected * 0.01)
+            self.assertEqual(metrics.Aggregator.from_name(agg.name), agg)
+
+    def check_state(self, agg, timestamped_values):
+        state = agg.new_state()
+        self.assertEqual(state.result(), 0.0)
+        for t, v in timestamped_values:
+            state.add(t, v)
+        values = [v for t, v in sorted(timestamped_values)]
+        self.assertEqual(state.result(), agg(values))
+
+        half = len(timestamped_values) // 2
+        state1, state2 = agg.new_state(), agg.new_state()
+        for t, v in timestamped_values[:half]:
+            state1.add(t, v)
+        for t, v in timestamped_values[half:]:
+            state2.add(t, v)
+        state2.merge(state1)
+        self.assertEqual(state2.result(), agg(values))
+
+    def test_states(self):
+        timestamped_values = [(3, 2.0), (1, -1.0), (2, 0.0), (5, 7.5),
+                              (4, 3.0)]
+        for agg in [metrics.SUM, metrics.AVG, metrics.MIN, metrics.MAX,
+                    metrics.LAST, metrics.P50, metrics.P95, metrics.P99]:
+            self.check_state(agg, timestamped_values)
+
+    def test_values_state(self):
+        agg = metrics.Aggregator("test_values_state", lambda vs: vs[0] * 10)
+        self.add_cleanup(metrics.Aggregator.REGISTRY.pop, agg.name)
+        state = agg.new_state()
+        self.assertTrue(isinstance(state, metrics.ValuesState))
+        state.add(2, 1.0)
+        state.add(1, 3.0)
+        self.assertEqual(state.result(), 30.0)
+
+    def test_quantile_sketch_accuracy(self):
+        sketch = metrics.QuantileSketch(0.5, relative_accuracy=0.01)
+        for v in range(1, 10001):
+            sketch.add(None, float(v))
+        for q in [0.0, 0.1, 0.5, 0.9, 0.99, 1.0]:
+            expected = 1 + q * 9999
+            self.assertApproximates(
+                sketch.get_quantile(q), expected, expected * 0.01)
+        # The sketch only needs a bucket per 2% of the range of values.
+        self.assertTrue(len(sketch.positive) < 500)
+
+    def test_quantile_sketch_negative_and_zero(self):
+        sketch = metrics.QuantileSketch(0.5)
+        for v in [-10.0, -1.0, 0.0, 0.0, 0.0, 1.0, 10.0]:
+            sketch.add(None, v)
+        self.assertEqual(sketch.get_quantile(0.5), 0.0)
+        self.assertApproximates(sketch.get_quantile(0.0), -10.0, 0.1)
+        self.assertApproximates(sketch.get_quantile(1.0), 10.0, 0.1)
+
+    def test_quantile_sketch_merge_accuracy_mismatch(self):
+        sketch = metrics.QuantileSketch(0.5, relative_accuracy=0.01)
+        other = metrics.QuantileSketch(0.5, relative_accuracy=0.02)
+        self.assertRaises(ValueError, sketch.merge, other)
+
 
 class CheckValuesMixin(object):
 
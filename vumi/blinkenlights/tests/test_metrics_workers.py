@@ -153,6 +153,33 @@ class TestMetricAggregator(VumiTestCase):
         worker.check_buckets()
         self.assertEqual(recv(), expected)
 
+    @inlineCallbacks
+    def test_aggregating_percentiles(self):
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricAggregator, config, start=False)
+        worker._time = self.fake_time
+        yield worker.startWorker()
+
+        datapoints = [
+            ("vumi.test.foo", ("p50", "p99"),
+             [(1235, float(v)) for v in range(1, 101)]),
+            ]
+        self.broker.send_datapoints(
+            "vumi.metrics.buckets", "bucket.3", datapoints)
+        yield self.broker.kick_delivery()
+
+        self.now = 1246
+        worker.check_buckets()
+        msgs = self.broker.recv_datapoints("vumi.metrics.aggregates",
+                                           "vumi.metrics.aggregates")
+        aggregates = dict((name, points) for [(name, _, points)] in msgs)
+        [[ts, p50]] = aggregates["vumi.test.foo.p50"]
+        [[ts, p99]] = aggregates["vumi.test.foo.p99"]
+        self.assertEqual(ts, 1235)
+        self.assertApproximates(p50, 50.0, 0.5)
+        self.assertApproximates(p99, 99.0, 1.0)
+
     @inlineCallbacks
     def test_aggregating_lag(self):
         config = {'bucket': 3, 'bucket_size': 5, 'lag': 1}
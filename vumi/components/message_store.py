@@ -7,18 +7,19 @@ from calendar import timegm
 from collections import defaultdict
 from datetime import datetime
 from uuid import uuid4
-import itertools
+import time
 import warnings
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.message import (
     TransportEvent, TransportUserMessage, parse_vumi_date, format_vumi_date)
-from vumi.persist.model import Model, Manager
+from vumi.persist.model import Model, Manager, VumiRiakObjectExistsError
 from vumi.persist.fields import (
     VumiMessage, ForeignKey, ManyToMany, ListOf, Tag, Dynamic, Unicode)
 from vumi.persist.txriak_manager import TxRiakManager
 from vumi import log
+from vumi.blinkenlights.metrics import Count, Metric
 from vumi.components.message_store_cache import MessageStoreCache
 from vumi.components.message_store_migrators import (
     EventMigrator, InboundMessageMigrator, OutboundMessageMigrator)
@@ -102,7 +103,7 @@ class OutboundMessage(Model):
     batches_with_addresses = ListOf(Unicode(), index=True)
     batches_with_addresses_reverse = ListOf(Unicode(), index=True)
 
-    def save(self):
+    def save(self, if_none_match=False):
         # We override this method to set our index fields before saving.
         self.batches_with_timestamps = []
         self.batches_with_addresses = []
@@ -118,7 +119,7 @@ class OutboundMessage(Model):
                 u"%s$%s$%s" % (batch_id, timestamp, self.msg['to_addr']))
             self.batches_with_addresses_reverse.append(
                 u"%s$%s$%s" % (batch_id, reverse_ts, self.msg['to_addr']))
-        return super(OutboundMessage, self).save()
+        return super(OutboundMessage, self).save(if_none_match=if_none_match)
 
 
 class Event(Model):
@@ -134,7 +135,7 @@ class Event(Model):
     message_with_status = Unicode(index=True, null=True)
     batches_with_statuses_reverse = ListOf(Unicode(), index=True)
 
-    def save(self):
+    def save(self, if_none_match=False):
         # We override this method to set our index fields before saving.
         timestamp = self.event['timestamp']
         if not isinstance(timestamp, basestring):
@@ -149,7 +150,7 @@ class Event(Model):
         for batch_id in self.batches.keys():
             self.batches_with_statuses_reverse.append(
                 u"%s$%s$%s" % (batch_id, reverse_ts, status))
-        return super(Event, self).save()
+        return super(Event, self).save(if_none_match=if_none_match)
 
 
 class InboundMessage(Model):
@@ -165,7 +166,7 @@ class InboundMessage(Model):
     batches_with_addresses = ListOf(Unicode(), index=True)
     batches_with_addresses_reverse = ListOf(Unicode(), index=True)
 
-    def save(self):
+    def save(self, if_none_match=False):
         # We override this method to set our index fields before saving.
         self.batches_with_timestamps = []
         self.batches_with_addresses = []
@@ -181,7 +182,7 @@ class InboundMessage(Model):
                 u"%s$%s$%s" % (batch_id, timestamp, self.msg['from_addr']))
             self.batches_with_addresses_reverse.append(
                 u"%s$%s$%s" % (batch_id, reverse_ts, self.msg['from_addr']))
-        return super(InboundMessage, self).save()
+        return super(InboundMessage, self).save(if_none_match=if_none_match)
 
 
 class ReconKeyManager(object):
@@ -189,37 +190,129 @@ class ReconKeyManager(object):
     A helper for tracking keys during cache recon.
 
     Keys are added one at a time from oldest to newest, and a buffer of recent
-    keys is kept to allow old and new keys to be handled differently.
+    keys is kept so that they can be added to the cache individually while
+    older keys are only counted. Keys newer than :attr:`start_timestamp` are
+    not buffered, because they can be added to the cache as soon as they are
+    seen.
     """
 
     def __init__(self, start_timestamp, key_count):
         self.start_timestamp = start_timestamp
         self.key_count = key_count
+        self.position = 0
         self.cache_keys = []
-        self.new_keys = []
+        self.unsaved_keys = []
+
+    def is_new(self, timestamp):
+        """
+        Return ``True`` if ``timestamp`` is newer than :attr:`start_timestamp`.
+        """
+        return timestamp > self.start_timestamp
 
     def add_key(self, key, timestamp):
         """
-        Add a key and timestamp to the manager.
+        Add a key and timestamp to the buffer.
 
-        If ``timestamp`` is newer than :attr:`start_timestamp`, the pair is
-        added to :attr:`new_keys`, otherwise it is added to :attr:`cache_keys`.
         If this causes :attr:`cache_keys` to grow larger than
         :attr:`key_count`, the earliest entry is removed and returned. If not,
         ``None`` is returned.
 
         It is assumed that keys will be added from oldest to newest.
         """
-        if timestamp > self.start_timestamp:
-            self.new_keys.append((key, timestamp))
-            return None
+        self.unsaved_keys.append((self.position, key, timestamp))
+        self.position += 1
         self.cache_keys.append((key, timestamp))
         if len(self.cache_keys) > self.key_count:
             return self.cache_keys.pop(0)
         return None
 
+    def pop_unsaved_keys(self):
+        """
+        Return the ``(position, key, timestamp)`` tuples added since the last
+        call and forget them.
+        """
+        unsaved_keys, self.unsaved_keys = self.unsaved_keys, []
+        return unsaved_keys
+
+    def buffer_range(self):
+        """
+        Return the range of positions of the keys in :attr:`cache_keys`.
+        """
+        return (max(0, self.position - self.key_count), self.position)
+
     def __iter__(self):
-        return itertools.chain(self.cache_keys, self.new_keys)
+        return iter(self.cache_keys)
+
+
+class ReconProgress(object):
+    """
+    A helper for tracking the progress of cache recon in one direction.
+
+    The counters and cursor of the index walk are checkpointed after each page
+    so that an interrupted recon can carry on from where it left off. The
+    buffered keys are saved separately, see
+    :meth:`MessageStoreCache.add_reconciliation_keys`.
+
+    :param str direction:
+        Either ``'inbound'`` or ``'outbound'``.
+    :param str start_timestamp:
+        Messages newer than this are treated as new during recon.
+    :param int key_count:
+        The number of recent keys to keep in the cache.
+    :param dict checkpoint:
+        State saved by :meth:`get_state` to resume from, if any.
+    """
+
+    def __init__(self, direction, start_timestamp, key_count,
+                 checkpoint=None):
+        self.direction = direction
+        self.key_manager = ReconKeyManager(start_timestamp, key_count)
+        self.key_count = 0
+        self.status_counts = defaultdict(int)
+        self.continuation = None
+        self.pages = 0
+        self.counts_added = False
+        self.started = time.time()
+        self.keys_seen = 0
+        if checkpoint is not None:
+            self.set_state(checkpoint)
+
+    def get_state(self):
+        return {
+            'key_count': self.key_count,
+            'status_counts': self.status_counts,
+            'continuation': self.continuation,
+            'pages': self.pages,
+            'counts_added': self.counts_added,
+            'position': self.key_manager.position,
+        }
+
+    def set_state(self, state):
+        self.key_count = state['key_count']
+        self.status_counts.update(state['status_counts'])
+        self.continuation = state['continuation']
+        self.pages = state['pages']
+        self.counts_added = state['counts_added']
+        self.key_manager.position = state['position']
+
+    def add_status_counts(self, status_counts):
+        for status, count in status_counts.iteritems():
+            self.status_counts[status] += count
+
+    def page_done(self, index_page, keys):
+        """
+        Record that a page of keys has been processed and return the number of
+        keys per second processed so far.
+        """
+        self.pages += 1
+        self.keys_seen += keys
+        self.continuation = None
+        if index_page.has_next_page():
+            self.continuation = index_page.continuation
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.keys_seen / elapsed
 
 
 class MessageStore(object):
@@ -232,12 +325,18 @@ class MessageStore(object):
     A small amount of information about the state of a batch (i.e. number
     of messages in the batch, messages sent, acknowledgements and delivery
     reports received) is stored in Redis.
+
+    If a :class:`vumi.blinkenlights.metrics.MetricManager` is provided as
+    ``metrics``, cache recon progress is reported through it.
     """
 
     # The Python Riak client defaults to max_results=1000 in places.
     DEFAULT_MAX_RESULTS = 1000
 
-    def __init__(self, manager, redis):
+    # The number of Riak lookups to have in flight at once during recon.
+    RECONCILE_CONCURRENCY = 10
+
+    def __init__(self, manager, redis, metrics=None):
         self.manager = manager
         self.batches = manager.proxy(Batch)
         self.outbound_messages = manager.proxy(OutboundMessage)
@@ -245,6 +344,27 @@ class MessageStore(object):
         self.inbound_messages = manager.proxy(InboundMessage)
         self.current_tags = manager.proxy(CurrentTag)
         self.cache = MessageStoreCache(redis)
+        self.metrics = metrics
+        if metrics is not None:
+            self._register_recon_metrics(metrics)
+
+    def _register_recon_metrics(self, metrics):
+        for direction in ['inbound', 'outbound']:
+            metrics.register(
+                Count('message_store.reconcile.%s_keys' % (direction,)))
+            metrics.register(Metric(
+                'message_store.reconcile.%s_keys_per_second' % (direction,)))
+
+    def _report_recon_progress(self, batch_id, progress, keys, rate):
+        log.info(
+            "Reconciling %s cache for batch %s: %s keys in %s pages"
+            " (%.1f keys/s)" % (
+                progress.direction, batch_id, progress.keys_seen,
+                progress.pages, rate))
+        if self.metrics is not None:
+            prefix = 'message_store.reconcile.%s_keys' % (progress.direction,)
+            self.metrics[prefix].set(keys)
+            self.metrics[prefix + '_per_second'].set(rate)
 
     @Manager.calls_manager
     def needs_reconciliation(self, batch_id, delta=0.01):
@@ -273,77 +393,197 @@ class MessageStore(object):
         returnValue(False)
 
     @Manager.calls_manager
-    def reconcile_cache(self, batch_id, start_timestamp=None):
+    def reconcile_cache(self, batch_id, start_timestamp=None, resume=False):
         """
         Rebuild the cache for the given batch.
 
+        If ``resume`` is ``True`` and an earlier recon of this batch was
+        interrupted, it carries on from its last checkpoint instead of
+        starting again from scratch.
+
         The ``start_timestamp`` parameter is used for testing only.
         """
-        if start_timestamp is None:
-            start_timestamp = format_vumi_date(datetime.utcnow())
-        yield self.cache.clear_batch(batch_id)
-        yield self.cache.batch_start(batch_id)
-        yield self.reconcile_outbound_cache(batch_id, start_timestamp)
-        yield self.reconcile_inbound_cache(batch_id, start_timestamp)
+        checkpoints = {}
+        if resume:
+            checkpoints = yield self.cache.get_reconciliation_checkpoints(
+                batch_id)
+        if checkpoints:
+            start_timestamp = checkpoints['start_timestamp']
+        else:
+            if start_timestamp is None:
+                start_timestamp = format_vumi_date(datetime.utcnow())
+            yield self.cache.clear_reconciliation_checkpoints(batch_id)
+            yield self.cache.clear_batch(batch_id)
+            yield self.cache.batch_start(batch_id)
+            yield self.cache.set_reconciliation_checkpoint(
+                batch_id, 'start_timestamp', start_timestamp)
+        yield self.reconcile_outbound_cache(
+            batch_id, start_timestamp, checkpoints.get('outbound'))
+        yield self.reconcile_inbound_cache(
+            batch_id, start_timestamp, checkpoints.get('inbound'))
+        yield self.cache.clear_reconciliation_checkpoints(batch_id)
+
+    @Manager.calls_manager
+    def _load_recon_progress(self, batch_id, direction, start_timestamp,
+                             checkpoint):
+        progress = ReconProgress(
+            direction, start_timestamp,
+            self.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT, checkpoint)
+        if checkpoint is not None:
+            start, stop = progress.key_manager.buffer_range()
+            progress.key_manager.cache_keys = (
+                yield self.cache.get_reconciliation_keys(
+                    batch_id, direction, start, stop))
+        returnValue(progress)
+
+    @Manager.calls_manager
+    def _checkpoint_recon(self, batch_id, progress):
+        # The buffered keys are written before the checkpoint and only
+        # truncated after it, so the keys a checkpoint refers to are always
+        # available when resuming from it.
+        keys_d = self.cache.add_reconciliation_keys(
+            batch_id, progress.direction,
+            progress.key_manager.pop_unsaved_keys())
+        state_d = self.cache.set_reconciliation_checkpoint(
+            batch_id, progress.direction, progress.get_state())
+        yield keys_d
+        yield state_d
+        yield self.cache.truncate_reconciliation_keys(
+            batch_id, progress.direction, progress.key_manager.key_count)
+
+    @Manager.calls_manager
+    def _reconcile_inbound_key(self, batch_id, key, timestamp):
+        try:
+            yield self.cache.add_inbound_message_key(
+                batch_id, key, self.cache.get_timestamp(timestamp))
+        except:
+            log.err()
+
+    @Manager.calls_manager
+    def _reconcile_outbound_key(self, batch_id, key, timestamp):
+        try:
+            yield self.cache.add_outbound_message_key(
+                batch_id, key, self.cache.get_timestamp(timestamp))
+            yield self.reconcile_event_cache(batch_id, key)
+        except:
+            log.err()
 
     @Manager.calls_manager
-    def reconcile_inbound_cache(self, batch_id, start_timestamp):
+    def reconcile_inbound_cache(self, batch_id, start_timestamp,
+                                checkpoint=None):
         """
         Rebuild the inbound message cache.
+
+        :param dict checkpoint:
+            Recon state to resume from, if any.
         """
-        key_manager = ReconKeyManager(
-            start_timestamp, self.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT)
-        key_count = 0
+        progress = yield self._load_recon_progress(
+            batch_id, 'inbound', start_timestamp, checkpoint)
+        key_manager = progress.key_manager
 
-        index_page = yield self.batch_inbound_keys_with_addresses(batch_id)
+        if progress.pages == 0 or progress.continuation is not None:
+            index_page = yield self.batch_inbound_keys_with_addresses(
+                batch_id, continuation=progress.continuation)
+        else:
+            index_page = None
         while index_page is not None:
+            # Fetch the next page while we work through this one.
+            next_page_d = index_page.next_page()
+            cache_ds = []
+            keys = 0
             for key, timestamp, addr in index_page:
-                yield self.cache.add_from_addr(batch_id, addr)
-                old_key = key_manager.add_key(key, timestamp)
-                if old_key is not None:
-                    key_count += 1
-            index_page = yield index_page.next_page()
-
-        yield self.cache.add_inbound_message_count(batch_id, key_count)
-        for key, timestamp in key_manager:
-            try:
-                yield self.cache.add_inbound_message_key(
-                    batch_id, key, self.cache.get_timestamp(timestamp))
-            except:
-                log.err()
+                keys += 1
+                cache_ds.append(self.cache.add_from_addr(batch_id, addr))
+                if key_manager.is_new(timestamp):
+                    cache_ds.append(
+                        self._reconcile_inbound_key(batch_id, key, timestamp))
+                elif key_manager.add_key(key, timestamp) is not None:
+                    progress.key_count += 1
+            for cache_d in cache_ds:
+                yield cache_d
+            rate = progress.page_done(index_page, keys)
+            yield self._checkpoint_recon(batch_id, progress)
+            self._report_recon_progress(batch_id, progress, keys, rate)
+            index_page = yield next_page_d
+
+        if not progress.counts_added:
+            yield self.cache.set_reconciled_counts(
+                batch_id, 'inbound', progress.key_count)
+            progress.counts_added = True
+            yield self._checkpoint_recon(batch_id, progress)
+        # We start all the cache updates before waiting for any of them so
+        # that their Redis commands are pipelined together.
+        key_ds = [
+            self._reconcile_inbound_key(batch_id, key, timestamp)
+            for key, timestamp in key_manager]
+        for key_d in key_ds:
+            yield key_d
 
     @Manager.calls_manager
-    def reconcile_outbound_cache(self, batch_id, start_timestamp):
+    def reconcile_outbound_cache(self, batch_id, start_timestamp,
+                                 checkpoint=None):
         """
         Rebuild the outbound message cache.
+
+        :param dict checkpoint:
+            Recon state to resume from, if any.
         """
-        key_manager = ReconKeyManager(
-            start_timestamp, self.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT)
-        key_count = 0
-        status_counts = defaultdict(int)
+        progress = yield self._load_recon_progress(
+            batch_id, 'outbound', start_timestamp, checkpoint)
+        key_manager = progress.key_manager
 
-        index_page = yield self.batch_outbound_keys_with_addresses(batch_id)
+        if progress.pages == 0 or progress.continuation is not None:
+            index_page = yield self.batch_outbound_keys_with_addresses(
+                batch_id, continuation=progress.continuation)
+        else:
+            index_page = None
         while index_page is not None:
+            # Fetch the next page while we work through this one.
+            next_page_d = index_page.next_page()
+            addr_ds = []
+            counts_ds = []
+            event_ds = []
+            keys = 0
             for key, timestamp, addr in index_page:
-                yield self.cache.add_to_addr(batch_id, addr)
+                keys += 1
+                addr_ds.append(self.cache.add_to_addr(batch_id, addr))
+                if key_manager.is_new(timestamp):
+                    event_ds.append(self._reconcile_outbound_key(
+                        batch_id, key, timestamp))
+                    if len(event_ds) >= self.RECONCILE_CONCURRENCY:
+                        yield event_ds.pop(0)
+                    continue
                 old_key = key_manager.add_key(key, timestamp)
                 if old_key is not None:
-                    key_count += 1
-                    sc = yield self.get_event_counts(old_key[0])
-                    for status, count in sc.iteritems():
-                        status_counts[status] += count
-            index_page = yield index_page.next_page()
-
-        yield self.cache.add_outbound_message_count(batch_id, key_count)
-        for status, count in status_counts.iteritems():
-            yield self.cache.add_event_count(batch_id, status, count)
+                    progress.key_count += 1
+                    counts_ds.append(self.get_event_counts(old_key[0]))
+                    if len(counts_ds) >= self.RECONCILE_CONCURRENCY:
+                        progress.add_status_counts((yield counts_ds.pop(0)))
+            for counts_d in counts_ds:
+                progress.add_status_counts((yield counts_d))
+            for event_d in event_ds:
+                yield event_d
+            for addr_d in addr_ds:
+                yield addr_d
+            rate = progress.page_done(index_page, keys)
+            yield self._checkpoint_recon(batch_id, progress)
+            self._report_recon_progress(batch_id, progress, keys, rate)
+            index_page = yield next_page_d
+
+        if not progress.counts_added:
+            yield self.cache.set_reconciled_counts(
+                batch_id, 'outbound', progress.key_count,
+                progress.status_counts)
+            progress.counts_added = True
+            yield self._checkpoint_recon(batch_id, progress)
+        event_ds = []
         for key, timestamp in key_manager:
-            try:
-                yield self.cache.add_outbound_message_key(
-                    batch_id, key, self.cache.get_timestamp(timestamp))
-                yield self.reconcile_event_cache(batch_id, key)
-            except:
-                log.err()
+            event_ds.append(
+                self._reconcile_outbound_key(batch_id, key, timestamp))
+            if len(event_ds) >= self.RECONCILE_CONCURRENCY:
+                yield event_ds.pop(0)
+        for event_d in event_ds:
+            yield event_d
 
     @Manager.calls_manager
     def get_event_counts(self, message_id):
@@ -370,9 +610,15 @@ class MessageStore(object):
         Update the event cache for a particular message.
         """
         event_keys = yield self.message_event_keys(message_id)
-        for event_key in event_keys:
-            event = yield self.get_event(event_key)
-            yield self.cache.add_event(batch_id, event)
+        # We fetch all the events before waiting for any of them so that the
+        # Riak requests are made concurrently.
+        event_ds = [self.get_event(event_key) for event_key in event_keys]
+        cache_ds = []
+        for event_d in event_ds:
+            event = yield event_d
+            cache_ds.append(self.cache.add_event(batch_id, event))
+        for cache_d in cache_ds:
+            yield cache_d
 
     @Manager.calls_manager
     def batch_start(self, tags=(), **metadata):
@@ -403,9 +649,43 @@ class MessageStore(object):
                 yield tag.save()
 
     @Manager.calls_manager
-    def add_outbound_message(self, msg, tag=None, batch_id=None, batch_ids=()):
+    def _insert_record(self, proxy, record, field):
+        """
+        Store a record we expect to be new without loading it first.
+
+        If a record with the same key already exists, ``field`` and our
+        batches are merged into it instead. Returns the stored record.
+        """
+        try:
+            yield record.save(if_none_match=True)
+        except VumiRiakObjectExistsError:
+            existing = yield proxy.load(record.key)
+            if existing is None:
+                # The existing record was deleted before we could load it.
+                existing = record
+            else:
+                setattr(existing, field, getattr(record, field))
+                for batch_id in record.batches.keys():
+                    existing.batches.add_key(batch_id)
+            yield existing.save()
+            record = existing
+        returnValue(record)
+
+    @Manager.calls_manager
+    def add_outbound_message(self, msg, tag=None, batch_id=None, batch_ids=(),
+                             is_new=False):
+        """
+        Store an outbound message and add it to its batches.
+
+        If ``is_new`` is ``True``, the message is expected not to have been
+        stored before and is written without loading the existing record
+        first. If it has been stored before, the stored record's batches are
+        kept.
+        """
         msg_id = msg['message_id']
-        msg_record = yield self.outbound_messages.load(msg_id)
+        msg_record = None
+        if not is_new:
+            msg_record = yield self.outbound_messages.load(msg_id)
         if msg_record is None:
             msg_record = self.outbound_messages(msg_id, msg=msg)
         else:
@@ -424,7 +704,13 @@ class MessageStore(object):
             msg_record.batches.add_key(batch_id)
             yield self.cache.add_outbound_message(batch_id, msg)
 
-        yield msg_record.save()
+        if is_new:
+            msg_record = yield self._insert_record(
+                self.outbound_messages, msg_record, 'msg')
+        else:
+            yield msg_record.save()
+        yield self.cache.set_message_batch_ids(
+            msg_id, msg_record.batches.keys())
 
     @Manager.calls_manager
     def get_outbound_message(self, msg_id):
@@ -432,28 +718,51 @@ class MessageStore(object):
         returnValue(msg.msg if msg is not None else None)
 
     @Manager.calls_manager
-    def add_event(self, event, batch_ids=None):
+    def add_event(self, event, batch_ids=None, is_new=False):
+        """
+        Store an event and add it to its message's batches.
+
+        See :meth:`add_outbound_message` for ``is_new``.
+        """
         event_id = event['event_id']
         msg_id = event['user_message_id']
-        event_record = yield self.events.load(event_id)
+        event_record = None
+        if not is_new:
+            event_record = yield self.events.load(event_id)
         if event_record is None:
             event_record = self.events(event_id, event=event, message=msg_id)
         else:
             event_record.event = event
 
-        # If we aren't given batch_ids, get them from the outbound message.
+        # If we aren't given batch_ids, get them from the cache or failing
+        # that, the outbound message.
         if batch_ids is None:
-            msg_record = yield self.outbound_messages.load(msg_id)
-            if msg_record is not None:
-                batch_ids = msg_record.batches.keys()
-            else:
-                batch_ids = []
+            batch_ids = yield self.get_message_batch_ids(msg_id)
 
         for batch_id in batch_ids:
             event_record.batches.add_key(batch_id)
             yield self.cache.add_event(batch_id, event)
 
-        yield event_record.save()
+        if is_new:
+            yield self._insert_record(self.events, event_record, 'event')
+        else:
+            yield event_record.save()
+
+    @Manager.calls_manager
+    def get_message_batch_ids(self, msg_id):
+        """
+        Return the batch_ids of an outbound message, looking them up in
+        Riak (and remembering them) only if they aren't in the cache.
+        """
+        batch_ids = yield self.cache.get_message_batch_ids(msg_id)
+        if batch_ids is None:
+            msg_record = yield self.outbound_messages.load(msg_id)
+            if msg_record is None:
+                returnValue([])
+            batch_ids = msg_record.batches.keys()
+            yield self.cache.set_message_batch_ids_if_missing(
+                msg_id, batch_ids)
+        returnValue(batch_ids)
 
     @Manager.calls_manager
     def get_event(self, event_id):
@@ -470,9 +779,17 @@ class MessageStore(object):
         returnValue(events)
 
     @Manager.calls_manager
-    def add_inbound_message(self, msg, tag=None, batch_id=None, batch_ids=()):
+    def add_inbound_message(self, msg, tag=None, batch_id=None, batch_ids=(),
+                            is_new=False):
+        """
+        Store an inbound message and add it to its batches.
+
+        See :meth:`add_outbound_message` for ``is_new``.
+        """
         msg_id = msg['message_id']
-        msg_record = yield self.inbound_messages.load(msg_id)
+        msg_record = None
+        if not is_new:
+            msg_record = yield self.inbound_messages.load(msg_id)
         if msg_record is None:
             msg_record = self.inbound_messages(msg_id, msg=msg)
         else:
@@ -491,7 +808,10 @@ class MessageStore(object):
             msg_record.batches.add_key(batch_id)
             yield self.cache.add_inbound_message(batch_id, msg)
 
-        yield msg_record.save()
+        if is_new:
+            yield self._insert_record(self.inbound_messages, msg_record, 'msg')
+        else:
+            yield msg_record.save()
 
     @Manager.calls_manager
     def get_inbound_message(self, msg_id):
@@ -783,7 +1103,8 @@ class MessageStore(object):
 
     @Manager.calls_manager
     def batch_inbound_keys_with_addresses(self, batch_id, max_results=None,
-                                          start=None, end=None):
+                                          start=None, end=None,
+                                          continuation=None):
         """
         Return all inbound message keys with (and ordered by) timestamps and
         addresses.
@@ -800,6 +1121,10 @@ class MessageStore(object):
         :param str end:
             Optional end timestamp string matching VUMI_DATE_FORMAT.
 
+        :param str continuation:
+            Optional continuation token from an earlier page of results to
+            carry on from.
+
         This method performs a Riak index query.
         """
         if max_results is None:
@@ -807,13 +1132,15 @@ class MessageStore(object):
         start_value, end_value = self._start_end_values(batch_id, start, end)
         results = yield self.inbound_messages.index_keys_page(
             'batches_with_addresses', start_value, end_value,
-            return_terms=True, max_results=max_results)
+            return_terms=True, max_results=max_results,
+            continuation=continuation)
         returnValue(IndexPageWrapper(
             key_with_ts_and_value_formatter, self, batch_id, results))
 
     @Manager.calls_manager
     def batch_outbound_keys_with_addresses(self, batch_id, max_results=None,
-                                           start=None, end=None):
+                                           start=None, end=None,
+                                           continuation=None):
         """
         Return all outbound message keys with (and ordered by) timestamps and
         addresses.
@@ -830,6 +1157,10 @@ class MessageStore(object):
         :param str end:
             Optional end timestamp string matching VUMI_DATE_FORMAT.
 
+        :param str continuation:
+            Optional continuation token from an earlier page of results to
+            carry on from.
+
         This method performs a Riak index query.
         """
         if max_results is None:
@@ -837,7 +1168,8 @@ class MessageStore(object):
         start_value, end_value = self._start_end_values(batch_id, start, end)
         results = yield self.outbound_messages.index_keys_page(
             'batches_with_addresses', start_value, end_value,
-            return_terms=True, max_results=max_results)
+            return_terms=True, max_results=max_results,
+            continuation=continuation)
         returnValue(IndexPageWrapper(
             key_with_ts_and_value_formatter, self, batch_id, results))
 
@@ -1087,6 +1419,13 @@ class IndexPageWrapper(object):
         """
         return self._index_page.has_next_page()
 
+    @property
+    def continuation(self):
+        """
+        The continuation token for fetching the next page of results.
+        """
+        return self._index_page.continuation
+
     def __iter__(self):
         return (self._formatter(self._batch_id, r) for r in self._index_page)
 
@@ -34,15 +34,35 @@ class MessageStoreCache(object):
     STATUS_KEY = 'status'
     SEARCH_TOKEN_KEY = 'search_token'
     SEARCH_RESULT_KEY = 'search_result'
+    RECON_CHECKPOINT_KEY = 'recon_checkpoint'
+    RECON_COUNT_KEY = 'recon_count'
+    RECON_KEYS_KEY = 'recon_keys'
+    MESSAGE_BATCHES_KEY = 'message_batches'
     TRUNCATE_MESSAGE_KEY_COUNT_AT = 2000
 
     # Cache search results for 24 hrs
     DEFAULT_SEARCH_RESULT_TTL = 60 * 60 * 24
 
+    # Remember outbound message batches for 72 hrs, by which time we
+    # don't expect many more events for the message.
+    DEFAULT_MESSAGE_BATCHES_TTL = 60 * 60 * 72
+
     def __init__(self, redis):
         # Store redis as `manager` as well since @Manager.calls_manager
         # requires it to be named as such.
         self.redis = self.manager = redis
+        self._pipeline = None
+
+    @property
+    def pipeline(self):
+        """
+        A pipelined view of our Redis manager. Commands issued through this
+        are sent without waiting for earlier replies, and :meth:`flush` on it
+        waits for any that are unanswered.
+        """
+        if self._pipeline is None:
+            self._pipeline = self.redis.pipeline()
+        return self._pipeline
 
     def key(self, *args):
         return ':'.join([unicode(a) for a in args])
@@ -83,6 +103,18 @@ class MessageStoreCache(object):
     def search_result_key(self, batch_id, token):
         return self.batch_key(self.SEARCH_RESULT_KEY, batch_id, token)
 
+    def recon_checkpoint_key(self, batch_id):
+        return self.batch_key(self.RECON_CHECKPOINT_KEY, batch_id)
+
+    def recon_count_key(self, batch_id):
+        return self.batch_key(self.RECON_COUNT_KEY, batch_id)
+
+    def recon_keys_key(self, batch_id, direction):
+        return self.batch_key(self.RECON_KEYS_KEY, batch_id, direction)
+
+    def message_batches_key(self, message_id):
+        return self.key(self.MESSAGE_BATCHES_KEY, message_id)
+
     def uses_counters(self, batch_id):
         """
         Returns ``True`` if ``batch_id`` has moved to the new system
@@ -93,7 +125,7 @@ class MessageStoreCache(object):
         exists. If it is then we've moved to the new system and are
         using counters.
         """
-        return self.redis.exists(self.inbound_count_key(batch_id))
+        return self.pipeline.exists(self.inbound_count_key(batch_id))
 
     def uses_event_counters(self, batch_id):
         """
@@ -104,7 +136,7 @@ class MessageStoreCache(object):
         The test for this is to see if `inbound_count_key(batch_id)` exists. If
         it is then we've moved to the new system and are using counters.
         """
-        return self.redis.exists(self.event_count_key(batch_id))
+        return self.pipeline.exists(self.event_count_key(batch_id))
 
     @Manager.calls_manager
     def switch_to_counters(self, batch_id):
@@ -138,11 +170,11 @@ class MessageStoreCache(object):
         truncate_at = (truncate_at or self.TRUNCATE_MESSAGE_KEY_COUNT_AT) + 1
         # NOTE: Doing this because ZCARD is O(1) where ZREMRANGEBYRANK is
         #       O(log(N)+M)
-        current_size = yield self.redis.zcard(redis_key)
+        current_size = yield self.pipeline.zcard(redis_key)
         if current_size <= truncate_at:
             returnValue(0)
 
-        keys_removed = yield self.redis.zremrangebyrank(
+        keys_removed = yield self.pipeline.zremrangebyrank(
             redis_key, 0, truncate_at * -1)
         returnValue(keys_removed)
 
@@ -221,10 +253,127 @@ class MessageStoreCache(object):
         yield self.redis.delete(self.event_key(batch_id))
         yield self.redis.delete(self.event_count_key(batch_id))
         yield self.redis.delete(self.status_key(batch_id))
+        yield self.redis.delete(self.recon_count_key(batch_id))
         yield self.redis.delete(self.to_addr_key(batch_id))
         yield self.redis.delete(self.from_addr_key(batch_id))
         yield self.redis.srem(self.batch_key(), batch_id)
 
+    @Manager.calls_manager
+    def get_reconciliation_checkpoints(self, batch_id):
+        """
+        Return a dict of the checkpoints saved during an interrupted
+        reconciliation of the given batch_id. The dict is empty if there
+        is nothing to resume.
+        """
+        checkpoints = yield self.redis.hgetall(
+            self.recon_checkpoint_key(batch_id))
+        returnValue(dict(
+            (name, json.loads(state))
+            for name, state in checkpoints.iteritems()))
+
+    def set_reconciliation_checkpoint(self, batch_id, name, state):
+        """
+        Save a checkpoint for the reconciliation of the given batch_id.
+        ``state`` must be serialisable to JSON.
+        """
+        return self.redis.hset(
+            self.recon_checkpoint_key(batch_id), name, json.dumps(state))
+
+    @Manager.calls_manager
+    def clear_reconciliation_checkpoints(self, batch_id):
+        """
+        Remove all reconciliation checkpoints and buffered reconciliation
+        keys for the given batch_id.
+        """
+        checkpoint_d = self.pipeline.delete(
+            self.recon_checkpoint_key(batch_id))
+        key_ds = [
+            self.pipeline.delete(self.recon_keys_key(batch_id, direction))
+            for direction in ['inbound', 'outbound']]
+        yield checkpoint_d
+        for key_d in key_ds:
+            yield key_d
+
+    @Manager.calls_manager
+    def add_reconciliation_keys(self, batch_id, direction, keys):
+        """
+        Buffer message keys for the reconciliation of the given batch_id.
+        ``keys`` is a list of ``(position, key, timestamp)`` tuples, where
+        ``position`` is the order in which the key was seen.
+        """
+        # The commands are pipelined, so we issue them all before waiting.
+        zadd_ds = [
+            self.pipeline.zadd(self.recon_keys_key(batch_id, direction), **{
+                json.dumps([key, timestamp]): position,
+            }) for position, key, timestamp in keys]
+        for zadd_d in zadd_ds:
+            yield zadd_d
+
+    @Manager.calls_manager
+    def get_reconciliation_keys(self, batch_id, direction, start, stop):
+        """
+        Return the ``(key, timestamp)`` pairs buffered for the reconciliation
+        of the given batch_id at positions from ``start`` up to but not
+        including ``stop``, in the order they were seen.
+        """
+        if stop <= start:
+            returnValue([])
+        keys = yield self.redis.zrangebyscore(
+            self.recon_keys_key(batch_id, direction), start, stop - 1)
+        returnValue([tuple(json.loads(key)) for key in keys])
+
+    def truncate_reconciliation_keys(self, batch_id, direction, truncate_at):
+        """
+        Keep only the ``truncate_at`` most recently seen keys buffered for the
+        reconciliation of the given batch_id.
+        """
+        return self.pipeline.zremrangebyrank(
+            self.recon_keys_key(batch_id, direction), 0, -(truncate_at + 1))
+
+    def set_message_batch_ids(self, message_id, batch_ids, ttl=None):
+        """
+        Remember the batch_ids of an outbound message so that events for it
+        can be stored without looking the message up in Riak.
+
+        :param int ttl:
+            How long to remember the batch_ids for.
+            Defaults to DEFAULT_MESSAGE_BATCHES_TTL.
+        """
+        ttl = ttl or self.DEFAULT_MESSAGE_BATCHES_TTL
+        return self.pipeline.setex(
+            self.message_batches_key(message_id), ttl,
+            json.dumps(sorted(batch_ids)))
+
+    @Manager.calls_manager
+    def set_message_batch_ids_if_missing(self, message_id, batch_ids,
+                                         ttl=None):
+        """
+        Like :meth:`set_message_batch_ids`, but leave any batch_ids we're
+        already remembering alone. Use this when filling the cache from an
+        older copy of the message, so we don't replace a fresher entry
+        written since we read it.
+
+        Returns ``True`` if the batch_ids were set.
+        """
+        ttl = ttl or self.DEFAULT_MESSAGE_BATCHES_TTL
+        key = self.message_batches_key(message_id)
+        was_set = yield self.pipeline.setnx(key, json.dumps(sorted(batch_ids)))
+        if was_set:
+            yield self.pipeline.expire(key, ttl)
+        returnValue(bool(was_set))
+
+    @Manager.calls_manager
+    def get_message_batch_ids(self, message_id):
+        """
+        Return the remembered batch_ids of an outbound message, or ``None``
+        if we don't have them.
+        """
+        batch_ids = yield self.pipeline.get(
+            self.message_batches_key(message_id))
+        if batch_ids is None:
+            returnValue(None)
+        returnValue(json.loads(batch_ids))
+
     def get_timestamp(self, timestamp):
         """
         Return a timestamp value for a datetime value.
@@ -239,25 +388,29 @@ class MessageStoreCache(object):
         Add an outbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
+        to_addr_d = self.add_to_addr(batch_id, msg['to_addr'])
         yield self.add_outbound_message_key(
             batch_id, msg['message_id'], timestamp)
-        yield self.add_to_addr(batch_id, msg['to_addr'])
+        yield to_addr_d
 
     @Manager.calls_manager
     def add_outbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id.
         """
-        new_entry = yield self.redis.zadd(self.outbound_key(batch_id), **{
+        new_entry_d = self.pipeline.zadd(self.outbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
         })
+        uses_counters_d = self.uses_counters(batch_id)
+        new_entry = yield new_entry_d
+        uses_counters = yield uses_counters_d
         if new_entry:
-            yield self.increment_event_status(batch_id, 'sent')
-
-            uses_counters = yield self.uses_counters(batch_id)
+            status_d = self.increment_event_status(batch_id, 'sent')
             if uses_counters:
-                yield self.redis.incr(self.outbound_count_key(batch_id))
+                incr_d = self.pipeline.incr(self.outbound_count_key(batch_id))
                 yield self.truncate_outbound_message_keys(batch_id)
+                yield incr_d
+            yield status_d
 
     @Manager.calls_manager
     def add_outbound_message_count(self, batch_id, count):
@@ -275,6 +428,32 @@ class MessageStoreCache(object):
         yield self.increment_event_status(batch_id, status, count)
         yield self.redis.incr(self.event_count_key(batch_id), count)
 
+    def set_reconciled_counts(self, batch_id, direction, count,
+                              status_counts=None):
+        """
+        Record the number of messages (and for outbound messages, events)
+        counted by a reconciliation rather than added individually. (Used
+        for recon.)
+
+        These are kept apart from the counters that are incremented as
+        messages arrive and added to them when they are read. Because they
+        are set rather than incremented, recording them again after an
+        interrupted reconciliation doesn't count anything twice.
+        """
+        fields = {direction: count}
+        if direction == 'outbound':
+            status_counts = status_counts or {}
+            fields['status:sent'] = count
+            fields['event'] = sum(status_counts.itervalues())
+            for status, status_count in status_counts.iteritems():
+                fields['status:%s' % (status,)] = status_count
+        return self.pipeline.hmset(self.recon_count_key(batch_id), fields)
+
+    @Manager.calls_manager
+    def get_reconciled_count(self, batch_id, field):
+        count = yield self.pipeline.hget(self.recon_count_key(batch_id), field)
+        returnValue(0 if count is None else int(count))
+
     @Manager.calls_manager
     def add_event(self, batch_id, event):
         """
@@ -285,10 +464,11 @@ class MessageStoreCache(object):
         new_entry = yield self.add_event_key(batch_id, event_id, timestamp)
         if new_entry:
             event_type = event['event_type']
-            yield self.increment_event_status(batch_id, event_type)
+            status_d = self.increment_event_status(batch_id, event_type)
             if event_type == 'delivery_report':
                 yield self.increment_event_status(
                     batch_id, '%s.%s' % (event_type, event['delivery_status']))
+            yield status_d
 
     @Manager.calls_manager
     def add_event_key(self, batch_id, event_key, timestamp):
@@ -298,12 +478,13 @@ class MessageStoreCache(object):
         """
         uses_event_counters = yield self.uses_event_counters(batch_id)
         if uses_event_counters:
-            new_entry = yield self.redis.zadd(self.event_key(batch_id), **{
+            new_entry = yield self.pipeline.zadd(self.event_key(batch_id), **{
                 event_key.encode('utf-8'): timestamp,
             })
             if new_entry:
-                yield self.redis.incr(self.event_count_key(batch_id))
+                incr_d = self.pipeline.incr(self.event_count_key(batch_id))
                 yield self.truncate_event_keys(batch_id)
+                yield incr_d
             returnValue(new_entry)
         else:
             # HACK: Disabling this because of unbounded growth.
@@ -320,7 +501,8 @@ class MessageStoreCache(object):
         """
         Increment the status for the given event_type for the given batch_id.
         """
-        return self.redis.hincrby(self.status_key(batch_id), event_type, count)
+        return self.pipeline.hincrby(
+            self.status_key(batch_id), event_type, count)
 
     @Manager.calls_manager
     def get_event_status(self, batch_id):
@@ -328,8 +510,14 @@ class MessageStoreCache(object):
         Return a dictionary containing the latest event stats for the given
         batch_id.
         """
-        stats = yield self.redis.hgetall(self.status_key(batch_id))
-        returnValue(dict([(k, int(v)) for k, v in stats.iteritems()]))
+        stats_d = self.pipeline.hgetall(self.status_key(batch_id))
+        recon_counts_d = self.pipeline.hgetall(self.recon_count_key(batch_id))
+        stats = dict([(k, int(v)) for k, v in (yield stats_d).iteritems()])
+        for field, count in (yield recon_counts_d).iteritems():
+            if field.startswith('status:'):
+                status = field[len('status:'):]
+                stats[status] = stats.get(status, 0) + int(count)
+        returnValue(stats)
 
     @Manager.calls_manager
     def add_inbound_message(self, batch_id, msg):
@@ -337,24 +525,26 @@ class MessageStoreCache(object):
         Add an inbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
+        from_addr_d = self.add_from_addr(batch_id, msg['from_addr'])
         yield self.add_inbound_message_key(
             batch_id, msg['message_id'], timestamp)
-        yield self.add_from_addr(batch_id, msg['from_addr'])
+        yield from_addr_d
 
     @Manager.calls_manager
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id
         """
-        new_entry = yield self.redis.zadd(self.inbound_key(batch_id), **{
+        new_entry_d = self.pipeline.zadd(self.inbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
         })
-
-        if new_entry:
-            uses_counters = yield self.uses_counters(batch_id)
-            if uses_counters:
-                yield self.redis.incr(self.inbound_count_key(batch_id))
-                yield self.truncate_inbound_message_keys(batch_id)
+        uses_counters_d = self.uses_counters(batch_id)
+        new_entry = yield new_entry_d
+        uses_counters = yield uses_counters_d
+        if new_entry and uses_counters:
+            incr_d = self.pipeline.incr(self.inbound_count_key(batch_id))
+            yield self.truncate_inbound_message_keys(batch_id)
+            yield incr_d
 
     @Manager.calls_manager
     def add_inbound_message_count(self, batch_id, count):
@@ -369,7 +559,7 @@ class MessageStoreCache(object):
         functionality. Generally this information is set when
         `add_inbound_message()` is called.
         """
-        return self.redis.pfadd(
+        return self.pipeline.pfadd(
             self.from_addr_key(batch_id), from_addr.encode('utf-8'))
 
     def get_from_addrs(self, batch_id, asc=False):
@@ -398,7 +588,7 @@ class MessageStoreCache(object):
         functionality. Generally this information is set when
         `add_outbound_message()` is called.
         """
-        return self.redis.pfadd(
+        return self.pipeline.pfadd(
             self.to_addr_key(batch_id), to_addr.encode('utf-8'))
 
     def get_to_addrs(self, batch_id, asc=False):
@@ -433,8 +623,10 @@ class MessageStoreCache(object):
 
     @Manager.calls_manager
     def inbound_message_count(self, batch_id):
-        count = yield self.redis.get(self.inbound_count_key(batch_id))
-        returnValue(0 if count is None else int(count))
+        count_d = self.pipeline.get(self.inbound_count_key(batch_id))
+        reconciled = yield self.get_reconciled_count(batch_id, 'inbound')
+        count = yield count_d
+        returnValue(reconciled + (0 if count is None else int(count)))
 
     def inbound_message_keys_size(self, batch_id):
         return self.redis.zcard(self.inbound_key(batch_id))
@@ -461,8 +653,10 @@ class MessageStoreCache(object):
 
     @Manager.calls_manager
     def outbound_message_count(self, batch_id):
-        count = yield self.redis.get(self.outbound_count_key(batch_id))
-        returnValue(0 if count is None else int(count))
+        count_d = self.pipeline.get(self.outbound_count_key(batch_id))
+        reconciled = yield self.get_reconciled_count(batch_id, 'outbound')
+        count = yield count_d
+        returnValue(reconciled + (0 if count is None else int(count)))
 
     def outbound_message_keys_size(self, batch_id):
         return self.redis.zcard(self.outbound_key(batch_id))
@@ -480,8 +674,10 @@ class MessageStoreCache(object):
 
     @Manager.calls_manager
     def event_count(self, batch_id):
-        count = yield self.redis.get(self.event_count_key(batch_id))
-        returnValue(0 if count is None else int(count))
+        count_d = self.pipeline.get(self.event_count_key(batch_id))
+        reconciled = yield self.get_reconciled_count(batch_id, 'event')
+        count = yield count_d
+        returnValue(reconciled + (0 if count is None else int(count)))
 
     @Manager.calls_manager
     def count_event_keys(self, batch_id):
@@ -598,17 +794,24 @@ class MessageStoreCache(object):
             raise MessageStoreCacheException('Invalid direction')
 
         # populate the results set weighted according to the timestamps
-        # that are already known in the cache.
-        for key in keys:
-            timestamp = yield self.redis.zscore(score_set_key, key)
-            yield self.redis.zadd(result_key, **{
+        # that are already known in the cache. All the lookups are sent
+        # before we wait for any of them, and likewise for the writes.
+        score_ds = [(key, self.pipeline.zscore(score_set_key, key))
+                    for key in keys]
+        write_ds = []
+        for key, score_d in score_ds:
+            timestamp = yield score_d
+            write_ds.append(self.pipeline.zadd(result_key, **{
                 key.encode('utf-8'): timestamp,
-            })
+            }))
 
         # Auto expire after TTL
-        yield self.redis.expire(result_key, ttl)
+        write_ds.append(self.pipeline.expire(result_key, ttl))
         # Remove from the list of in progress search operations.
-        yield self.redis.srem(self.search_token_key(batch_id), token)
+        write_ds.append(
+            self.pipeline.srem(self.search_token_key(batch_id), token))
+        for write_d in write_ds:
+            yield write_d
 
     def is_query_in_progress(self, batch_id, token):
         """
@@ -0,0 +1,231 @@
+# -*- test-case-name: vumi.components.tests.test_message_store_writer -*-
+
+"""Write-behind buffering for the message store."""
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, DeferredList, inlineCallbacks, maybeDeferred, succeed)
+
+from vumi import log
+from vumi.blinkenlights.metrics import Metric, AVG, LAST, MAX
+
+
+class MessageStoreWriter(object):
+    """
+    Buffers messages and events and writes them to a
+    :class:`vumi.components.message_store.MessageStore` in the background.
+
+    Writes are queued in memory and taken off the queue in batches of up to
+    ``batch_size``. A batch is written as soon as the queue holds a full one
+    or its oldest write has waited ``max_latency`` seconds. At most
+    ``concurrency`` batches are written at once.
+
+    When the queue holds ``max_size`` writes, further writes wait for space
+    and ``pause_callback`` is called. ``unpause_callback`` is called once
+    the queue has drained to half that size.
+
+    An event is only written once any write of the outbound message it
+    refers to that was queued before it has finished, so the store can find
+    the message's batches.
+
+    Writes queued with ``is_new=True`` are passed on to the store, which
+    then skips loading the existing record (see
+    :meth:`vumi.components.message_store.MessageStore.add_outbound_message`).
+
+    If a :class:`vumi.blinkenlights.metrics.MetricManager` is provided as
+    ``metrics``, the queue depth and the time writes spend waiting to be
+    stored are reported through it.
+
+    :param MessageStore store:
+        The message store to write to.
+    :param int max_size:
+        Maximum number of writes to queue.
+    :param int batch_size:
+        Maximum number of writes in a batch.
+    :param int concurrency:
+        Maximum number of batches to write at once.
+    :param float max_latency:
+        Maximum number of seconds to wait for a full batch.
+    """
+
+    clock = reactor
+
+    def __init__(self, store, max_size=1000, batch_size=50, concurrency=4,
+                 max_latency=0.5, metrics=None, pause_callback=None,
+                 unpause_callback=None):
+        self.store = store
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_latency = max_latency
+        self.metrics = metrics
+        self.pause_callback = pause_callback
+        self.unpause_callback = unpause_callback
+        self.paused = False
+        # Items are (queued_at, write function, args).
+        self._queue = deque()
+        self._space_waiters = deque()
+        self._flush_waiters = []
+        self._flushing = False
+        self._active = 0
+        self._timer = None
+        # message_id -> deferred that fires when that outbound message has
+        # been written.
+        self._outbound_writes = {}
+        if metrics is not None:
+            metrics.register(Metric(
+                'message_store_writer.queue_depth', [LAST, MAX]))
+            metrics.register(Metric(
+                'message_store_writer.flush_latency', [AVG, MAX]))
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add_inbound_message(self, msg, tag=None, is_new=False):
+        return self._enqueue(
+            self._write_inbound, msg.copy(), tag, is_new)
+
+    def add_outbound_message(self, msg, tag=None, is_new=False):
+        return self._enqueue(self._write_outbound, msg.copy(), tag, is_new)
+
+    def add_event(self, event, is_new=False):
+        return self._enqueue(self._write_event, event.copy(), is_new)
+
+    def flush(self):
+        """
+        Write everything that is queued without waiting for full batches.
+
+        Returns a deferred that fires once the queue is empty and all
+        writes have finished.
+        """
+        if not self._queue and not self._active:
+            return succeed(None)
+        d = Deferred()
+        self._flush_waiters.append(d)
+        self._flushing = True
+        self._start_writers()
+        return d
+
+    def stop(self):
+        """
+        Write everything that is queued and stop the latency timer.
+        """
+        d = self.flush()
+        d.addCallback(lambda _: self._cancel_timer())
+        return d
+
+    def _enqueue(self, func, *args):
+        if len(self._queue) >= self.max_size or self._space_waiters:
+            d = Deferred()
+            self._space_waiters.append((d, func, args))
+            return d
+        self._push(func, args)
+        self._start_writers()
+        self._arm_timer()
+        return succeed(None)
+
+    def _push(self, func, args):
+        self._queue.append((self.clock.seconds(), func, args))
+        if len(self._queue) >= self.max_size and not self.paused:
+            self.paused = True
+            if self.pause_callback is not None:
+                self.pause_callback()
+
+    def _batch_due(self):
+        if not self._queue:
+            return False
+        if self._flushing or len(self._queue) >= self.batch_size:
+            return True
+        queued_at = self._queue[0][0]
+        return self.clock.seconds() >= queued_at + self.max_latency
+
+    def _start_writers(self):
+        while self._active < self.concurrency and self._batch_due():
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            self._active += 1
+            d = self._write_batch(batch)
+            d.addCallback(self._batch_written)
+            self._release_space()
+
+    def _release_space(self):
+        while self._space_waiters and len(self._queue) < self.max_size:
+            d, func, args = self._space_waiters.popleft()
+            self._push(func, args)
+            d.callback(None)
+        if self.paused and len(self._queue) <= self.max_size // 2:
+            self.paused = False
+            if self.unpause_callback is not None:
+                self.unpause_callback()
+
+    def _batch_written(self, _):
+        self._active -= 1
+        self._start_writers()
+        self._arm_timer()
+        if not self._queue and not self._active:
+            self._flushing = False
+            waiters, self._flush_waiters = self._flush_waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def _arm_timer(self):
+        if self._timer is not None or not self._queue:
+            return
+        queued_at = self._queue[0][0]
+        delay = max(0, queued_at + self.max_latency - self.clock.seconds())
+        self._timer = self.clock.callLater(delay, self._timer_fired)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _timer_fired(self):
+        self._timer = None
+        self._start_writers()
+        self._arm_timer()
+
+    @inlineCallbacks
+    def _write_batch(self, batch):
+        if self.metrics is not None:
+            self.metrics['message_store_writer.queue_depth'].set(
+                len(self._queue))
+        results = yield DeferredList([
+            maybeDeferred(func, *args) for _, func, args in batch],
+            consumeErrors=True)
+        for success, result in results:
+            if not success:
+                log.err(result, "Error writing to message store")
+        if self.metrics is not None:
+            self.metrics['message_store_writer.flush_latency'].set(
+                self.clock.seconds() - batch[0][0])
+
+    def _write_inbound(self, msg, tag, is_new):
+        return self.store.add_inbound_message(msg, tag=tag, is_new=is_new)
+
+    def _write_outbound(self, msg, tag, is_new):
+        msg_id = msg['message_id']
+        d = maybeDeferred(
+            self.store.add_outbound_message, msg, tag=tag, is_new=is_new)
+        done = Deferred()
+        self._outbound_writes[msg_id] = done
+
+        def written(result):
+            if self._outbound_writes.get(msg_id) is done:
+                del self._outbound_writes[msg_id]
+            done.callback(None)
+            return result
+
+        return d.addBoth(written)
+
+    def _write_event(self, event, is_new):
+        msg_written = self._outbound_writes.get(event['user_message_id'])
+        if msg_written is None:
+            return self.store.add_event(event, is_new=is_new)
+        d = Deferred()
+        msg_written.addCallback(lambda _: d.callback(None))
+        return d.addCallback(
+            lambda _: self.store.add_event(event, is_new=is_new))
@@ -0,0 +1,186 @@
+# -*- test-case-name: vumi.components.tests.test_scheduler -*-
+
+import json
+from datetime import datetime
+from uuid import uuid4
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+
+from vumi import message, log
+
+
+class SortedSetScheduler(object):
+    """
+    Publishes stuff to a given queue at a given time, keeping everything
+    scheduled in a single Redis sorted set scored by the time it is due.
+
+    Each member of the sorted set holds the scheduled payload itself, so a
+    batch of due items is claimed with one ``ZRANGEBYSCORE`` and one
+    ``ZREM`` however large it is. The claim is made in a transaction that
+    watches the sorted set, so several schedulers can share a prefix
+    without delivering an item more than once. Instead of polling, a timer
+    is armed for the next due time. The timer is never armed for more than
+    ``max_delay`` seconds, so that items scheduled by other processes are
+    picked up.
+
+    If the callback fails for an item, the error is logged and the item is
+    scheduled again ``retry_delay`` seconds later.
+
+    :param redis:
+        Synchronous Redis client.
+    :param callback:
+        Called with the time an item was scheduled at and its payload when
+        it is due. May return a deferred.
+    :param str prefix:
+        Prefix for the scheduler's Redis key.
+    :param int batch_size:
+        Maximum number of due items to claim at a time.
+    :param float max_delay:
+        Maximum number of seconds to wait before checking for due items.
+    :param float retry_delay:
+        Number of seconds to wait before delivering an item again if the
+        callback fails.
+    """
+
+    clock = reactor
+
+    def __init__(self, redis, callback, prefix='scheduler', batch_size=100,
+                 max_delay=60, retry_delay=60, json_encoder=None,
+                 json_decoder=None):
+        self.r_server = redis
+        self.r_prefix = prefix
+        self.callback = callback
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self.json_encoder = json_encoder or message.JSONMessageEncoder
+        self.json_decoder = json_decoder or message.date_time_decoder
+        self._due_key = "#".join((self.r_prefix, "due"))
+        self._running = False
+        self._timer = None
+
+    @property
+    def is_running(self):
+        return self._running
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self._deliver()
+
+    def stop(self):
+        self._running = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _deliver(self):
+        self._timer = None
+        d = self.deliver_scheduled()
+        d.addErrback(lambda f: log.err(f, "Error delivering scheduled items"))
+        d.addCallback(lambda _: self._arm_timer())
+        return d
+
+    def _arm_timer(self):
+        if not self._running:
+            return
+        delay = self.max_delay
+        next_due = self.get_next_due_time()
+        if next_due is not None:
+            delay = max(0, min(delay, next_due - self.clock.seconds()))
+        self._timer = self.clock.callLater(delay, self._deliver)
+
+    def get_next_due_time(self):
+        """
+        Return the time the next scheduled item is due, or ``None`` if
+        nothing is scheduled.
+        """
+        first = self.r_server.zrange(self._due_key, 0, 0, withscores=True)
+        if not first:
+            return None
+        [(_, due)] = first
+        return due
+
+    def schedule(self, delta, payload, now=None):
+        """
+        Store the payload in Redis and call `self.callback` after
+        `delta` seconds as counted from `now` onwards.
+
+        :param delta: the amount of seconds
+        :param payload: the payload send to `self.callback`
+        :param now: Used to calculate the delta (timestamp in
+                    seconds since epoch)
+
+        If ``now`` is ``None`` then it will default to the current time.
+
+        Returns a key that can be passed to :meth:`cancel`.
+        """
+        if now is None:
+            now = self.clock.seconds()
+        due = now + delta
+        key = json.dumps([
+            uuid4().get_hex(),
+            datetime.utcnow().isoformat(),
+            payload,
+        ], cls=self.json_encoder)
+        self.r_server.zadd(self._due_key, **{key: due})
+        # Deliver sooner if this is due before anything we're waiting for.
+        if self._timer is not None and due < self._timer.getTime():
+            self._timer.reset(max(0, due - self.clock.seconds()))
+        return key
+
+    def cancel(self, key):
+        """
+        Cancel a scheduled item. Returns ``True`` if it hadn't been
+        delivered yet.
+        """
+        return bool(self.r_server.zrem(self._due_key, key))
+
+    def count_scheduled(self):
+        return self.r_server.zcard(self._due_key)
+
+    def claim_due(self, now):
+        """
+        Remove up to ``batch_size`` items due by ``now`` and return them as
+        a list of ``(key, scheduled_at, payload)`` tuples.
+        """
+        def claim(pipe):
+            keys = pipe.zrangebyscore(
+                self._due_key, '-inf', now, start=0, num=self.batch_size)
+            pipe.multi()
+            if keys:
+                pipe.zrem(self._due_key, *keys)
+            return keys
+
+        # If the sorted set changes before the ZREM runs, the transaction is
+        # retried, so no other scheduler can claim the same items.
+        keys = self.r_server.transaction(
+            claim, self._due_key, value_from_callable=True)
+        items = []
+        for key in keys:
+            _, scheduled_at, payload = json.loads(
+                key, object_hook=self.json_decoder)
+            items.append((key, scheduled_at, payload))
+        return items
+
+    @inlineCallbacks
+    def deliver_scheduled(self, now=None):
+        """
+        Deliver everything due by ``now``, which defaults to the current
+        time.
+        """
+        if now is None:
+            now = self.clock.seconds()
+        while True:
+            items = self.claim_due(now)
+            for key, scheduled_at, payload in items:
+                try:
+                    yield self.callback(scheduled_at, payload)
+                except Exception:
+                    log.err(None, "Error delivering scheduled item, retrying"
+                            " in %s seconds" % (self.retry_delay,))
+                    self.r_server.zadd(self._due_key, **{
+                        key: self.clock.seconds() + self.retry_delay})
+            if len(items) < self.batch_size:
+                return
@@ -23,11 +23,14 @@ class SessionManager(object):
     def __init__(self, redis, max_session_length=None, gc_period=None):
         self.max_session_length = max_session_length
         self.redis = redis
+        self._pipeline = None
         if gc_period is not None:
             log.warning("SessionManager 'gc_period' parameter is deprecated.")
 
     @inlineCallbacks
     def stop(self, stop_redis=True):
+        if self._pipeline is not None:
+            yield self._pipeline.flush()
         if stop_redis:
             yield self.redis._close()
 
@@ -42,6 +45,36 @@ class SessionManager(object):
             d.addCallback(lambda m: m.sub_manager(key_prefix))
         return d.addCallback(lambda m: cls(m, max_session_length, gc_period))
 
+    @property
+    def pipeline(self):
+        """
+        A pipelined view of our Redis manager. Commands issued through this
+        are sent without waiting for earlier replies, and :meth:`flush` on it
+        waits for any that are unanswered.
+        """
+        if self._pipeline is None:
+            self._pipeline = self.redis.pipeline()
+        return self._pipeline
+
+    def session_key(self, user_id):
+        return "%s:%s" % ('session', user_id)
+
+    def _encode(self, value):
+        # Redis stores everything as bytestrings. txredis and redis-py encode
+        # floats differently (with str() and repr() respectively), so we
+        # encode values ourselves before saving them.
+        if isinstance(value, str):
+            return value
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, float):
+            return repr(value)
+        return str(value)
+
+    def _encode_session(self, session):
+        return dict((self._encode(k), self._encode(v))
+                    for k, v in session.iteritems())
+
     @inlineCallbacks
     def active_sessions(self):
         """Return a list of active user_ids and associated sessions.
@@ -51,18 +84,35 @@ class SessionManager(object):
         quick even for millions of keys. Try not to hit this too often, though.
         """
         keys = yield self.redis.keys('session:*')
-        sessions = []
-        for user_id in [key.split(':', 1)[1] for key in keys]:
-            sessions.append((user_id, (yield self.load_session(user_id))))
-
-        returnValue(sessions)
+        user_ids = [key.split(':', 1)[1] for key in keys]
+        sessions = yield self.load_sessions(user_ids)
+        returnValue([(user_id, sessions[user_id]) for user_id in user_ids])
 
     def load_session(self, user_id):
         """
         Load session data from Redis
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.hgetall(ukey)
+        return self.pipeline.hgetall(self.session_key(user_id))
+
+    @inlineCallbacks
+    def load_sessions(self, user_ids):
+        """
+        Load several sessions from Redis in a single round trip.
+
+        Parameters
+        ----------
+        user_ids : list
+            The ids of the users whose sessions should be loaded.
+
+        Returns a dictionary mapping each user id to its session. Users
+        without a session are mapped to an empty dictionary.
+        """
+        session_ds = [(user_id, self.load_session(user_id))
+                      for user_id in user_ids]
+        sessions = {}
+        for user_id, session_d in session_ds:
+            sessions[user_id] = yield session_d
+        returnValue(sessions)
 
     def schedule_session_expiry(self, user_id, timeout):
         """
@@ -75,28 +125,35 @@ class SessionManager(object):
         timeout : int
             The number of seconds after which this session should expire
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.expire(ukey, timeout)
+        return self.pipeline.expire(self.session_key(user_id), timeout)
 
     @inlineCallbacks
     def create_session(self, user_id, **kwargs):
         """
         Create a new session using the given user_id
+
+        The existing session is cleared and the new one written and given
+        its expiry in a single round trip. The session is returned as Redis
+        would return it, without loading it again.
         """
-        yield self.clear_session(user_id)
         defaults = {
             'created_at': time.time()
         }
         defaults.update(kwargs)
-        yield self.save_session(user_id, defaults)
+        session = self._encode_session(defaults)
+        clear_d = self.clear_session(user_id)
+        save_d = self.save_session(user_id, session)
+        expiry_d = None
         if self.max_session_length:
-            yield self.schedule_session_expiry(user_id,
-                                               int(self.max_session_length))
-        returnValue((yield self.load_session(user_id)))
+            expiry_d = self.schedule_session_expiry(
+                user_id, int(self.max_session_length))
+        yield clear_d
+        yield save_d
+        yield expiry_d
+        returnValue(session)
 
     def clear_session(self, user_id):
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.delete(ukey)
+        return self.pipeline.delete(self.session_key(user_id))
 
     @inlineCallbacks
     def save_session(self, user_id, session):
@@ -112,7 +169,24 @@ class SessionManager(object):
             values that are dictionaries are converted to strings by Redis.
 
         """
-        ukey = "%s:%s" % ('session', user_id)
-        for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
+        if session:
+            yield self.pipeline.hmset(self.session_key(user_id), session)
         returnValue(session)
+
+    @inlineCallbacks
+    def save_sessions(self, sessions):
+        """
+        Save several sessions in a single round trip.
+
+        Parameters
+        ----------
+        sessions : dict
+            A dictionary mapping user ids to session info, as passed to
+            :meth:`save_session`.
+
+        """
+        save_ds = [self.save_session(user_id, session)
+                   for user_id, session in sessions.iteritems()]
+        for save_d in save_ds:
+            yield save_d
+        returnValue(sessions)
@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.message import TransportEvent, format_vumi_date
 from vumi.tests.helpers import (
     VumiTestCase, MessageHelper, PersistenceHelper, import_skip)
@@ -191,6 +192,34 @@ class TestMessageStore(TestMessageStoreBase):
         self.assertEqual(new_stored_msg, msg)
         self.assertNotEqual(old_stored_msg, new_stored_msg)
 
+    @inlineCallbacks
+    def test_add_outbound_message_is_new(self):
+        batch_id = yield self.store.batch_start()
+        msg = self.msg_helper.make_outbound('outbound foo')
+        msg_id = msg['message_id']
+        yield self.store.add_outbound_message(
+            msg, batch_id=batch_id, is_new=True)
+
+        stored_msg = yield self.store.get_outbound_message(msg_id)
+        outbound_keys = yield self.store.batch_outbound_keys(batch_id)
+        self.assertEqual(stored_msg, msg)
+        self.assertEqual(outbound_keys, [msg_id])
+
+    @inlineCallbacks
+    def test_add_outbound_message_is_new_duplicate(self):
+        msg_id, msg, batch_id_1 = yield self._create_outbound()
+        batch_id_2 = yield self.store.batch_start()
+        msg['helper_metadata']['foo'] = {'bar': 'baz'}
+        yield self.store.add_outbound_message(
+            msg, batch_id=batch_id_2, is_new=True)
+
+        stored_msg = yield self.store.get_outbound_message(msg_id)
+        self.assertEqual(stored_msg, msg)
+        self.assertEqual(
+            (yield self.store.batch_outbound_keys(batch_id_1)), [msg_id])
+        self.assertEqual(
+            (yield self.store.batch_outbound_keys(batch_id_2)), [msg_id])
+
     @inlineCallbacks
     def test_add_outbound_message_with_batch_id(self):
         msg_id, msg, batch_id = yield self._create_outbound(by_batch=True)
@@ -300,6 +329,36 @@ class TestMessageStore(TestMessageStoreBase):
             "%s$%s$ack" % (batch_id, to_reverse_timestamp(timestamp)),
         ]))
 
+    @inlineCallbacks
+    def test_add_ack_event_batch_ids_from_cache(self):
+        """
+        The batch ids of an outbound message are cached when it is stored,
+        so we don't need to load the message from Riak to store an event.
+        """
+        msg_id, msg, batch_id = yield self._create_outbound()
+        self.assertEqual(
+            (yield self.store.cache.get_message_batch_ids(msg_id)),
+            [batch_id])
+        self.store.outbound_messages = None  # Blow up if we load it.
+        ack = self.msg_helper.make_ack(msg)
+        yield self.store.add_event(ack)
+
+        event = yield self.store.events.load(ack['event_id'])
+        self.assertEqual(event.batches.keys(), [batch_id])
+
+    @inlineCallbacks
+    def test_add_ack_event_batch_ids_cache_miss(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        yield self.redis.delete(self.store.cache.message_batches_key(msg_id))
+        ack = self.msg_helper.make_ack(msg)
+        yield self.store.add_event(ack)
+
+        event = yield self.store.events.load(ack['event_id'])
+        self.assertEqual(event.batches.keys(), [batch_id])
+        self.assertEqual(
+            (yield self.store.cache.get_message_batch_ids(msg_id)),
+            [batch_id])
+
     @inlineCallbacks
     def test_add_ack_event_with_batch_ids(self):
         """
@@ -407,6 +466,33 @@ class TestMessageStore(TestMessageStoreBase):
         self.assertEqual(event_keys, [ack_id])
         self.assertEqual(batch_status, self._batch_status(sent=1, ack=1))
 
+    @inlineCallbacks
+    def test_add_ack_event_is_new(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        ack = self.msg_helper.make_ack(msg)
+        ack_id = ack['event_id']
+        yield self.store.add_event(ack, is_new=True)
+
+        stored_ack = yield self.store.get_event(ack_id)
+        event_keys = yield self.store.message_event_keys(msg_id)
+        self.assertEqual(stored_ack, ack)
+        self.assertEqual(event_keys, [ack_id])
+        event = yield self.store.events.load(ack_id)
+        self.assertEqual(event.batches.keys(), [batch_id])
+
+    @inlineCallbacks
+    def test_add_ack_event_is_new_duplicate(self):
+        msg_id, msg, batch_id_1 = yield self._create_outbound()
+        batch_id_2 = yield self.store.batch_start()
+        ack = self.msg_helper.make_ack(msg)
+        ack_id = ack['event_id']
+        yield self.store.add_event(ack)
+        yield self.store.add_event(ack, batch_ids=[batch_id_2], is_new=True)
+
+        event = yield self.store.events.load(ack_id)
+        self.assertEqual(
+            sorted(event.batches.keys()), sorted([batch_id_1, batch_id_2]))
+
     @inlineCallbacks
     def test_add_nack_event(self):
         msg_id, msg, batch_id = yield self._create_outbound()
@@ -496,6 +582,31 @@ class TestMessageStore(TestMessageStoreBase):
         self.assertEqual(new_stored_msg, msg)
         self.assertNotEqual(old_stored_msg, new_stored_msg)
 
+    @inlineCallbacks
+    def test_add_inbound_message_is_new(self):
+        batch_id = yield self.store.batch_start()
+        msg = self.msg_helper.make_inbound('inbound foo')
+        msg_id = msg['message_id']
+        yield self.store.add_inbound_message(
+            msg, batch_id=batch_id, is_new=True)
+
+        stored_msg = yield self.store.get_inbound_message(msg_id)
+        inbound_keys = yield self.store.batch_inbound_keys(batch_id)
+        self.assertEqual(stored_msg, msg)
+        self.assertEqual(inbound_keys, [msg_id])
+
+    @inlineCallbacks
+    def test_add_inbound_message_is_new_duplicate(self):
+        msg_id, msg, batch_id_1 = yield self._create_inbound()
+        batch_id_2 = yield self.store.batch_start()
+        yield self.store.add_inbound_message(
+            msg, batch_id=batch_id_2, is_new=True)
+
+        self.assertEqual(
+            (yield self.store.batch_inbound_keys(batch_id_1)), [msg_id])
+        self.assertEqual(
+            (yield self.store.batch_inbound_keys(batch_id_2)), [msg_id])
+
     @inlineCallbacks
     def test_add_inbound_message_with_batch_id(self):
         msg_id, msg, batch_id = yield self._create_inbound(by_batch=True)
@@ -1606,6 +1717,89 @@ class TestMessageStoreCache(TestMessageStoreBase):
         self.assertEqual(batch_status["delivery_report"], 10)
         self.assertEqual(batch_status["delivery_report.delivered"], 10)
 
+    @inlineCallbacks
+    def test_reconcile_cache_multiple_pages(self):
+        metrics = MetricManager('vumi.test.')
+        store = MessageStore(self.manager, self.redis, metrics=metrics)
+        store.DEFAULT_MAX_RESULTS = 3
+        store.RECONCILE_CONCURRENCY = 2
+        cache = store.cache
+        batch_id = yield store.batch_start([("pool", "tag")])
+
+        yield self.create_inbound_messages(batch_id, 5, from_addr='from1')
+        outbound_messages = yield self.create_outbound_messages(
+            batch_id, 7, to_addr='to1')
+        for msg in outbound_messages:
+            yield store.add_event(self.msg_helper.make_ack(msg))
+
+        yield self.clear_cache(store)
+        yield store.reconcile_cache(batch_id)
+        self.assertFalse(
+            (yield store.needs_reconciliation(batch_id, delta=0)))
+        self.assertEqual(
+            (yield cache.count_inbound_message_keys(batch_id)), 5)
+        self.assertEqual(
+            (yield cache.count_outbound_message_keys(batch_id)), 7)
+        batch_status = yield store.batch_status(batch_id)
+        self.assertEqual(batch_status['ack'], 7)
+        self.assertEqual(batch_status['sent'], 7)
+        self.assertEqual(
+            (yield cache.get_reconciliation_checkpoints(batch_id)), {})
+
+        inbound_keys = metrics['message_store.reconcile.inbound_keys']
+        self.assertEqual(
+            [v for _, v in inbound_keys.poll()], [3, 2])
+        outbound_keys = metrics['message_store.reconcile.outbound_keys']
+        self.assertEqual(
+            [v for _, v in outbound_keys.poll()], [3, 3, 1])
+        rates = metrics['message_store.reconcile.outbound_keys_per_second']
+        self.assertEqual(len(rates.poll()), 3)
+
+    @inlineCallbacks
+    def test_reconcile_cache_resume(self):
+        cache = self.store.cache
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+
+        yield self.create_inbound_messages(batch_id, 3, from_addr='from1')
+        outbound_messages = yield self.create_outbound_messages(
+            batch_id, 4, to_addr='to1')
+        for msg in outbound_messages:
+            yield self.store.add_event(self.msg_helper.make_ack(msg))
+
+        # Interrupt the recon after the outbound cache has been rebuilt.
+        reconcile_inbound_cache = self.store.reconcile_inbound_cache
+
+        def interrupted_reconcile_inbound_cache(*args, **kw):
+            raise ValueError("Interrupted.")
+
+        self.store.reconcile_inbound_cache = (
+            interrupted_reconcile_inbound_cache)
+        yield self.clear_cache(self.store)
+        yield self.assertFailure(
+            self.store.reconcile_cache(batch_id), ValueError)
+        checkpoints = yield cache.get_reconciliation_checkpoints(batch_id)
+        self.assertEqual(
+            sorted(checkpoints.keys()), ['outbound', 'start_timestamp'])
+        self.assertEqual(checkpoints['outbound']['counts_added'], True)
+        self.assertEqual(checkpoints['outbound']['position'], 4)
+        self.assertEqual(
+            len((yield cache.get_reconciliation_keys(
+                batch_id, 'outbound', 0, 4))), 4)
+
+        self.store.reconcile_inbound_cache = reconcile_inbound_cache
+        yield self.store.reconcile_cache(batch_id, resume=True)
+        self.assertFalse(
+            (yield self.store.needs_reconciliation(batch_id, delta=0)))
+        self.assertEqual(
+            (yield cache.count_inbound_message_keys(batch_id)), 3)
+        self.assertEqual(
+            (yield cache.count_outbound_message_keys(batch_id)), 4)
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['ack'], 4)
+        self.assertEqual(batch_status['sent'], 4)
+        self.assertEqual(
+            (yield cache.get_reconciliation_checkpoints(batch_id)), {})
+
     @inlineCallbacks
     def test_reconcile_cache_and_switch_to_counters(self):
         batch_id = yield self.store.batch_start([("pool", "tag")])
@@ -245,6 +245,118 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
             (yield self.cache.get_inbound_message_keys(self.batch_id)),
             ['the-same-thing'])
 
+    @inlineCallbacks
+    def test_reconciliation_checkpoints(self):
+        self.assertEqual(
+            (yield self.cache.get_reconciliation_checkpoints(self.batch_id)),
+            {})
+        yield self.cache.set_reconciliation_checkpoint(
+            self.batch_id, 'start_timestamp', '2014-01-01 00:00:00.000000')
+        yield self.cache.set_reconciliation_checkpoint(
+            self.batch_id, 'outbound', {'continuation': 'abc', 'pages': 2})
+        self.assertEqual(
+            (yield self.cache.get_reconciliation_checkpoints(self.batch_id)),
+            {
+                'start_timestamp': '2014-01-01 00:00:00.000000',
+                'outbound': {'continuation': 'abc', 'pages': 2},
+            })
+        yield self.cache.clear_reconciliation_checkpoints(self.batch_id)
+        self.assertEqual(
+            (yield self.cache.get_reconciliation_checkpoints(self.batch_id)),
+            {})
+
+    @inlineCallbacks
+    def test_reconciliation_keys(self):
+        yield self.cache.add_reconciliation_keys(self.batch_id, 'inbound', [
+            (0, 'key-0', '2014-01-01 00:00:00.000000'),
+            (1, 'key-1', '2014-01-01 00:00:01.000000'),
+            (2, 'key-2', '2014-01-01 00:00:02.000000'),
+        ])
+        self.assertEqual(
+            (yield self.cache.get_reconciliation_keys(
+                self.batch_id, 'inbound', 1, 3)),
+            [('key-1', '2014-01-01 00:00:01.000000'),
+             ('key-2', '2014-01-01 00:00:02.000000')])
+        self.assertEqual(
+            (yield self.cache.get_reconciliation_keys(
+                self.batch_id, 'outbound', 0, 3)),
+            [])
+
+        yield self.cache.truncate_reconciliation_keys(
+            self.batch_id, 'inbound', 1)
+        self.assertEqual(
+            (yield self.cache.get_reconciliation_keys(
+                self.batch_id, 'inbound', 0, 3)),
+            [('key-2', '2014-01-01 00:00:02.000000')])
+
+        yield self.cache.clear_reconciliation_checkpoints(self.batch_id)
+        self.assertEqual(
+            (yield self.cache.get_reconciliation_keys(
+                self.batch_id, 'inbound', 0, 3)),
+            [])
+
+    @inlineCallbacks
+    def test_set_reconciled_counts(self):
+        msg_in = self.msg_helper.make_inbound("inbound")
+        msg_out = self.msg_helper.make_outbound("outbound")
+        yield self.cache.add_inbound_message(self.batch_id, msg_in)
+        yield self.cache.add_outbound_message(self.batch_id, msg_out)
+        yield self.cache.add_event(
+            self.batch_id, self.msg_helper.make_ack(msg_out))
+
+        # Setting the same counts again, as a resumed reconciliation would,
+        # must not count anything twice.
+        for _ in range(2):
+            yield self.cache.set_reconciled_counts(self.batch_id, 'inbound', 3)
+            yield self.cache.set_reconciled_counts(
+                self.batch_id, 'outbound', 2, {'ack': 1, 'nack': 1})
+
+        self.assertEqual(
+            (yield self.cache.count_inbound_message_keys(self.batch_id)), 4)
+        self.assertEqual(
+            (yield self.cache.count_outbound_message_keys(self.batch_id)), 3)
+        self.assertEqual(
+            (yield self.cache.count_event_keys(self.batch_id)), 3)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status['sent'], 3)
+        self.assertEqual(status['ack'], 2)
+        self.assertEqual(status['nack'], 1)
+
+        yield self.cache.clear_batch(self.batch_id)
+        yield self.cache.batch_start(self.batch_id)
+        self.assertEqual(
+            (yield self.cache.count_inbound_message_keys(self.batch_id)), 0)
+        self.assertEqual(
+            (yield self.cache.count_event_keys(self.batch_id)), 0)
+
+    @inlineCallbacks
+    def test_message_batch_ids(self):
+        self.assertEqual(
+            (yield self.cache.get_message_batch_ids('msg-1')), None)
+        yield self.cache.set_message_batch_ids('msg-1', ['b2', 'b1'])
+        yield self.cache.set_message_batch_ids('msg-2', [])
+        self.assertEqual(
+            (yield self.cache.get_message_batch_ids('msg-1')), ['b1', 'b2'])
+        self.assertEqual(
+            (yield self.cache.get_message_batch_ids('msg-2')), [])
+        ttl = yield self.redis.ttl(self.cache.message_batches_key('msg-1'))
+        self.assertTrue(
+            0 < ttl <= self.cache.DEFAULT_MESSAGE_BATCHES_TTL)
+
+    @inlineCallbacks
+    def test_set_message_batch_ids_if_missing(self):
+        self.assertTrue(
+            (yield self.cache.set_message_batch_ids_if_missing(
+                'msg-1', ['b1'])))
+        self.assertFalse(
+            (yield self.cache.set_message_batch_ids_if_missing(
+                'msg-1', ['b2'])))
+        self.assertEqual(
+            (yield self.cache.get_message_batch_ids('msg-1')), ['b1'])
+        ttl = yield self.redis.ttl(self.cache.message_batches_key('msg-1'))
+        self.assertTrue(
+            0 < ttl <= self.cache.DEFAULT_MESSAGE_BATCHES_TTL)
+
     @inlineCallbacks
     def test_clear_batch(self):
         msg_in = self.msg_helper.make_inbound("inbound")
@@ -0,0 +1,236 @@
+"""Tests for vumi.components.message_store_writer."""
+
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.internet.task import Clock
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.components.message_store_writer import MessageStoreWriter
+from vumi.tests.helpers import VumiTestCase, MessageHelper
+
+
+class FakeStore(object):
+    """
+    Records writes and holds them until they're told to finish.
+    """
+
+    def __init__(self):
+        self.writes = []
+        self.new_ids = []
+        self.block = False
+
+    def _write(self, kind, msg_id, is_new):
+        d = Deferred() if self.block else succeed(None)
+        self.writes.append((kind, msg_id, d))
+        if is_new:
+            self.new_ids.append(msg_id)
+        return d
+
+    def add_inbound_message(self, msg, tag=None, is_new=False):
+        return self._write('inbound', msg['message_id'], is_new)
+
+    def add_outbound_message(self, msg, tag=None, is_new=False):
+        return self._write('outbound', msg['message_id'], is_new)
+
+    def add_event(self, event, is_new=False):
+        return self._write('event', event['event_id'], is_new)
+
+    def written(self):
+        return [(kind, msg_id) for kind, msg_id, _ in self.writes]
+
+    def finish(self, n=None):
+        writes = [d for _, _, d in self.writes if not d.called]
+        for d in writes[:n]:
+            d.callback(None)
+
+    def unblock(self):
+        self.block = False
+        self.finish()
+
+
+class TestMessageStoreWriter(VumiTestCase):
+
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.store = FakeStore()
+        self.clock = Clock()
+        self.pauses = []
+
+    def make_writer(self, **kw):
+        kw.setdefault('pause_callback', lambda: self.pauses.append('pause'))
+        kw.setdefault(
+            'unpause_callback', lambda: self.pauses.append('unpause'))
+        writer = MessageStoreWriter(self.store, **kw)
+        writer.clock = self.clock
+        self.add_cleanup(writer.stop)
+        self.add_cleanup(self.store.unblock)
+        return writer
+
+    def mk_msgs(self, n):
+        return [self.msg_helper.make_outbound('hi', message_id='msg%s' % i)
+                for i in range(n)]
+
+    def test_writes_full_batch(self):
+        writer = self.make_writer(batch_size=3, max_latency=10)
+        msg1, msg2, msg3 = self.mk_msgs(3)
+        writer.add_outbound_message(msg1)
+        writer.add_outbound_message(msg2)
+        self.assertEqual(self.store.written(), [])
+        writer.add_outbound_message(msg3)
+        self.assertEqual(self.store.written(), [
+            ('outbound', 'msg0'), ('outbound', 'msg1'), ('outbound', 'msg2'),
+        ])
+        self.assertEqual(len(writer), 0)
+
+    def test_writes_after_max_latency(self):
+        writer = self.make_writer(batch_size=3, max_latency=0.5)
+        [msg] = self.mk_msgs(1)
+        writer.add_outbound_message(msg)
+        self.clock.advance(0.4)
+        self.assertEqual(self.store.written(), [])
+        self.clock.advance(0.1)
+        self.assertEqual(self.store.written(), [('outbound', 'msg0')])
+
+    def test_kinds(self):
+        writer = self.make_writer(batch_size=3)
+        msg = self.msg_helper.make_inbound('hi', message_id='in1')
+        writer.add_inbound_message(msg)
+        msg = self.msg_helper.make_outbound('hi', message_id='out1')
+        writer.add_outbound_message(msg)
+        ack = self.msg_helper.make_ack(msg, event_id='ack1')
+        writer.add_event(ack)
+        self.assertEqual(self.store.written(), [
+            ('inbound', 'in1'), ('outbound', 'out1'), ('event', 'ack1'),
+        ])
+
+    def test_is_new(self):
+        writer = self.make_writer(batch_size=4)
+        msg = self.msg_helper.make_inbound('hi', message_id='in1')
+        writer.add_inbound_message(msg, is_new=True)
+        msg = self.msg_helper.make_outbound('hi', message_id='out1')
+        writer.add_outbound_message(msg, is_new=True)
+        writer.add_event(self.msg_helper.make_ack(msg, event_id='ack1'))
+        writer.add_event(
+            self.msg_helper.make_nack(msg, event_id='nack1'), is_new=True)
+        self.assertEqual(len(self.store.writes), 4)
+        self.assertEqual(self.store.new_ids, ['in1', 'out1', 'nack1'])
+
+    def test_stores_copies(self):
+        writer = self.make_writer(batch_size=2)
+        [msg] = self.mk_msgs(1)
+        copies = []
+        self.store.add_outbound_message = (
+            lambda msg, tag=None, is_new=False: copies.append(msg))
+        writer.add_outbound_message(msg)
+        msg['content'] = 'changed'
+        writer.flush()
+        [copy] = copies
+        self.assertEqual(copy['content'], 'hi')
+
+    def test_concurrency(self):
+        self.store.block = True
+        writer = self.make_writer(batch_size=1, concurrency=2)
+        for msg in self.mk_msgs(3):
+            writer.add_outbound_message(msg)
+        self.assertEqual(len(self.store.writes), 2)
+        self.assertEqual(len(writer), 1)
+        self.store.finish(1)
+        self.assertEqual(len(self.store.writes), 3)
+        self.assertEqual(len(writer), 0)
+
+    def test_event_waits_for_message(self):
+        self.store.block = True
+        writer = self.make_writer(batch_size=1, concurrency=2)
+        [msg] = self.mk_msgs(1)
+        writer.add_outbound_message(msg)
+        writer.add_event(self.msg_helper.make_ack(msg, event_id='ack1'))
+        self.assertEqual(self.store.written(), [('outbound', 'msg0')])
+        self.store.finish()
+        self.assertEqual(self.store.written(), [
+            ('outbound', 'msg0'), ('event', 'ack1')])
+
+    @inlineCallbacks
+    def test_backpressure(self):
+        self.store.block = True
+        writer = self.make_writer(
+            max_size=4, batch_size=1, concurrency=1, max_latency=10)
+        msgs = self.mk_msgs(7)
+        ds = [writer.add_outbound_message(msg) for msg in msgs]
+        # One write in progress, four queued and two waiting for space.
+        self.assertEqual(len(self.store.writes), 1)
+        self.assertEqual(len(writer), 4)
+        self.assertEqual([d.called for d in ds], [True] * 5 + [False] * 2)
+        self.assertEqual(self.pauses, ['pause'])
+        self.assertTrue(writer.paused)
+
+        self.store.finish()
+        self.assertEqual([d.called for d in ds], [True] * 6 + [False])
+        self.assertEqual(self.pauses, ['pause'])
+        self.store.finish()
+        self.assertEqual([d.called for d in ds], [True] * 7)
+        self.store.finish()
+        self.assertEqual(len(writer), 3)
+        self.assertTrue(writer.paused)
+        # We unpause once the queue is down to half full.
+        self.store.finish()
+        self.assertEqual(len(writer), 2)
+        self.assertEqual(self.pauses, ['pause', 'unpause'])
+        self.assertFalse(writer.paused)
+
+        self.store.block = False
+        self.store.finish()
+        yield writer.flush()
+        self.assertEqual(
+            [msg_id for _, msg_id in self.store.written()],
+            [msg['message_id'] for msg in msgs])
+
+    @inlineCallbacks
+    def test_flush(self):
+        self.store.block = True
+        writer = self.make_writer(batch_size=10, max_latency=10)
+        for msg in self.mk_msgs(3):
+            writer.add_outbound_message(msg)
+        d = writer.flush()
+        self.assertEqual(len(self.store.writes), 3)
+        self.assertFalse(d.called)
+        self.store.finish()
+        yield d
+        self.assertEqual(len(writer), 0)
+
+    def test_flush_empty(self):
+        writer = self.make_writer()
+        self.assertTrue(writer.flush().called)
+
+    def test_stop(self):
+        writer = self.make_writer(batch_size=10, max_latency=10)
+        for msg in self.mk_msgs(2):
+            writer.add_outbound_message(msg)
+        d = writer.stop()
+        self.assertTrue(d.called)
+        self.assertEqual(len(self.store.writes), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_write_errors_logged(self):
+        writer = self.make_writer(batch_size=1)
+        self.store.add_outbound_message = (
+            lambda msg, tag=None, is_new=False: 1 / 0)
+        [msg] = self.mk_msgs(1)
+        writer.add_outbound_message(msg)
+        [err] = self.flushLoggedErrors(ZeroDivisionError)
+        self.assertEqual(len(writer), 0)
+
+    def test_metrics(self):
+        metrics = MetricManager('vumi.test.')
+        writer = self.make_writer(
+            batch_size=2, max_latency=0.5, metrics=metrics)
+        msg1, msg2, msg3 = self.mk_msgs(3)
+        writer.add_outbound_message(msg1)
+        self.clock.advance(0.2)
+        writer.add_outbound_message(msg2)
+        writer.add_outbound_message(msg3)
+        self.clock.advance(0.5)
+        depth = metrics['message_store_writer.queue_depth'].poll()
+        self.assertEqual([v for _, v in depth], [0, 0])
+        latency = metrics['message_store_writer.flush_latency'].poll()
+        [latency1, latency2] = [v for _, v in latency]
+        self.assertAlmostEqual(latency1, 0.2)
+        self.assertAlmostEqual(latency2, 0.5)
@@ -0,0 +1,177 @@
+import time
+from datetime import datetime
+
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.task import Clock
+
+from vumi.components.scheduler import SortedSetScheduler
+from vumi.persist.fake_redis import FakeRedis
+from vumi.message import TransportUserMessage
+from vumi.utils import to_kwargs
+from vumi.tests.helpers import VumiTestCase, MessageHelper
+from vumi.tests.utils import LogCatcher
+
+
+class TestSortedSetScheduler(VumiTestCase):
+
+    def setUp(self):
+        self.r_server = FakeRedis()
+        self.clock = Clock()
+        self.clock.advance(time.mktime(datetime(2012, 1, 1).timetuple()))
+        self.scheduler = SortedSetScheduler(
+            self.r_server, self._scheduler_callback, batch_size=2)
+        self.scheduler.clock = self.clock
+        self.add_cleanup(self.scheduler.stop)
+        self._delivery_history = []
+        self.msg_helper = self.add_helper(MessageHelper())
+
+    def _scheduler_callback(self, scheduled_at, message):
+        self._delivery_history.append((scheduled_at, message))
+
+    def delivered_ids(self):
+        return [payload['message_id'] for _, payload in self._delivery_history]
+
+    def schedule_msg(self, message_id, delta, now=None):
+        msg = self.msg_helper.make_inbound("inbound", message_id=message_id)
+        return self.scheduler.schedule(delta, msg.payload, now)
+
+    @inlineCallbacks
+    def test_deliver_scheduled(self):
+        self.schedule_msg('msg1', 10)
+        self.schedule_msg('msg2', 5.5)
+        now = self.clock.seconds()
+        yield self.scheduler.deliver_scheduled(now + 5)
+        self.assertEqual(self.delivered_ids(), [])
+        yield self.scheduler.deliver_scheduled(now + 5.5)
+        self.assertEqual(self.delivered_ids(), ['msg2'])
+        yield self.scheduler.deliver_scheduled(now + 20)
+        self.assertEqual(self.delivered_ids(), ['msg2', 'msg1'])
+        self.assertEqual(self.scheduler.count_scheduled(), 0)
+
+    @inlineCallbacks
+    def test_deliver_scheduled_payload(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        self.scheduler.schedule(0, msg.payload)
+        yield self.scheduler.deliver_scheduled()
+        [(scheduled_at, payload)] = self._delivery_history
+        self.assertTrue(scheduled_at)
+        self.assertEqual(TransportUserMessage(**to_kwargs(payload)), msg)
+
+    @inlineCallbacks
+    def test_deliver_scheduled_in_batches(self):
+        for i in range(5):
+            self.schedule_msg('msg%s' % (i,), i)
+        claims = []
+        orig_claim_due = self.scheduler.claim_due
+
+        def claim_due(now):
+            items = orig_claim_due(now)
+            claims.append(len(items))
+            return items
+
+        self.scheduler.claim_due = claim_due
+        yield self.scheduler.deliver_scheduled(self.clock.seconds() + 10)
+        self.assertEqual(claims, [2, 2, 1])
+        self.assertEqual(self.delivered_ids(),
+                         ['msg0', 'msg1', 'msg2', 'msg3', 'msg4'])
+
+    @inlineCallbacks
+    def test_failing_callback(self):
+        def callback(scheduled_at, payload):
+            if payload['message_id'] == 'msg2':
+                raise ValueError("Delivery failed")
+            self._delivery_history.append((scheduled_at, payload))
+
+        self.scheduler.callback = callback
+        for i in range(1, 4):
+            self.schedule_msg('msg%s' % (i,), i)
+        now = self.clock.seconds()
+        with LogCatcher() as lc:
+            yield self.scheduler.deliver_scheduled(now + 10)
+        # The items after the failing one are still delivered.
+        self.assertEqual(self.delivered_ids(), ['msg1', 'msg3'])
+        [err] = lc.errors
+        self.assertEqual(
+            err['why'], "Error delivering scheduled item, retrying in 60"
+            " seconds")
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        # The failed item is kept for another attempt.
+        self.assertEqual(self.scheduler.count_scheduled(), 1)
+        self.assertEqual(self.scheduler.get_next_due_time(), now + 60)
+        self.scheduler.callback = self._scheduler_callback
+        yield self.scheduler.deliver_scheduled(now + 60)
+        self.assertEqual(self.delivered_ids(), ['msg1', 'msg3', 'msg2'])
+
+    @inlineCallbacks
+    def test_cancel(self):
+        key = self.schedule_msg('msg1', 0)
+        self.assertTrue(self.scheduler.cancel(key))
+        self.assertFalse(self.scheduler.cancel(key))
+        yield self.scheduler.deliver_scheduled()
+        self.assertEqual(self.delivered_ids(), [])
+
+    def test_get_next_due_time(self):
+        self.assertEqual(self.scheduler.get_next_due_time(), None)
+        now = self.clock.seconds()
+        self.schedule_msg('msg1', 10)
+        self.schedule_msg('msg2', 3)
+        self.assertEqual(self.scheduler.get_next_due_time(), now + 3)
+
+    def test_timer_armed_for_next_due_time(self):
+        self.schedule_msg('msg1', 2.5)
+        self.scheduler.start()
+        self.assertTrue(self.scheduler.is_running)
+        self.clock.advance(2.4)
+        self.assertEqual(self.delivered_ids(), [])
+        self.clock.advance(0.1)
+        self.assertEqual(self.delivered_ids(), ['msg1'])
+
+    def test_timer_rearmed_for_earlier_item(self):
+        self.schedule_msg('msg1', 30)
+        self.scheduler.start()
+        self.schedule_msg('msg2', 1)
+        self.clock.advance(1)
+        self.assertEqual(self.delivered_ids(), ['msg2'])
+        self.clock.advance(29)
+        self.assertEqual(self.delivered_ids(), ['msg2', 'msg1'])
+
+    def test_claim_due_shared_prefix(self):
+        other = SortedSetScheduler(self.r_server, None, batch_size=2)
+        for i in range(3):
+            self.schedule_msg('msg%s' % (i,), 0)
+        now = self.clock.seconds()
+        claimed = self.scheduler.claim_due(now) + other.claim_due(now)
+        self.assertEqual(
+            sorted(payload['message_id'] for _, _, payload in claimed),
+            ['msg0', 'msg1', 'msg2'])
+        self.assertEqual(self.scheduler.claim_due(now), [])
+
+    def test_timer_max_delay(self):
+        self.scheduler.max_delay = 10
+        self.scheduler.start()
+        # Scheduled by some other process, so our timer doesn't know.
+        other = SortedSetScheduler(self.r_server, None)
+        msg = self.msg_helper.make_inbound("inbound", message_id='msg1')
+        other.schedule(1, msg.payload, now=self.clock.seconds())
+        self.clock.advance(9)
+        self.assertEqual(self.delivered_ids(), [])
+        self.clock.advance(1)
+        self.assertEqual(self.delivered_ids(), ['msg1'])
+
+    def test_waits_for_callback(self):
+        d = Deferred()
+        self.scheduler.callback = lambda scheduled_at, payload: d
+        self.schedule_msg('msg1', 0)
+        self.scheduler.start()
+        self.assertEqual(self.scheduler._timer, None)
+        d.callback(None)
+        self.assertNotEqual(self.scheduler._timer, None)
+
+    def test_stop(self):
+        self.schedule_msg('msg1', 5)
+        self.scheduler.start()
+        self.scheduler.stop()
+        self.assertFalse(self.scheduler.is_running)
+        self.clock.advance(5)
+        self.assertEqual(self.delivered_ids(), [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -70,3 +70,63 @@ class TestSessionManager(VumiTestCase):
         # Redis saves & returns all session values as strings
         self.assertEqual(session, dict([map(str, kvs) for kvs
                                         in test_session.items()]))
+
+    @inlineCallbacks
+    def test_create_session_encodes_values(self):
+        session = yield self.sm.create_session(
+            "u1", created_at=1.5, count=3, name=u"f\xf6\xf6")
+        self.assertEqual(session, {
+            'created_at': '1.5',
+            'count': '3',
+            'name': u"f\xf6\xf6".encode('utf-8'),
+        })
+        loaded = yield self.sm.load_session("u1")
+        self.assertEqual(loaded, session)
+
+    @inlineCallbacks
+    def test_create_session_encodes_floats_with_repr(self):
+        # str() would round this to 1413245321.12 under Python 2.
+        session = yield self.sm.create_session(
+            "u1", created_at=1413245321.123456)
+        self.assertEqual(session, {'created_at': '1413245321.123456'})
+        loaded = yield self.sm.load_session("u1")
+        self.assertEqual(loaded, session)
+
+    @inlineCallbacks
+    def test_create_session_with_expiry(self):
+        self.sm.max_session_length = 60.0
+        yield self.sm.create_session("u1")
+        ttl = yield self.manager.ttl("session:u1")
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_create_session_batches_commands(self):
+        self.sm.max_session_length = 60.0
+        pipeline = self.sm.pipeline
+        if pipeline is self.manager:
+            # The synchronous manager's commands block.
+            return
+        d = self.sm.create_session("u1", foo="bar")
+        # The clear, save and expiry are all sent without waiting.
+        self.assertEqual(pipeline.pending_count(), 3)
+        yield d
+        self.assertEqual(pipeline.pending_count(), 0)
+
+    @inlineCallbacks
+    def test_save_sessions(self):
+        yield self.sm.save_sessions({
+            "u1": {"foo": "bar"},
+            "u2": {"baz": 5},
+        })
+        self.assertEqual((yield self.sm.load_session("u1")), {"foo": "bar"})
+        self.assertEqual((yield self.sm.load_session("u2")), {"baz": "5"})
+
+    @inlineCallbacks
+    def test_load_sessions(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.sm.create_session("u2", baz="quux")
+        sessions = yield self.sm.load_sessions(["u1", "u2", "u3"])
+        self.assertEqual(sorted(sessions.keys()), ["u1", "u2", "u3"])
+        self.assertEqual(sessions["u1"]["foo"], "bar")
+        self.assertEqual(sessions["u2"]["baz"], "quux")
+        self.assertEqual(sessions["u3"], {})
@@ -17,7 +17,8 @@ class BaseConnector(object):
     individually all over the place.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, max_concurrency=1, ordering_fields=(),
+                 publisher_confirms=False, max_unconfirmed=100):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
@@ -25,6 +26,10 @@ class BaseConnector(object):
         self._endpoint_handlers = {}
         self._default_handlers = {}
         self._prefetch_count = prefetch_count
+        self._max_concurrency = max_concurrency
+        self._ordering_fields = ordering_fields
+        self._publisher_confirms = publisher_confirms
+        self._max_unconfirmed = max_unconfirmed
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
 
@@ -36,9 +41,25 @@ class BaseConnector(object):
 
     def teardown(self):
         d = gatherResults([c.stop() for c in self._consumers.values()])
+        d.addCallback(lambda r: self._wait_for_confirms())
         d.addCallback(lambda r: self._middlewares.teardown())
         return d
 
+    def _wait_for_confirms(self):
+        """
+        Wait for the broker to confirm the messages published by this
+        connector. Messages that are rejected, or whose channel is closed
+        before they are confirmed, are logged rather than failing teardown.
+        """
+        ds = []
+        for mtype, publisher in self._publishers.iteritems():
+            d = publisher.wait_for_confirms()
+            d.addErrback(
+                log.err, "Unconfirmed %r messages published by %r" % (
+                    mtype, self.name))
+            ds.append(d)
+        return gatherResults(ds)
+
     @property
     def paused(self):
         return all(consumer.paused
@@ -55,7 +76,9 @@ class BaseConnector(object):
 
     @inlineCallbacks
     def _setup_publisher(self, mtype):
-        publisher = yield self.worker.publish_to(self._rkey(mtype))
+        publisher = yield self.worker.publish_to(
+            self._rkey(mtype), confirm=self._publisher_confirms,
+            max_unconfirmed=self._max_unconfirmed)
         self._publishers[mtype] = publisher
         returnValue(publisher)
 
@@ -66,7 +89,9 @@ class BaseConnector(object):
 
         consumer = yield self.worker.consume(
             self._rkey(mtype), handler, message_class=msg_class, paused=True,
-            prefetch_count=self._prefetch_count)
+            prefetch_count=self._prefetch_count,
+            max_concurrency=self._max_concurrency,
+            ordering_fields=self._ordering_fields)
         self._consumers[mtype] = consumer
         self._set_default_endpoint_handler(mtype, default_handler)
         returnValue(consumer)
@@ -10,11 +10,12 @@ from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
 from vumi.service import Worker
 from vumi.errors import ConfigError, DispatcherError
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.utils import load_class_by_string, get_first_word
+from vumi.utils import load_class_by_string, get_first_word, LRUCache
 from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
 from vumi import log
 from vumi.components.session import SessionManager
 from vumi.persist.txredis_manager import TxRedisManager
+from vumi.blinkenlights.metrics import MetricManager, Metric, LAST
 
 
 class BaseDispatchWorker(Worker):
@@ -390,6 +391,25 @@ class UserGroupingRouter(SimpleDispatchRouter):
     :param str dispatcher_name:
         The name of the dispatcher, used internally as
         the prefix for Redis keys.
+
+    :param int group_cache_size:
+        Maximum number of user group assignments to keep in memory.
+        Assignments never change once made, so returning users are
+        routed without a Redis lookup. Defaults to 10000.
+
+    :param bool group_cache_warmup:
+        If true, fill the group cache with existing assignments from
+        Redis in the background on startup. Messages are routed while
+        this is happening. This scans the keys in the Redis database, so
+        it defaults to false.
+
+    :param int group_cache_warmup_max_scans:
+        The maximum number of Redis ``SCAN`` calls made while warming the
+        group cache. Defaults to 100.
+
+    :param str group_cache_metrics_prefix:
+        Prefix for the group cache hit rate metric. If not set (the
+        default), the hit rate isn't published.
     """
 
     def setup_routing(self):
@@ -402,25 +422,111 @@ class UserGroupingRouter(SimpleDispatchRouter):
 
         self.groups = self.config['group_mappings']
         self.nr_of_groups = len(self.groups)
+        self.sorted_groups = sorted(self.groups.items())
+
+        self.group_cache = LRUCache(
+            self.config.get('group_cache_size', 10000))
+        self.group_cache_stats = {'hits': 0, 'misses': 0}
+        self.group_cache_warmup_max_scans = self.config.get(
+            'group_cache_warmup_max_scans', 100)
+        self._group_cache_warmup_d = None
+        self._stop_group_cache_warmup = False
+        if self.config.get('group_cache_warmup', False):
+            self._redis_d.addCallback(self._start_group_cache_warmup)
+
+        self.metrics = None
+        metrics_prefix = self.config.get('group_cache_metrics_prefix')
+        if metrics_prefix is not None:
+            self._redis_d.addCallback(
+                lambda _: self._setup_metrics(metrics_prefix))
+
+    def teardown_routing(self):
+        self._stop_group_cache_warmup = True
+        if self.metrics is not None:
+            self.metrics.stop()
+            self.metrics = None
+        return self._group_cache_warmup_d
 
     def _setup_redis(self, redis):
         self.redis = redis
 
+    @inlineCallbacks
+    def _setup_metrics(self, metrics_prefix):
+        self.metrics = yield self.dispatcher.start_publisher(
+            MetricManager, metrics_prefix)
+        self.metrics.register(
+            Metric('group_cache.hit_rate', aggregators=[LAST]))
+
+    def _start_group_cache_warmup(self, _):
+        # We don't wait for this, so routing starts straight away and isn't
+        # affected if warming the cache fails.
+        d = self.warm_group_cache()
+        d.addErrback(log.err, "Error warming UserGroupingRouter group cache")
+        self._group_cache_warmup_d = d
+
+    @inlineCallbacks
+    def warm_group_cache(self):
+        """
+        Load existing group assignments from Redis into the group cache,
+        stopping once the cache is full or after
+        :attr:`group_cache_warmup_max_scans` scans.
+        """
+        pipeline = self.redis.pipeline()
+        cursor = None
+        for _ in xrange(self.group_cache_warmup_max_scans):
+            if self._stop_group_cache_warmup:
+                break
+            if len(self.group_cache) >= self.group_cache.max_size:
+                break
+            cursor, keys = yield self.redis.scan(cursor, match='user:*')
+            group_ds = [(key, pipeline.get(key)) for key in keys]
+            for key, group_d in group_ds:
+                group = yield group_d
+                if group:
+                    self.group_cache.set(key.split(':', 1)[1], group)
+            if cursor is None:
+                break
+
+    def group_cache_hit_rate(self):
+        """
+        Return the fraction of group lookups answered from the group cache.
+        """
+        lookups = self.group_cache_stats['hits'] + \
+            self.group_cache_stats['misses']
+        if not lookups:
+            return 0.0
+        return self.group_cache_stats['hits'] / float(lookups)
+
+    def _publish_group_cache_hit_rate(self):
+        if self.metrics is not None:
+            self.metrics['group_cache.hit_rate'].set(
+                self.group_cache_hit_rate())
+
     @inlineCallbacks
     def get_next_group(self):
         counter = (yield self.redis.incr('round-robin')) - 1
         current_group_id = counter % self.nr_of_groups
-        sorted_groups = sorted(self.groups.items())
-        group = sorted_groups[current_group_id]
+        group = self.sorted_groups[current_group_id]
         returnValue(group)
 
     @inlineCallbacks
     def get_group_for_user(self, user_id):
+        group = self.group_cache.get(user_id)
+        if group is not None:
+            self.group_cache_stats['hits'] += 1
+            self._publish_group_cache_hit_rate()
+            returnValue(group)
+        self.group_cache_stats['misses'] += 1
+        self._publish_group_cache_hit_rate()
         user_key = "user:%s" % (user_id,)
         group = yield self.redis.get(user_key)
         if not group:
             group, transport_name = yield self.get_next_group()
-            yield self.redis.set(user_key, group)
+            # Another dispatcher may have assigned this user a group since
+            # we looked, in which case we use theirs.
+            if not (yield self.redis.setnx(user_key, group)):
+                group = yield self.redis.get(user_key)
+        self.group_cache.set(user_id, group)
         returnValue(group)
 
     @inlineCallbacks
@@ -431,6 +537,58 @@ class UserGroupingRouter(SimpleDispatchRouter):
         self.dispatcher.publish_inbound_message(app, msg)
 
 
+class KeywordRoutingTable(object):
+    """Index of :class:`ContentKeywordRouter` rules.
+
+    Rules are indexed by keyword, then by `to_addr` and then by `prefix`,
+    so finding the rules that match a message doesn't depend on the number
+    of rules.
+
+    :param list rules:
+        Routing rules, as described in :class:`ContentKeywordRouter`, with
+        lowercase keywords.
+    """
+
+    # Key for rules that match any to_addr.
+    ANY_TO_ADDR = (False, None)
+
+    def __init__(self, rules):
+        self._keywords = {}
+        for i, rule in enumerate(rules):
+            to_addrs = self._keywords.setdefault(rule['keyword'], {})
+            if 'to_addr' in rule:
+                to_addr_key = (True, rule['to_addr'])
+            else:
+                to_addr_key = self.ANY_TO_ADDR
+            prefixes = to_addrs.setdefault(to_addr_key, {})
+            prefixes.setdefault(rule.get('prefix', ''), []).append(
+                (i, rule['app']))
+        # For each set of prefixes, keep the distinct prefix lengths so that
+        # a from_addr only needs one lookup per length.
+        for to_addrs in self._keywords.itervalues():
+            for to_addr_key, prefixes in to_addrs.items():
+                lengths = sorted(set(len(prefix) for prefix in prefixes))
+                to_addrs[to_addr_key] = (lengths, prefixes)
+
+    def lookup(self, keyword, to_addr, from_addr):
+        """Return the apps of all rules that match, in rule order."""
+        to_addrs = self._keywords.get(keyword)
+        if to_addrs is None:
+            return []
+        from_addr = from_addr or ''
+        matches = []
+        for to_addr_key in (self.ANY_TO_ADDR, (True, to_addr)):
+            if to_addr_key not in to_addrs:
+                continue
+            lengths, prefixes = to_addrs[to_addr_key]
+            for length in lengths:
+                if length > len(from_addr):
+                    break
+                matches.extend(prefixes.get(from_addr[:length], []))
+        matches.sort()
+        return [app for _, app in matches]
+
+
 class ContentKeywordRouter(SimpleDispatchRouter):
     """Router that dispatches based on the first word of the message
     content. In the context of SMSes the first word is sometimes called
@@ -470,6 +628,9 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         route events such as acknowledgements and delivery reports
         back to the application that sent the outgoing
         message. Default is seven days.
+
+    The rules can be replaced while the dispatcher is running by calling
+    :meth:`load_rules`.
     """
 
     DEFAULT_ROUTING_TIMEOUT = 60 * 60 * 24 * 7  # 7 days
@@ -478,18 +639,8 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         self.r_config = self.config.get('redis_manager', {})
         self.r_prefix = self.config['dispatcher_name']
 
-        self.rules = []
-        for rule in self.config.get('rules', []):
-            if 'keyword' not in rule or 'app' not in rule:
-                raise ConfigError("Rule definition %r must contain values for"
-                                  " both 'app' and 'keyword'" % rule)
-            rule = rule.copy()
-            rule['keyword'] = rule['keyword'].lower()
-            self.rules.append(rule)
-        keyword_mappings = self.config.get('keyword_mappings', {})
-        for transport_name, keyword in keyword_mappings.items():
-            self.rules.append({'app': transport_name,
-                               'keyword': keyword.lower()})
+        self.load_rules(self.config.get('rules', []),
+                        self.config.get('keyword_mappings', {}))
         self.fallback_application = self.config.get('fallback_application')
         self.transport_mappings = self.config['transport_mappings']
         self.expire_routing_timeout = int(self.config.get(
@@ -505,6 +656,33 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         self.session_manager = SessionManager(
             self.redis, self.expire_routing_timeout)
 
+    def load_rules(self, rules, keyword_mappings):
+        """Replace the routing rules.
+
+        This may be called at any time to reload the rules without
+        restarting the dispatcher. The new routing table is built before it
+        replaces the old one, so invalid rules leave the old ones in place.
+
+        :param list rules:
+            Routing rules, as for the *rules* config option.
+        :param dict keyword_mappings:
+            Mapping from application names to keywords, as for the
+            *keyword_mappings* config option.
+        """
+        new_rules = []
+        for rule in rules:
+            if 'keyword' not in rule or 'app' not in rule:
+                raise ConfigError("Rule definition %r must contain values for"
+                                  " both 'app' and 'keyword'" % rule)
+            rule = rule.copy()
+            rule['keyword'] = rule['keyword'].lower()
+            new_rules.append(rule)
+        for transport_name, keyword in keyword_mappings.items():
+            new_rules.append({'app': transport_name,
+                              'keyword': keyword.lower()})
+        routing_table = KeywordRoutingTable(new_rules)
+        self.rules, self.routing_table = new_rules, routing_table
+
     def get_message_key(self, message):
         return 'message:%s' % (message,)
 
@@ -526,14 +704,13 @@ class ContentKeywordRouter(SimpleDispatchRouter):
 
     def dispatch_inbound_message(self, msg):
         keyword = get_first_word(msg['content']).lower()
-        matched = False
-        for rule in self.rules:
-            if self.is_msg_matching_routing_rules(keyword, msg, rule):
-                matched = True
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.publish_exposed_inbound(rule['app'], msg.copy())
-        if not matched:
+        apps = self.routing_table.lookup(
+            keyword, msg['to_addr'], msg['from_addr'])
+        for app in apps:
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.publish_exposed_inbound(app, msg.copy())
+        if not apps:
             if self.fallback_application is not None:
                 self.publish_exposed_inbound(self.fallback_application, msg)
             else:
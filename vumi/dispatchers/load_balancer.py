@@ -1,16 +1,181 @@
 # -*- test-case-name: vumi.dispatchers.tests.test_load_balancer -*-
 
-"""Router for round-robin load balancing between two transports."""
+"""Router for load balancing between transports."""
 
 import itertools
+from collections import deque
+
+from twisted.internet import reactor
 
 from vumi import log
 from vumi.errors import ConfigError
 from vumi.dispatchers.base import BaseDispatchRouter
 
 
+class RoundRobinStrategy(object):
+    """Pick transports in turn.
+
+    Strategies are told about every outbound message sent and every event
+    received so that they can base their choice on how each transport is
+    coping.
+    """
+
+    def __init__(self, router, config):
+        self.transport_name_cycle = itertools.cycle(
+            router.dispatcher.transport_names)
+
+    def next_transport_name(self):
+        return self.transport_name_cycle.next()
+
+    def message_sent(self, transport_name, msg):
+        pass
+
+    def event_received(self, msg):
+        pass
+
+
+class WeightedRoundRobinStrategy(RoundRobinStrategy):
+    """Pick transports in turn in proportion to their configured weights.
+
+    Uses smooth weighted round robin, so a transport with weight 3 next to
+    one with weight 1 gets three out of every four messages, but not three
+    in a row.
+
+    Configuration options:
+
+    :param dict transport_weights:
+        Mapping of transport name to a positive integer weight. Transports
+        that aren't listed have a weight of 1.
+    """
+
+    def __init__(self, router, config):
+        weights = config.get('transport_weights', {})
+        self.weights = []
+        for transport_name in router.dispatcher.transport_names:
+            weight = weights.get(transport_name, 1)
+            if not isinstance(weight, (int, long)) or weight < 1:
+                raise ConfigError(
+                    "Weight for transport %r must be a positive integer,"
+                    " not %r." % (transport_name, weight))
+            self.weights.append([transport_name, weight, 0])
+        self.total_weight = sum(w[1] for w in self.weights)
+
+    def next_transport_name(self):
+        best = None
+        for entry in self.weights:
+            entry[2] += entry[1]
+            if best is None or entry[2] > best[2]:
+                best = entry
+        best[2] -= self.total_weight
+        return best[0]
+
+
+class LeastOutstandingStrategy(RoundRobinStrategy):
+    """Pick the transport that should clear its outstanding messages soonest.
+
+    Messages are outstanding from the time they are sent until an ack or a
+    nack is received for them (or until ``outstanding_timeout`` passes).
+    Each transport's ack latency is tracked as an exponentially weighted
+    moving average, and a transport's score is the number of messages it has
+    outstanding multiplied by its average latency. Transports that are slow
+    or throttled build up both, so traffic shifts away from them.
+
+    Configuration options:
+
+    :param float outstanding_timeout:
+        Number of seconds after which a message we haven't seen an ack or
+        nack for is no longer counted as outstanding. Default: 60.
+    :param float latency_smoothing:
+        Weight given to each new latency sample in the moving average,
+        between 0 and 1. Default: 0.2.
+    """
+
+    MIN_LATENCY = 0.001
+
+    def __init__(self, router, config):
+        self.clock = router.clock
+        self.transport_names = list(router.dispatcher.transport_names)
+        self.outstanding_timeout = config.get('outstanding_timeout', 60)
+        self.latency_smoothing = config.get('latency_smoothing', 0.2)
+        self.outstanding = dict((name, 0) for name in self.transport_names)
+        self.latency = dict((name, None) for name in self.transport_names)
+        # message_id -> (transport_name, sent_at)
+        self.in_flight = {}
+        # (message_id, sent_at), oldest first. Entries for messages that have
+        # since been acked or nacked are skipped when they expire.
+        self._sent_order = deque()
+        self._next_start = 0
+
+    def expire_outstanding(self):
+        expire_before = self.clock.seconds() - self.outstanding_timeout
+        while self._sent_order and self._sent_order[0][1] <= expire_before:
+            message_id, sent_at = self._sent_order.popleft()
+            sent = self.in_flight.get(message_id)
+            if sent is None or sent[1] != sent_at:
+                continue
+            del self.in_flight[message_id]
+            self.outstanding[sent[0]] -= 1
+
+    def score(self, transport_name, default_latency):
+        latency = self.latency[transport_name]
+        if latency is None:
+            latency = default_latency
+        # A latency of zero would make outstanding messages irrelevant.
+        latency = max(latency, self.MIN_LATENCY)
+        return (self.outstanding[transport_name] + 1) * latency
+
+    def next_transport_name(self):
+        self.expire_outstanding()
+        latencies = [l for l in self.latency.values() if l is not None]
+        if latencies:
+            # Transports we know nothing about are assumed to be average.
+            default_latency = sum(latencies) / len(latencies)
+        else:
+            default_latency = 1.0
+        # We start at a different transport each time so that ties are
+        # broken round-robin.
+        names = self.transport_names
+        start = self._next_start
+        self._next_start = (start + 1) % len(names)
+        candidates = names[start:] + names[:start]
+        return min(candidates, key=lambda name: self.score(
+            name, default_latency))
+
+    def message_sent(self, transport_name, msg):
+        message_id = msg['message_id']
+        if transport_name not in self.outstanding:
+            return
+        if message_id in self.in_flight:
+            # Already outstanding, so it doesn't count twice.
+            return
+        sent_at = self.clock.seconds()
+        self.in_flight[message_id] = (transport_name, sent_at)
+        self._sent_order.append((message_id, sent_at))
+        self.outstanding[transport_name] += 1
+
+    def event_received(self, msg):
+        if msg['event_type'] not in ('ack', 'nack'):
+            return
+        sent = self.in_flight.pop(msg['user_message_id'], None)
+        if sent is None:
+            return
+        transport_name, sent_at = sent
+        self.outstanding[transport_name] -= 1
+        if msg['event_type'] == 'ack':
+            self.record_latency(transport_name, self.clock.seconds() - sent_at)
+
+    def record_latency(self, transport_name, latency):
+        average = self.latency[transport_name]
+        if average is None:
+            self.latency[transport_name] = latency
+        else:
+            self.latency[transport_name] = (
+                self.latency_smoothing * latency +
+                (1 - self.latency_smoothing) * average)
+
+
 class LoadBalancingRouter(BaseDispatchRouter):
-    """Router that does round-robin dispatching to transports.
+    """Router that load balances dispatching to transports.
 
     Supports only one exposed name and requires at least one transport
     name.
@@ -19,13 +184,27 @@ class LoadBalancingRouter(BaseDispatchRouter):
 
     :param bool reply_affinity:
         If set to true, replies are sent back to the same transport
-        they were sent from. If false, replies are round-robinned in
+        they were sent from. If false, replies are load balanced in
         the same way other outbound messages are. Default: true.
     :param bool rewrite_transport_name:
         If set to true, rewrites message `transport_names` in both
         directions. Default: true.
+    :param str strategy:
+        How to pick a transport for each outbound message. One of
+        `round_robin`, `weighted_round_robin` (see
+        :class:`WeightedRoundRobinStrategy`) or `least_outstanding` (see
+        :class:`LeastOutstandingStrategy`). Strategy options are given in
+        the router config. Default: `round_robin`.
     """
 
+    STRATEGIES = {
+        'round_robin': RoundRobinStrategy,
+        'weighted_round_robin': WeightedRoundRobinStrategy,
+        'least_outstanding': LeastOutstandingStrategy,
+    }
+
+    clock = reactor
+
     def setup_routing(self):
         self.reply_affinity = self.config.get('reply_affinity', True)
         self.rewrite_transport_names = self.config.get(
@@ -37,8 +216,11 @@ class LoadBalancingRouter(BaseDispatchRouter):
         if not self.dispatcher.transport_names:
             raise ConfigError("At least one transport name is needed for %s" %
                               (type(self).__name__,))
-        self.transport_name_cycle = itertools.cycle(
-            self.dispatcher.transport_names)
+        strategy = self.config.get('strategy', 'round_robin')
+        if strategy not in self.STRATEGIES:
+            raise ConfigError("Unknown load balancing strategy %r for %s." %
+                              (strategy, type(self).__name__))
+        self.strategy = self.STRATEGIES[strategy](self, self.config)
         self.transport_name_set = set(self.dispatcher.transport_names)
 
     def push_transport_name(self, msg, transport_name):
@@ -65,6 +247,7 @@ class LoadBalancingRouter(BaseDispatchRouter):
         self.dispatcher.publish_inbound_message(self.exposed_name, msg)
 
     def dispatch_inbound_event(self, msg):
+        self.strategy.event_received(msg)
         if self.rewrite_transport_names:
             msg['transport_name'] = self.exposed_name
         self.dispatcher.publish_inbound_event(self.exposed_name, msg)
@@ -75,11 +258,12 @@ class LoadBalancingRouter(BaseDispatchRouter):
             if transport_name not in self.transport_name_set:
                 log.warning("LoadBalancer is configured for reply affinity but"
                             " reply for unknown load balancer endpoint %r was"
-                            " was received. Using round-robin routing instead."
-                            % (transport_name,))
-                transport_name = self.transport_name_cycle.next()
+                            " was received. Using load balanced routing"
+                            " instead." % (transport_name,))
+                transport_name = self.strategy.next_transport_name()
         else:
-            transport_name = self.transport_name_cycle.next()
+            transport_name = self.strategy.next_transport_name()
+        self.strategy.message_sent(transport_name, msg)
         if self.rewrite_transport_names:
             msg['transport_name'] = transport_name
         self.dispatcher.publish_outbound_message(transport_name, msg)
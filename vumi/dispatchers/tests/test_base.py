@@ -1,9 +1,10 @@
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 
 from vumi.dispatchers.base import (
-    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter)
+    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter,
+    KeywordRoutingTable)
 from vumi.dispatchers.tests.helpers import DispatcherHelper, DummyDispatcher
-from vumi.errors import DispatcherError
+from vumi.errors import DispatcherError, ConfigError
 from vumi.tests.utils import LogCatcher
 from vumi.tests.helpers import VumiTestCase, MessageHelper
 
@@ -396,6 +397,7 @@ class TestUserGroupingRouter(VumiTestCase):
         })
         self.router = self.dispatcher._router
         yield self.router._redis_d
+        yield self.router._group_cache_warmup_d
         self.redis = self.router.redis
         yield self.redis._purge_all()  # just in case
 
@@ -422,6 +424,115 @@ class TestUserGroupingRouter(VumiTestCase):
             'group2',
         ])
 
+    @inlineCallbacks
+    def test_group_assignment_cached(self):
+        group = yield self.router.get_group_for_user('user1')
+        self.assertEqual(self.router.group_cache_stats,
+                         {'hits': 0, 'misses': 1})
+        # Returning users are served from the cache, even if Redis goes away.
+        yield self.redis.delete('user:user1')
+        self.assertEqual((yield self.router.get_group_for_user('user1')),
+                         group)
+        self.assertEqual(self.router.group_cache_stats,
+                         {'hits': 1, 'misses': 1})
+        self.assertEqual(self.router.group_cache_hit_rate(), 0.5)
+
+    @inlineCallbacks
+    def test_group_assignment_from_redis(self):
+        yield self.redis.set('user:user1', 'group2')
+        self.assertEqual(
+            (yield self.router.get_group_for_user('user1')), 'group2')
+        self.assertEqual(self.router.group_cache.get('user1'), 'group2')
+
+    @inlineCallbacks
+    def test_group_assignment_race(self):
+        # Another dispatcher assigns a group between our lookup and our write.
+        orig_get_next_group = self.router.get_next_group
+
+        @inlineCallbacks
+        def get_next_group():
+            group = yield orig_get_next_group()
+            yield self.redis.set('user:user1', 'group2')
+            returnValue(group)
+
+        self.router.get_next_group = get_next_group
+        self.assertEqual(
+            (yield self.router.get_group_for_user('user1')), 'group2')
+
+    def test_group_cache_hit_rate_no_lookups(self):
+        self.assertEqual(self.router.group_cache_hit_rate(), 0.0)
+
+    @inlineCallbacks
+    def test_warm_group_cache(self):
+        yield self.redis.set('user:user1', 'group1')
+        yield self.redis.set('user:user2', 'group2')
+        yield self.redis.set('round-robin', '2')
+        yield self.router.warm_group_cache()
+        self.assertEqual(len(self.router.group_cache), 2)
+        self.assertEqual(self.router.group_cache.get('user1'), 'group1')
+        self.assertEqual(self.router.group_cache.get('user2'), 'group2')
+
+    @inlineCallbacks
+    def test_warm_group_cache_stops_when_full(self):
+        self.router.group_cache.max_size = 3
+        for i in range(10):
+            yield self.redis.set('user:user%s' % (i,), 'group1')
+        yield self.router.warm_group_cache()
+        self.assertEqual(len(self.router.group_cache), 3)
+
+    @inlineCallbacks
+    def test_warm_group_cache_max_scans(self):
+        self.router.group_cache_warmup_max_scans = 1
+        for i in range(25):
+            yield self.redis.set('user:user%s' % (i,), 'group1')
+        yield self.router.warm_group_cache()
+        self.assertTrue(0 < len(self.router.group_cache) < 25)
+
+    def test_group_cache_warmup_disabled_by_default(self):
+        self.assertEqual(self.router._group_cache_warmup_d, None)
+
+    @inlineCallbacks
+    def test_group_cache_hit_rate_metric(self):
+        config = self.dispatcher.config.copy()
+        config['group_cache_metrics_prefix'] = 'vumi.test.'
+        dispatcher = yield self.disp_helper.get_dispatcher(config)
+        router = dispatcher._router
+        yield router._redis_d
+        yield router.get_group_for_user('user1')
+        yield router.get_group_for_user('user1')
+        hit_rate = router.metrics['group_cache.hit_rate']
+        self.assertEqual([v for _, v in hit_rate.poll()], [0.0, 0.5])
+
+    @inlineCallbacks
+    def test_warm_group_cache_does_not_block_routing(self):
+        scan_d = Deferred()
+        self.redis.scan = lambda cursor, match=None: scan_d
+        self.router._start_group_cache_warmup(None)
+        msg = self.make_inbound_from('from_1')
+        yield self.disp_helper.dispatch_inbound(msg, 'transport1')
+        self.assertEqual(self.disp_helper.get_dispatched_inbound('app1'),
+                         [msg])
+        self.assertFalse(self.router._group_cache_warmup_d.called)
+        scan_d.callback((None, []))
+        yield self.router._group_cache_warmup_d
+
+    @inlineCallbacks
+    def test_warm_group_cache_failure_logged(self):
+        def scan(cursor, match=None):
+            raise ValueError("Redis went away")
+        self.redis.scan = scan
+        with LogCatcher() as lc:
+            self.router._start_group_cache_warmup(None)
+            yield self.router._group_cache_warmup_d
+        [err] = lc.errors
+        self.assertEqual(
+            err['why'], "Error warming UserGroupingRouter group cache")
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        msg = self.make_inbound_from('from_1')
+        yield self.disp_helper.dispatch_inbound(msg, 'transport1')
+        self.assertEqual(self.disp_helper.get_dispatched_inbound('app1'),
+                         [msg])
+
     def make_inbound_from(self, from_addr):
         return self.disp_helper.make_inbound("foo", from_addr=from_addr)
 
@@ -531,6 +642,29 @@ class TestContentKeywordRouter(VumiTestCase):
             'keyword1 rest of msg', to_addr='8181', from_addr='+256788601462')
         self.assert_dispatched('app1', [msg])
 
+    @inlineCallbacks
+    def test_inbound_message_routing_prefix_mismatch(self):
+        msg = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8181', from_addr='+255788601462')
+        self.assert_dispatched('app1', [])
+        self.assert_dispatched('app3', [msg])
+
+    @inlineCallbacks
+    def test_load_rules(self):
+        self.router.load_rules([{'app': 'app1', 'keyword': 'NEW'}], {})
+        msg1 = yield self.send_inbound('new rest of msg')
+        msg2 = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8181', from_addr='+256788601462')
+        self.assert_dispatched('app1', [msg1])
+        self.assert_dispatched('app3', [])
+        self.assert_dispatched('fallback_app', [msg2])
+
+    def test_load_rules_invalid(self):
+        routing_table = self.router.routing_table
+        self.assertRaises(
+            ConfigError, self.router.load_rules, [{'app': 'app1'}], {})
+        self.assertTrue(self.router.routing_table is routing_table)
+
     @inlineCallbacks
     def test_inbound_event_routing_ok(self):
         yield self.router.session_manager.create_session(
@@ -574,6 +708,53 @@ class TestContentKeywordRouter(VumiTestCase):
         self.assertEqual(session['name'], 'app2')
 
 
+class TestKeywordRoutingTable(VumiTestCase):
+
+    def test_lookup_keyword(self):
+        table = KeywordRoutingTable([
+            {'app': 'app1', 'keyword': 'foo'},
+            {'app': 'app2', 'keyword': 'bar'},
+        ])
+        self.assertEqual(table.lookup('foo', '123', '456'), ['app1'])
+        self.assertEqual(table.lookup('bar', '123', '456'), ['app2'])
+        self.assertEqual(table.lookup('baz', '123', '456'), [])
+
+    def test_lookup_to_addr(self):
+        table = KeywordRoutingTable([
+            {'app': 'app1', 'keyword': 'foo', 'to_addr': '123'},
+            {'app': 'app2', 'keyword': 'foo', 'to_addr': None},
+        ])
+        self.assertEqual(table.lookup('foo', '123', '456'), ['app1'])
+        self.assertEqual(table.lookup('foo', None, '456'), ['app2'])
+        self.assertEqual(table.lookup('foo', '789', '456'), [])
+
+    def test_lookup_prefix(self):
+        table = KeywordRoutingTable([
+            {'app': 'app1', 'keyword': 'foo', 'prefix': '+27'},
+            {'app': 'app2', 'keyword': 'foo', 'prefix': '+2782'},
+            {'app': 'app3', 'keyword': 'foo', 'prefix': '+256'},
+        ])
+        self.assertEqual(
+            table.lookup('foo', '123', '+27821234567'), ['app1', 'app2'])
+        self.assertEqual(table.lookup('foo', '123', '+27721234567'), ['app1'])
+        self.assertEqual(table.lookup('foo', '123', '+2'), [])
+        self.assertEqual(table.lookup('foo', '123', None), [])
+
+    def test_lookup_rule_order(self):
+        table = KeywordRoutingTable([
+            {'app': 'app1', 'keyword': 'foo', 'to_addr': '123',
+             'prefix': '+27'},
+            {'app': 'app2', 'keyword': 'foo'},
+            {'app': 'app3', 'keyword': 'foo', 'prefix': '+27'},
+            {'app': 'app4', 'keyword': 'foo', 'to_addr': '123'},
+        ])
+        self.assertEqual(
+            table.lookup('foo', '123', '+27821234567'),
+            ['app1', 'app2', 'app3', 'app4'])
+        self.assertEqual(
+            table.lookup('foo', '456', '+27821234567'), ['app2', 'app3'])
+
+
 class TestRedirectOutboundRouterForSMPP(VumiTestCase):
     """
     This is a test to cover our use case when using SMPP 3.4 with
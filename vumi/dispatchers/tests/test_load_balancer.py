@@ -1,8 +1,10 @@
 """Tests for vumi.dispatchers.load_balancer."""
 
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
 
 from vumi.dispatchers.load_balancer import LoadBalancingRouter
+from vumi.errors import ConfigError
 from vumi.dispatchers.tests.helpers import DummyDispatcher
 from vumi.tests.helpers import VumiTestCase, MessageHelper
 from vumi.tests.utils import LogCatcher
@@ -12,14 +14,13 @@ class BaseLoadBalancingTestCase(VumiTestCase):
 
     reply_affinity = None
     rewrite_transport_names = None
+    transport_names = ["transport_1", "transport_2"]
+    strategy_config = {}
 
     @inlineCallbacks
     def setUp(self):
         config = {
-            "transport_names": [
-                "transport_1",
-                "transport_2",
-            ],
+            "transport_names": self.transport_names,
             "exposed_names": ["round_robin"],
             "router_class": ("vumi.dispatchers.load_balancer."
                              "LoadBalancingRouter"),
@@ -28,6 +29,8 @@ class BaseLoadBalancingTestCase(VumiTestCase):
             config['reply_affinity'] = self.reply_affinity
         if self.rewrite_transport_names is not None:
             config['rewrite_transport_names'] = self.rewrite_transport_names
+        config.update(self.strategy_config)
+        self.config = config
         self.dispatcher = DummyDispatcher(config)
         self.router = LoadBalancingRouter(self.dispatcher, config)
         self.add_cleanup(self.router.teardown_routing)
@@ -167,3 +170,172 @@ class TestLoadBalancingWithoutRewriteTransportNames(BaseLoadBalancingTestCase):
         self.router.dispatch_outbound_message(msg1)
         [new_msg] = self.dispatcher.transport_publisher['transport_1'].msgs
         self.assertEqual(new_msg['transport_name'], 'round_robin')
+
+
+class TestLoadBalancingStrategyConfig(BaseLoadBalancingTestCase):
+
+    def test_default_strategy(self):
+        self.assertEqual(
+            type(self.router.strategy).__name__, 'RoundRobinStrategy')
+
+    def test_unknown_strategy(self):
+        config = dict(self.config, strategy='random')
+        router = LoadBalancingRouter(self.dispatcher, config)
+        self.assertRaises(ConfigError, router.setup_routing)
+
+    def test_invalid_weight(self):
+        config = dict(self.config, strategy='weighted_round_robin',
+                      transport_weights={'transport_1': 0})
+        router = LoadBalancingRouter(self.dispatcher, config)
+        self.assertRaises(ConfigError, router.setup_routing)
+
+
+class TestWeightedRoundRobin(BaseLoadBalancingTestCase):
+
+    reply_affinity = False
+    transport_names = ["transport_1", "transport_2", "transport_3"]
+    strategy_config = {
+        'strategy': 'weighted_round_robin',
+        'transport_weights': {'transport_1': 3, 'transport_3': 2},
+    }
+
+    def test_outbound_message_routing(self):
+        names = [self.router.strategy.next_transport_name()
+                 for _ in range(12)]
+        self.assertEqual(names[:6], [
+            'transport_1', 'transport_3', 'transport_1', 'transport_2',
+            'transport_3', 'transport_1',
+        ])
+        self.assertEqual(names[6:], names[:6])
+
+    def test_outbound_message_publishing(self):
+        msgs = [self.msg_helper.make_outbound('msg %s' % (i,))
+                for i in range(6)]
+        for msg in msgs:
+            self.router.dispatch_outbound_message(msg)
+        publishers = self.dispatcher.transport_publisher
+        self.assertEqual(len(publishers['transport_1'].msgs), 3)
+        self.assertEqual(len(publishers['transport_2'].msgs), 1)
+        self.assertEqual(len(publishers['transport_3'].msgs), 2)
+
+
+class TestLeastOutstanding(BaseLoadBalancingTestCase):
+
+    reply_affinity = False
+    strategy_config = {
+        'strategy': 'least_outstanding',
+        'outstanding_timeout': 30,
+        'latency_smoothing': 0.5,
+    }
+
+    def setUp(self):
+        d = super(TestLeastOutstanding, self).setUp()
+        self.clock = Clock()
+        d.addCallback(lambda _: setattr(
+            self.router.strategy, 'clock', self.clock))
+        return d
+
+    def send(self, n=1):
+        msgs = []
+        for i in range(n):
+            msg = self.msg_helper.make_outbound('msg')
+            self.router.dispatch_outbound_message(msg)
+            msgs.append(msg)
+        return msgs
+
+    def published(self, transport_name):
+        return self.dispatcher.transport_publisher[transport_name].msgs
+
+    def ack(self, msg):
+        self.router.dispatch_inbound_event(self.msg_helper.make_ack(
+            msg, transport_name=msg['transport_name']))
+
+    def nack(self, msg):
+        self.router.dispatch_inbound_event(self.msg_helper.make_nack(
+            msg, transport_name=msg['transport_name']))
+
+    def test_round_robin_without_events(self):
+        msg1, msg2, msg3 = self.send(3)
+        self.assertEqual(self.published('transport_1'), [msg1, msg3])
+        self.assertEqual(self.published('transport_2'), [msg2])
+
+    def test_outstanding_counts(self):
+        msg1, msg2 = self.send(2)
+        strategy = self.router.strategy
+        self.assertEqual(strategy.outstanding,
+                         {'transport_1': 1, 'transport_2': 1})
+        self.ack(msg1)
+        self.nack(msg2)
+        self.assertEqual(strategy.outstanding,
+                         {'transport_1': 0, 'transport_2': 0})
+        # Only acks are used to measure latency.
+        self.assertEqual(strategy.latency,
+                         {'transport_1': 0, 'transport_2': None})
+
+    def test_avoids_transport_with_outstanding_messages(self):
+        msg1, msg2 = self.send(2)
+        # transport_2 acks, transport_1 doesn't.
+        self.ack(msg2)
+        [msg3] = self.send()
+        self.assertEqual(self.published('transport_2'), [msg2, msg3])
+
+    def test_avoids_slow_transport(self):
+        msg1, msg2 = self.send(2)
+        self.clock.advance(1)
+        self.ack(msg2)
+        self.clock.advance(9)
+        self.ack(msg1)
+        strategy = self.router.strategy
+        self.assertEqual(strategy.latency,
+                         {'transport_1': 10, 'transport_2': 1})
+        # With nothing outstanding, the faster transport gets messages until
+        # its backlog outweighs the latency difference.
+        msgs = self.send(9)
+        self.assertEqual(self.published('transport_2'), [msg2] + msgs)
+        self.send(2)
+        self.assertEqual(len(self.published('transport_1')), 2)
+        self.assertEqual(len(self.published('transport_2')), 11)
+
+    def test_latency_smoothing(self):
+        [msg] = self.send()
+        self.clock.advance(4)
+        self.ack(msg)
+        self.send()
+        [msg] = self.send()
+        self.assertEqual(msg['transport_name'], 'transport_1')
+        self.clock.advance(2)
+        self.ack(msg)
+        self.assertEqual(self.router.strategy.latency['transport_1'], 3)
+
+    def test_outstanding_timeout(self):
+        self.send(2)
+        self.clock.advance(31)
+        self.send()
+        self.assertEqual(self.router.strategy.outstanding,
+                         {'transport_1': 1, 'transport_2': 0})
+        self.assertEqual(len(self.router.strategy.in_flight), 1)
+
+    def test_outstanding_timeout_after_ack(self):
+        msg1, msg2 = self.send(2)
+        self.ack(msg1)
+        self.clock.advance(31)
+        self.router.strategy.expire_outstanding()
+        self.assertEqual(self.router.strategy.outstanding,
+                         {'transport_1': 0, 'transport_2': 0})
+        self.assertEqual(self.router.strategy.in_flight, {})
+
+    def test_message_sent_twice(self):
+        [msg] = self.send()
+        strategy = self.router.strategy
+        strategy.message_sent('transport_1', msg)
+        self.assertEqual(strategy.outstanding,
+                         {'transport_1': 1, 'transport_2': 0})
+        self.ack(msg)
+        self.assertEqual(strategy.outstanding,
+                         {'transport_1': 0, 'transport_2': 0})
+
+    def test_unknown_event(self):
+        self.router.dispatch_inbound_event(
+            self.msg_helper.make_ack(transport_name='transport_1'))
+        self.assertEqual(self.router.strategy.outstanding,
+                         {'transport_1': 0, 'transport_2': 0})
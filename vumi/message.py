@@ -8,6 +8,12 @@ from errors import MissingMessageField, InvalidMessageField
 
 from vumi.utils import to_kwargs
 
+try:
+    # This is optional, but it decodes JSON faster than the standard library.
+    import ujson
+except ImportError:
+    ujson = None
+
 
 # This is the date format we work with internally
 VUMI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
@@ -55,6 +61,24 @@ def date_time_decoder(json_object):
     return json_object
 
 
+def copy_payload_value(value):
+    """
+    Return a deep copy of a message payload value.
+
+    This copies the nested dicts and lists that make up a message payload
+    without serialising them. Values of other types are assumed to be
+    immutable and are shared with the original.
+    """
+    if isinstance(value, dict):
+        return dict(
+            (k, copy_payload_value(v)) for k, v in dict.iteritems(value))
+    if isinstance(value, list):
+        return [copy_payload_value(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(copy_payload_value(v) for v in value)
+    return value
+
+
 class JSONMessageEncoder(json.JSONEncoder):
     """A JSON encoder that is able to serialize datetime"""
     def default(self, obj):
@@ -84,6 +108,9 @@ class Message(object):
     # name of the special attribute that isn't stored by the message store
     _CACHE_ATTRIBUTE = "__cache__"
 
+    # top-level fields that hold timestamps, used by SchemaMessageCodec
+    TIMESTAMP_FIELDS = ()
+
     def __init__(self, _process_fields=True, **kwargs):
         if _process_fields:
             kwargs = self.process_fields(kwargs)
@@ -140,7 +167,12 @@ class Message(object):
         return self.payload.items()
 
     def copy(self):
-        return self.from_json(self.to_json())
+        """
+        Return a deep copy of this message.
+        """
+        return type(self)(
+            _process_fields=False,
+            **to_kwargs(copy_payload_value(self.payload)))
 
     @property
     def cache(self):
@@ -157,6 +189,7 @@ class TransportMessage(Message):
     MESSAGE_TYPE = None
     MESSAGE_VERSION = '20110921'
     DEFAULT_ENDPOINT_NAME = 'default'
+    TIMESTAMP_FIELDS = ('timestamp',)
 
     @staticmethod
     def generate_id():
@@ -429,3 +462,50 @@ class TransportEvent(TransportMessage):
             self.assert_field_present(extra_field)
             if not check(self[extra_field]):
                 raise InvalidMessageField(extra_field)
+
+
+class JSONMessageCodec(object):
+    """
+    Encodes messages as JSON using :meth:`Message.to_json` and decodes them
+    using :meth:`Message.from_json`.
+
+    When decoding, every string in the message that looks like a timestamp is
+    turned into a :class:`datetime`.
+    """
+
+    def encode(self, message):
+        return message.to_json()
+
+    def decode(self, data, message_class=Message):
+        return message_class.from_json(data)
+
+
+class SchemaMessageCodec(object):
+    """
+    Encodes and decodes messages as JSON, only treating the fields listed
+    in the message class's ``TIMESTAMP_FIELDS`` as timestamps.
+
+    This avoids trying to parse every string in a message as a timestamp,
+    but other timestamps in a message are decoded as strings. If ``ujson`` is
+    installed and ``use_ujson`` is ``True``, it is used for decoding.
+    """
+
+    def __init__(self, use_ujson=True):
+        if use_ujson and ujson is not None:
+            self.loads = ujson.loads
+        else:
+            self.loads = json.loads
+
+    def encode(self, message):
+        return to_json(message.payload)
+
+    def decode(self, data, message_class=Message):
+        payload = self.loads(data)
+        for field in message_class.TIMESTAMP_FIELDS:
+            value = payload.get(field)
+            if isinstance(value, basestring):
+                try:
+                    payload[field] = parse_vumi_date(value)
+                except ValueError:
+                    pass
+        return message_class(_process_fields=False, **to_kwargs(payload))
@@ -1,7 +1,8 @@
 # -*- test-case-name: vumi.middleware.tests.test_base -*-
 from confmodel import Config
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed, fail)
 
 from vumi.utils import load_class_by_string
 from vumi.errors import ConfigError, VumiError
@@ -191,6 +192,9 @@ class MiddlewareStack(object):
             middlewares, 'consume_priority')
         self.publish_middlewares = self._sort_by_priority(
             reversed(middlewares), 'publish_priority')
+        # Compiled handler lists, keyed by the full handler name (e.g.
+        # 'consume_inbound').
+        self._handlers = {}
 
     @staticmethod
     def _sort_by_priority(middlewares, priority_key):
@@ -198,17 +202,70 @@ class MiddlewareStack(object):
         # order within priority levels.
         return sorted(middlewares, key=lambda mw: getattr(mw, priority_key))
 
-    @inlineCallbacks
-    def _handle(self, middlewares, handler_name, message, connector_name):
+    @staticmethod
+    def _is_passthrough(middleware, handler_name):
+        """
+        Return ``True`` if the middleware uses :class:`BaseMiddleware`'s
+        implementation of both ``handle_<handler_name>`` and the generic
+        handler it calls, which just return the message.
+        """
+        generic_name = handler_name.split('_', 1)[-1]
+        for method_name in set(['handle_%s' % (handler_name,),
+                                'handle_%s' % (generic_name,)]):
+            if method_name in vars(middleware):
+                return False
+            base_method = getattr(BaseMiddleware, method_name, None)
+            method = getattr(type(middleware), method_name, None)
+            if base_method is None or method is None:
+                return False
+            if method.im_func is not base_method.im_func:
+                return False
+        return True
+
+    def _compile_handlers(self, middlewares, handler_name):
         method_name = 'handle_%s' % (handler_name,)
-        for middleware in middlewares:
-            handler = getattr(middleware, method_name)
-            message = yield handler(message, connector_name)
-            if message is None:
-                raise MiddlewareError(
-                    'Returned value of %s.%s should never be None' % (
-                        middleware, method_name,))
-        returnValue(message)
+        return [
+            (middleware, method_name, getattr(middleware, method_name))
+            for middleware in middlewares
+            if not self._is_passthrough(middleware, handler_name)]
+
+    def _get_handlers(self, middlewares, handler_name):
+        handlers = self._handlers.get(handler_name)
+        if handlers is None:
+            handlers = self._compile_handlers(middlewares, handler_name)
+            self._handlers[handler_name] = handlers
+        return handlers
+
+    def _handle(self, middlewares, handler_name, message, connector_name):
+        handlers = self._get_handlers(middlewares, handler_name)
+        return self._run_handlers(handlers, 0, message, connector_name)
+
+    def _run_handlers(self, handlers, start, message, connector_name):
+        # Handlers are called synchronously until one returns a Deferred,
+        # after which the rest are called when it fires.
+        try:
+            for i in xrange(start, len(handlers)):
+                middleware, method_name, handler = handlers[i]
+                message = handler(message, connector_name)
+                if isinstance(message, Deferred):
+                    message.addCallback(
+                        self._handler_done, handlers, i, connector_name)
+                    return message
+                self._check_result(message, middleware, method_name)
+        except Exception:
+            return fail()
+        return succeed(message)
+
+    def _handler_done(self, message, handlers, i, connector_name):
+        middleware, method_name, _ = handlers[i]
+        self._check_result(message, middleware, method_name)
+        return self._run_handlers(handlers, i + 1, message, connector_name)
+
+    def _check_result(self, message, middleware, method_name):
+        if message is None:
+            raise MiddlewareError(
+                'Returned value of %s.%s should never be None' % (
+                    middleware, method_name,))
 
     def apply_consume(self, handler_name, message, connector_name):
         handler_name = 'consume_%s' % (handler_name,)
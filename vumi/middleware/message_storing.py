@@ -1,12 +1,16 @@
 # -*- test-case-name: vumi.middleware.tests.test_message_storing -*-
 
-from confmodel.fields import ConfigBool, ConfigDict, ConfigText
+from confmodel.fields import (
+    ConfigBool, ConfigDict, ConfigText, ConfigInt, ConfigFloat)
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+from vumi import log
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.middleware.base import BaseMiddleware, BaseMiddlewareConfig
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.components.message_store import MessageStore
+from vumi.components.message_store_writer import MessageStoreWriter
 from vumi.config import ConfigRiak
 from vumi.persist.txriak_manager import TxRiakManager
 from vumi.persist.txredis_manager import TxRedisManager
@@ -28,6 +32,26 @@ class StoringMiddlewareConfig(BaseMiddlewareConfig):
         "``True`` to store consumed messages as well as published ones, "
         "``False`` to store only published messages.", default=True,
         static=True)
+    write_behind = ConfigBool(
+        "``True`` to queue messages and store them in the background instead"
+        " of waiting for them to be stored.", default=False, static=True)
+    write_behind_max_size = ConfigInt(
+        "Maximum number of messages to queue when ``write_behind`` is set."
+        " The worker's connectors are paused while the queue is full.",
+        default=1000, static=True)
+    write_behind_batch_size = ConfigInt(
+        "Maximum number of queued messages to store in a batch.",
+        default=50, static=True)
+    write_behind_concurrency = ConfigInt(
+        "Maximum number of batches to store at once.",
+        default=4, static=True)
+    write_behind_max_latency = ConfigFloat(
+        "Maximum number of seconds to wait for a full batch.",
+        default=0.5, static=True)
+    write_behind_metrics_prefix = ConfigText(
+        "Prefix for write-behind queue depth and flush latency metrics. If"
+        " unset, these metrics are not published.",
+        default=None, static=True)
 
 
 class StoringMiddleware(BaseMiddleware):
@@ -45,6 +69,11 @@ class StoringMiddleware(BaseMiddleware):
     application worker or middleware such as
     :class:`vumi.middleware.TaggingMiddleware`).
 
+    Published messages and events are expected to be new, so they are
+    stored without first loading any existing record. Consumed ones may
+    already have been stored by the worker that published them and are
+    merged into the existing record.
+
     Configuration options:
 
     :param string store_prefix:
@@ -59,10 +88,19 @@ class StoringMiddleware(BaseMiddleware):
         ``True`` to store consumed messages as well as published ones,
         ``False`` to store only published messages.
         Default is ``True``.
+    :param bool write_behind:
+        ``True`` to queue messages and store them in the background
+        (see :class:`vumi.components.message_store_writer.MessageStoreWriter`)
+        instead of waiting for them to be stored. Messages are passed on
+        as soon as they're queued, so a crash may lose queued messages.
+        Default is ``False``.
     """
 
     CONFIG_CLASS = StoringMiddlewareConfig
 
+    writer = None
+    metrics = None
+
     @inlineCallbacks
     def setup_middleware(self):
         store_prefix = self.config.store_prefix
@@ -72,20 +110,96 @@ class StoringMiddleware(BaseMiddleware):
         self.store = MessageStore(manager,
                                   self.redis.sub_manager(store_prefix))
         self.store_on_consume = self.config.store_on_consume
+        if self.config.write_behind:
+            yield self.setup_writer()
+
+    @inlineCallbacks
+    def setup_writer(self):
+        if self.config.write_behind_metrics_prefix is not None:
+            self.metrics = yield self.worker.start_publisher(
+                MetricManager, self.config.write_behind_metrics_prefix)
+        self._paused_connectors = []
+        self.writer = MessageStoreWriter(
+            self.store, max_size=self.config.write_behind_max_size,
+            batch_size=self.config.write_behind_batch_size,
+            concurrency=self.config.write_behind_concurrency,
+            max_latency=self.config.write_behind_max_latency,
+            metrics=self.metrics, pause_callback=self.pause_connectors,
+            unpause_callback=self.unpause_connectors)
 
     @inlineCallbacks
     def teardown_middleware(self):
+        if self.writer is not None:
+            yield self.writer.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
         yield self.redis.close_manager()
 
+    def pause_connectors(self):
+        """
+        Pause the worker's connectors while the write-behind queue is full.
+
+        Connectors that are already paused are left alone, so we don't
+        unpause them when the queue drains.
+        """
+        connectors = getattr(self.worker, 'connectors', {})
+        self._paused_connectors = [
+            connector for connector in connectors.itervalues()
+            if not connector.paused]
+        log.warning("Message store write-behind queue full, pausing %d"
+                    " connectors." % (len(self._paused_connectors),))
+        for connector in self._paused_connectors:
+            # We don't wait for this, because the connector only finishes
+            # pausing once the messages waiting on us have been processed.
+            connector.pause().addErrback(log.err)
+
+    def unpause_connectors(self):
+        """
+        Unpause the connectors paused by :meth:`pause_connectors`.
+
+        If the worker has paused its connectors itself in the meantime, they
+        are left paused for the worker to unpause.
+        """
+        paused, self._paused_connectors = self._paused_connectors, []
+        if getattr(self.worker, 'connectors_paused', False):
+            log.info("Message store write-behind queue drained, but the"
+                     " worker has paused its connectors. Leaving them"
+                     " paused.")
+            return
+        for connector in paused:
+            connector.unpause()
+
+    def add_inbound_message(self, message, tag, is_new=False):
+        if self.writer is not None:
+            return self.writer.add_inbound_message(
+                message, tag=tag, is_new=is_new)
+        return self.store.add_inbound_message(
+            message, tag=tag, is_new=is_new)
+
+    def add_outbound_message(self, message, tag, is_new=False):
+        if self.writer is not None:
+            return self.writer.add_outbound_message(
+                message, tag=tag, is_new=is_new)
+        return self.store.add_outbound_message(
+            message, tag=tag, is_new=is_new)
+
+    def add_event(self, event, is_new=False):
+        if self.writer is not None:
+            return self.writer.add_event(event, is_new=is_new)
+        return self.store.add_event(event, is_new=is_new)
+
     def handle_consume_inbound(self, message, connector_name):
         if not self.store_on_consume:
             return message
         return self.handle_inbound(message, connector_name)
 
+    def handle_publish_inbound(self, message, connector_name):
+        return self.handle_inbound(message, connector_name, is_new=True)
+
     @inlineCallbacks
-    def handle_inbound(self, message, connector_name):
+    def handle_inbound(self, message, connector_name, is_new=False):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_inbound_message(message, tag=tag)
+        yield self.add_inbound_message(message, tag, is_new=is_new)
         returnValue(message)
 
     def handle_consume_outbound(self, message, connector_name):
@@ -93,10 +207,13 @@ class StoringMiddleware(BaseMiddleware):
             return message
         return self.handle_outbound(message, connector_name)
 
+    def handle_publish_outbound(self, message, connector_name):
+        return self.handle_outbound(message, connector_name, is_new=True)
+
     @inlineCallbacks
-    def handle_outbound(self, message, connector_name):
+    def handle_outbound(self, message, connector_name, is_new=False):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_outbound_message(message, tag=tag)
+        yield self.add_outbound_message(message, tag, is_new=is_new)
         returnValue(message)
 
     def handle_consume_event(self, event, connector_name):
@@ -104,8 +221,11 @@ class StoringMiddleware(BaseMiddleware):
             return event
         return self.handle_event(event, connector_name)
 
+    def handle_publish_event(self, event, connector_name):
+        return self.handle_event(event, connector_name, is_new=True)
+
     @inlineCallbacks
-    def handle_event(self, event, connector_name):
+    def handle_event(self, event, connector_name, is_new=False):
         transport_metadata = event.get('transport_metadata', {})
         # FIXME: The SMPP transport writes a 'datetime' object
         #        in the 'date' of the transport_metadata.
@@ -114,5 +234,5 @@ class StoringMiddleware(BaseMiddleware):
             date = transport_metadata['date']
             if not isinstance(date, basestring):
                 transport_metadata['date'] = date.isoformat()
-        yield self.store.add_event(event)
+        yield self.add_event(event, is_new=is_new)
         returnValue(event)
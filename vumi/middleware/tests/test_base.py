@@ -2,11 +2,11 @@ import yaml
 import itertools
 
 from confmodel.fields import ConfigInt
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 
 from vumi.middleware.base import (
     BaseMiddleware, MiddlewareStack, create_middlewares_from_config,
-    setup_middlewares_from_config, BaseMiddlewareConfig)
+    setup_middlewares_from_config, BaseMiddlewareConfig, MiddlewareError)
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -81,6 +81,22 @@ class ToyAsymmetricMiddleware(ToyMiddleware):
         return self._handle('publish_failure', message, connector_name)
 
 
+class ToyAsyncMiddleware(ToyMiddleware):
+
+    def _handle(self, direction, message, connector_name):
+        self.worker.processed(self.name, direction, message, connector_name)
+        self.d = Deferred()
+        self.d.addCallback(lambda _: '%s.%s' % (message, self.name))
+        return self.d
+
+
+class ToyEventMiddleware(BaseMiddleware):
+
+    def handle_event(self, event, connector_name):
+        self.worker.processed(self.name, 'event', event, connector_name)
+        return event
+
+
 class TestMiddlewareStack(VumiTestCase):
 
     @inlineCallbacks
@@ -220,6 +236,72 @@ class TestMiddlewareStack(VumiTestCase):
             ('pasym', 'event', 'dummy_msg.pn.p1_2.p1_1.p2.pasym', 'end_foo'),
         ])
 
+    @inlineCallbacks
+    def test_passthrough_middlewares_skipped(self):
+        mw1 = yield self.mkmiddleware('mw1', ToyEventMiddleware)
+        mw2 = yield self.mkmiddleware('mw2', BaseMiddleware)
+        self.stack = MiddlewareStack([mw1, mw2])
+        msg = yield self.stack.apply_consume('inbound', 'dummy_msg', 'foo')
+        self.assertEqual(msg, 'dummy_msg')
+        self.assertEqual(self.stack._handlers['consume_inbound'], [])
+        yield self.stack.apply_consume('event', 'dummy_msg', 'foo')
+        self.assert_processed([('mw1', 'event', 'dummy_msg', 'foo')])
+        self.assertEqual(
+            self.stack._handlers['consume_event'],
+            [(mw1, 'handle_consume_event', mw1.handle_consume_event)])
+
+    @inlineCallbacks
+    def test_instance_handler_not_skipped(self):
+        mw = yield self.mkmiddleware('mw', BaseMiddleware)
+        mw.handle_inbound = lambda msg, connector_name: '%s.mw' % (msg,)
+        self.stack = MiddlewareStack([mw])
+        msg = yield self.stack.apply_consume('inbound', 'dummy_msg', 'foo')
+        self.assertEqual(msg, 'dummy_msg.mw')
+
+    def test_sync_handlers_fire_immediately(self):
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(
+            self.successResultOf(d), 'dummy_msg.mw1.mw2.mw3')
+
+    @inlineCallbacks
+    def test_async_handler(self):
+        mw_async = yield self.mkmiddleware('mwa', ToyAsyncMiddleware)
+        self.stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyMiddleware)),
+            mw_async,
+            (yield self.mkmiddleware('mw3', ToyMiddleware)),
+        ])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertNoResult(d)
+        self.assert_processed([
+            ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+            ('mwa', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+        ])
+        mw_async.d.callback(None)
+        self.assertEqual(
+            self.successResultOf(d), 'dummy_msg.mw1.mwa.mw3')
+        self.assertEqual(len(self.processed_messages), 3)
+
+    @inlineCallbacks
+    def test_handler_returns_none(self):
+        mw = yield self.mkmiddleware('mw', BaseMiddleware)
+        mw.handle_inbound = lambda msg, connector_name: None
+        self.stack = MiddlewareStack([mw])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'foo')
+        self.failureResultOf(d, MiddlewareError)
+
+    @inlineCallbacks
+    def test_handler_raises(self):
+        mw = yield self.mkmiddleware('mw', BaseMiddleware)
+
+        def handle_inbound(msg, connector_name):
+            raise ValueError("oops")
+
+        mw.handle_inbound = handle_inbound
+        self.stack = MiddlewareStack([mw])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'foo')
+        self.failureResultOf(d, ValueError)
+
 
 class TestUtilityFunctions(VumiTestCase):
 
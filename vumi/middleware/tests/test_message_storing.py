@@ -1,12 +1,30 @@
 """Tests for vumi.middleware.message_storing."""
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.message import TransportUserMessage, TransportEvent
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
 
+class DummyConnector(object):
+    def __init__(self, paused=False):
+        self.paused = paused
+
+    def pause(self):
+        self.paused = True
+        return succeed(None)
+
+    def unpause(self):
+        self.paused = False
+
+
+class DummyWorker(object):
+    def __init__(self, **connectors):
+        self.connectors = connectors
+        self.connectors_paused = False
+
+
 class TestStoringMiddleware(VumiTestCase):
 
     def setUp(self):
@@ -18,14 +36,15 @@ class TestStoringMiddleware(VumiTestCase):
         self.persistence_helper.get_riak_manager()
 
     @inlineCallbacks
-    def setup_middleware(self, config={}):
+    def setup_middleware(self, config={}, worker=None):
         # We've already skipped the test by now if we don't have riakasaurus,
         # so it's safe to import stuff that pulls it in without guards.
         from vumi.middleware.message_storing import StoringMiddleware
 
         config = self.persistence_helper.mk_config(config)
-        dummy_worker = object()
-        mw = StoringMiddleware("dummy_storer", config, dummy_worker)
+        if worker is None:
+            worker = object()
+        mw = StoringMiddleware("dummy_storer", config, worker)
         self.add_cleanup(mw.teardown_middleware)
         yield mw.setup_middleware()
         self.store = mw.store
@@ -200,3 +219,83 @@ class TestStoringMiddleware(VumiTestCase):
         resp2 = yield mw.handle_publish_event(ack2, "dummy_connector")
         self.assertEqual(resp2, ack2)
         yield self.assert_outbound_stored(msg, events=[event_id2])
+
+    def record_is_new(self, name):
+        calls = []
+        add = getattr(self.store, name)
+
+        def recording_add(*args, **kw):
+            calls.append(kw.get('is_new', False))
+            return add(*args, **kw)
+
+        setattr(self.store, name, recording_add)
+        return calls
+
+    @inlineCallbacks
+    def test_published_messages_are_new(self):
+        mw = yield self.setup_middleware()
+        inbound = self.record_is_new('add_inbound_message')
+        outbound = self.record_is_new('add_outbound_message')
+        events = self.record_is_new('add_event')
+        msg = self.mk_msg()
+        yield mw.handle_publish_inbound(msg, "dummy_connector")
+        yield mw.handle_consume_inbound(msg, "dummy_connector")
+        yield mw.handle_publish_outbound(msg, "dummy_connector")
+        yield mw.handle_consume_outbound(msg, "dummy_connector")
+        ack = self.mk_ack(user_message_id=msg["message_id"])
+        yield mw.handle_publish_event(ack, "dummy_connector")
+        yield mw.handle_consume_event(ack, "dummy_connector")
+        self.assertEqual(inbound, [True, False])
+        self.assertEqual(outbound, [True, False])
+        self.assertEqual(events, [True, False])
+        yield self.assert_inbound_stored(msg)
+        yield self.assert_outbound_stored(msg, events=[ack['event_id']])
+
+    @inlineCallbacks
+    def test_write_behind(self):
+        mw = yield self.setup_middleware({
+            'write_behind': True, 'write_behind_max_latency': 10})
+        msg = self.mk_msg()
+        resp = yield mw.handle_publish_outbound(msg, "dummy_connector")
+        self.assertEqual(resp, msg)
+        self.assertEqual(len(mw.writer), 1)
+        ack = self.mk_ack(user_message_id=msg["message_id"])
+        resp = yield mw.handle_publish_event(ack, "dummy_connector")
+        self.assertEqual(resp, ack)
+        self.assertEqual(len(mw.writer), 2)
+
+        yield mw.writer.flush()
+        yield self.assert_outbound_stored(msg, events=[ack['event_id']])
+
+    @inlineCallbacks
+    def test_write_behind_inbound(self):
+        mw = yield self.setup_middleware({
+            'write_behind': True, 'write_behind_max_latency': 10})
+        msg = self.mk_msg()
+        resp = yield mw.handle_publish_inbound(msg, "dummy_connector")
+        self.assertEqual(resp, msg)
+        yield mw.writer.flush()
+        yield self.assert_inbound_stored(msg)
+
+    @inlineCallbacks
+    def test_write_behind_pause_unpause_connectors(self):
+        worker = DummyWorker(
+            foo=DummyConnector(), bar=DummyConnector(paused=True))
+        mw = yield self.setup_middleware(
+            {'write_behind': True}, worker=worker)
+        mw.pause_connectors()
+        self.assertTrue(worker.connectors['foo'].paused)
+        self.assertTrue(worker.connectors['bar'].paused)
+        mw.unpause_connectors()
+        self.assertFalse(worker.connectors['foo'].paused)
+        self.assertTrue(worker.connectors['bar'].paused)
+
+    @inlineCallbacks
+    def test_write_behind_unpause_leaves_worker_paused_connectors(self):
+        worker = DummyWorker(foo=DummyConnector())
+        mw = yield self.setup_middleware(
+            {'write_behind': True}, worker=worker)
+        mw.pause_connectors()
+        worker.connectors_paused = True
+        mw.unpause_connectors()
+        self.assertTrue(worker.connectors['foo'].paused)
@@ -370,9 +370,9 @@ class FakeRedis(object):
         return zval.zadd(**valscores)
 
     @maybe_async
-    def zrem(self, key, value):
+    def zrem(self, key, *values):
         zval = self._setdefault_key(key, Zset())
-        return zval.zrem(value)
+        return sum(zval.zrem(value) for value in values)
 
     @maybe_async
     def zcard(self, key):
@@ -529,6 +529,53 @@ class FakeRedis(object):
         hll = self._data.get(key, HyperLogLog(0.01))
         return len(hll)
 
+    # Transactions
+
+    def transaction(self, func, *watches, **kw):
+        """
+        Call ``func`` with a :class:`FakePipeline` and execute the commands
+        it queued, like the synchronous client's ``transaction()``.
+
+        Nothing else can change the data while ``func`` runs, so the watched
+        keys are ignored and the transaction is never retried.
+        """
+        pipe = FakePipeline(self)
+        func_value = func(pipe)
+        exec_value = pipe.execute()
+        if kw.get('value_from_callable', False):
+            return func_value
+        return exec_value
+
+
+class FakePipeline(object):
+    """
+    A transactional pipeline for :class:`FakeRedis`.
+
+    Commands run immediately until :meth:`multi` is called. After that they
+    are queued and run by :meth:`execute`.
+    """
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._queued = None
+
+    def multi(self):
+        self._queued = []
+
+    def execute(self):
+        queued, self._queued = self._queued or [], None
+        return [func(self._redis, *args, **kw) for func, args, kw in queued]
+
+    def __getattr__(self, name):
+        func = getattr(type(self._redis), name).sync
+
+        def call(*args, **kw):
+            if self._queued is None:
+                return func(self._redis, *args, **kw)
+            self._queued.append((func, args, kw))
+            return self
+        return call
+
 
 class Zset(object):
     """A Redis-like ordered set implementation."""
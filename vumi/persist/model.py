@@ -17,6 +17,10 @@ class VumiRiakError(VumiError):
     pass
 
 
+class VumiRiakObjectExistsError(VumiRiakError):
+    pass
+
+
 class ModelMetaClass(type):
     def __new__(mcs, name, bases, dict):
         # set default bucket suffix
@@ -249,14 +253,19 @@ class Model(object):
         })
         return data
 
-    def save(self):
+    def save(self, if_none_match=False):
         """Save the object to Riak.
 
+        :param bool if_none_match:
+            If ``True``, only store the object if there isn't already one
+            with the same key. :class:`VumiRiakObjectExistsError` is raised
+            if there is.
+
         :returns:
             A deferred that fires once the data is saved (or None if
             using a synchronous manager).
         """
-        return self.manager.store(self)
+        return self.manager.store(self, if_none_match=if_none_match)
 
     def delete(self):
         """Delete the object from Riak.
@@ -719,8 +728,13 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " .riak_object(...)")
 
-    def store(self, modelobj):
-        """Store the modelobj in Riak."""
+    def store(self, modelobj, if_none_match=False):
+        """Store the modelobj in Riak.
+
+        :param bool if_none_match:
+            If ``True``, raise :class:`VumiRiakObjectExistsError` instead of
+            storing the modelobj if its key already exists.
+        """
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " .store(...)")
 
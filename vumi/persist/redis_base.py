@@ -157,6 +157,25 @@ class Manager(object):
     def close_manager(self):
         return self._close()
 
+    def pipeline(self):
+        """Return a manager that sends commands without waiting for replies.
+
+        The returned object has the same API as this manager and sends
+        commands on the same connection, in the order they are issued.
+        Results are only guaranteed to be available once they have been
+        waited for, and :meth:`flush` waits for all of them.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .pipeline(...)")
+
+    def flush(self):
+        """Wait for any commands that haven't been answered yet.
+
+        Managers whose commands block until they complete have nothing to
+        do here.
+        """
+        return None
+
     def _close(self):
         """Close redis connection."""
         raise NotImplementedError("Sub-classes of Manager should implement"
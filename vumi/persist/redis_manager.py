@@ -77,6 +77,13 @@ class RedisManager(Manager):
         # Close all the connections this client may have open.
         self._client.connection_pool.disconnect()
 
+    def pipeline(self):
+        """Return a manager that sends commands without waiting for replies.
+
+        Our commands block until they complete, so we return ourselves.
+        """
+        return self
+
     def _purge_all(self):
         """Delete *ALL* keys whose names start with this manager's key prefix.
 
@@ -0,0 +1,45 @@
+# -*- test-case-name: vumi.persist.tests.test_riak_base -*-
+
+"""Helpers shared by the sync and async Riak managers."""
+
+import re
+
+from riak import RiakError, ConflictError
+
+
+# Status returned by the HTTP transport when an ``If-None-Match`` store finds
+# an existing object.
+HTTP_PRECONDITION_FAILED = 412
+
+# Error returned by the protocol buffers transport in the same situation.
+PBC_MATCH_FOUND = 'match_found'
+
+# The HTTP transport does not keep the response status on the exception, so
+# we recover it from the message built by ``check_http_code``.
+_HTTP_STATUS_RE = re.compile(r'received (\d+)$')
+
+
+def riak_error_status(e):
+    """
+    Return the HTTP status code of a :class:`RiakError`, or ``None`` if the
+    error did not come from an HTTP response.
+    """
+    status = getattr(e, 'status', None)
+    if status is not None:
+        return int(status)
+    match = _HTTP_STATUS_RE.search(str(getattr(e, 'value', '')))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def is_object_exists_error(e):
+    """
+    Check whether an exception from a conditional store means the object
+    already exists.
+    """
+    if not isinstance(e, RiakError) or isinstance(e, ConflictError):
+        return False
+    if riak_error_status(e) == HTTP_PRECONDITION_FAILED:
+        return True
+    return e.value == PBC_MATCH_FOUND
@@ -6,7 +6,9 @@ import json
 
 from riak import RiakClient, RiakObject, RiakMapReduce, RiakError
 
-from vumi.persist.model import Manager, VumiRiakError
+from vumi.persist.model import (
+    Manager, VumiRiakError, VumiRiakObjectExistsError)
+from vumi.persist.riak_base import is_object_exists_error
 from vumi.utils import flatten_generator
 
 
@@ -152,8 +154,14 @@ class VumiRiakObject(object):
 
     # Methods that touch the network.
 
-    def store(self):
-        return type(self)(self._riak_obj.store())
+    def store(self, if_none_match=False):
+        try:
+            return type(self)(
+                self._riak_obj.store(if_none_match=if_none_match))
+        except RiakError as e:
+            if if_none_match and is_object_exists_error(e):
+                raise VumiRiakObjectExistsError(e)
+            raise
 
     def reload(self):
         return type(self)(self._riak_obj.reload())
@@ -236,7 +244,7 @@ class RiakManager(Manager):
             riak_object.set_data({'$VERSION': modelcls.VERSION})
         return riak_object
 
-    def store(self, modelobj):
+    def store(self, modelobj, if_none_match=False):
         riak_object = modelobj._riak_object
         modelcls = type(modelobj)
         model_name = "%s.%s" % (modelcls.__module__, modelcls.__name__)
@@ -248,7 +256,7 @@ class RiakManager(Manager):
                 modelcls, self, data_version, reverse=True)
             riak_object = migrator(riak_object).get_riak_object()
             data_version = riak_object.get_data().get('$VERSION', None)
-        riak_object.store()
+        riak_object.store(if_none_match=if_none_match)
         return modelobj
 
     def delete(self, modelobj):
@@ -195,6 +195,15 @@ class FakeRedisTestMixin(object):
         yield self.assert_redis_op(
             redis, [('two', 0.2)], 'zrange', 'set', 0, -1, withscores=True)
 
+    @inlineCallbacks
+    def test_zrem_multiple(self):
+        redis = yield self.get_redis()
+        yield redis.zadd('set', one=0.1, two=0.2, three=0.3)
+        yield self.assert_redis_op(
+            redis, 2, 'zrem', 'set', 'one', 'three', 'four')
+        yield self.assert_redis_op(
+            redis, [('two', 0.2)], 'zrange', 'set', 0, -1, withscores=True)
+
     @inlineCallbacks
     def test_zremrangebyrank(self):
         redis = yield self.get_redis()
@@ -628,6 +637,25 @@ class TestFakeRedis(FakeRedisUnverifiedTestMixin, FakeRedisTestMixin,
     def wait(self, redis, delay):
         redis.clock.advance(delay)
 
+    def test_transaction(self):
+        redis = self.get_redis()
+        redis.zadd('set', one=0.1, two=0.2)
+
+        def claim(pipe):
+            values = pipe.zrangebyscore('set', '-inf', 0.15)
+            pipe.multi()
+            # Commands are queued until the transaction is executed.
+            self.assertEqual(pipe.zrem('set', *values), pipe)
+            self.assertEqual(redis.zcard('set'), 2)
+            return values
+
+        self.assertEqual(redis.transaction(claim, 'set'), [1])
+        self.assertEqual(redis.zrange('set', 0, -1), ['two'])
+        redis.zadd('set', one=0.1)
+        self.assertEqual(
+            redis.transaction(claim, 'set', value_from_callable=True),
+            ['one'])
+
 
 class TestFakeRedisAsync(FakeRedisUnverifiedTestMixin, FakeRedisTestMixin,
                          VumiTestCase):
@@ -72,3 +72,9 @@ class TestRedisManager(VumiTestCase):
         self.manager.setex("key-ttl", 30, "value")
         ttl = self.manager.ttl("key-ttl")
         self.assertTrue(10 <= ttl <= 30)
+
+    def test_pipeline(self):
+        pipeline = self.manager.pipeline()
+        self.assertEqual(True, pipeline.set('foo', 'bar'))
+        self.assertEqual(None, pipeline.flush())
+        self.assertEqual('bar', self.manager.get('foo'))
@@ -0,0 +1,42 @@
+"""Tests for vumi.persist.riak_base."""
+
+from vumi.tests.helpers import VumiTestCase, import_skip
+
+
+class TestRiakBase(VumiTestCase):
+
+    def setUp(self):
+        try:
+            from riak import RiakError, ConflictError
+            from vumi.persist import riak_base
+        except ImportError, e:
+            import_skip(e, 'riak')
+        self.RiakError = RiakError
+        self.ConflictError = ConflictError
+        self.riak_base = riak_base
+
+    def http_error(self, status):
+        return self.RiakError(
+            'Expected status [200, 201, 204, 300], received %s' % (status,))
+
+    def test_riak_error_status(self):
+        status = self.riak_base.riak_error_status
+        self.assertEqual(status(self.http_error(412)), 412)
+        self.assertEqual(status(self.http_error(500)), 500)
+        self.assertEqual(status(self.RiakError('match_found')), None)
+
+    def test_is_object_exists_error_http(self):
+        is_exists = self.riak_base.is_object_exists_error
+        self.assertTrue(is_exists(self.http_error(412)))
+        self.assertFalse(is_exists(self.http_error(500)))
+        self.assertFalse(is_exists(self.http_error(4120)))
+
+    def test_is_object_exists_error_pbc(self):
+        is_exists = self.riak_base.is_object_exists_error
+        self.assertTrue(is_exists(self.RiakError('match_found')))
+        self.assertFalse(is_exists(self.RiakError('no match_found here')))
+
+    def test_is_object_exists_error_other_exceptions(self):
+        is_exists = self.riak_base.is_object_exists_error
+        self.assertFalse(is_exists(self.ConflictError()))
+        self.assertFalse(is_exists(ValueError('match_found')))
@@ -107,6 +107,61 @@ class TestTxRedisManager(VumiTestCase):
         ttl = yield manager.ttl("key-ttl")
         self.assertTrue(10 <= ttl <= 30)
 
+    @inlineCallbacks
+    def test_pipeline_flush(self):
+        manager = yield self.get_manager()
+        pipeline = manager.pipeline()
+        set_d = pipeline.set('foo', 'bar')
+        get_d = pipeline.get('foo')
+        yield pipeline.flush()
+        self.assertEqual(pipeline.pending_count(), 0)
+        self.assertEqual(True, (yield set_d))
+        self.assertEqual('bar', (yield get_d))
+        self.assertEqual('bar', (yield manager.get('foo')))
+
+    @inlineCallbacks
+    def test_pipeline_flush_empty(self):
+        manager = yield self.get_manager()
+        pipeline = manager.pipeline()
+        self.assertEqual(pipeline.pending_count(), 0)
+        yield pipeline.flush()
+
+    @inlineCallbacks
+    def test_pipeline_ordering(self):
+        """
+        Commands sent through a pipeline and directly on its manager reach
+        Redis in the order they were issued.
+        """
+        manager = yield self.get_manager()
+        pipeline = manager.pipeline()
+        pipeline_d = pipeline.set('foo', 'pipelined')
+        direct_d = manager.set('foo', 'direct')
+        get_d = pipeline.get('foo')
+        yield pipeline_d
+        yield direct_d
+        self.assertEqual('direct', (yield get_d))
+        self.assertEqual('direct', (yield manager.get('foo')))
+
+    @inlineCallbacks
+    def test_pipeline_failure(self):
+        manager = yield self.get_manager()
+        pipeline = manager.pipeline()
+        yield manager.set('foo', 'bar')
+        incr_d = pipeline.incr('foo')
+        get_d = pipeline.get('foo')
+        yield pipeline.flush()
+        yield self.assertFailure(incr_d, Exception)
+        self.assertEqual('bar', (yield get_d))
+
+    @inlineCallbacks
+    def test_pipeline_sub_manager(self):
+        manager = yield self.get_manager()
+        sub_pipeline = manager.pipeline().sub_manager('sub')
+        set_d = sub_pipeline.set('foo', 'bar')
+        yield sub_pipeline.flush()
+        yield set_d
+        self.assertEqual(['sub:foo'], (yield manager.keys()))
+
     @skip_fake_redis
     @inlineCallbacks
     def test_reconnect_sub_managers(self):
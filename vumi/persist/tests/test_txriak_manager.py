@@ -2,7 +2,7 @@
 
 from twisted.internet.defer import inlineCallbacks
 
-from vumi.persist.model import Manager
+from vumi.persist.model import Manager, VumiRiakObjectExistsError
 from vumi.tests.helpers import VumiTestCase, import_skip
 
 
@@ -141,6 +141,23 @@ class CommonRiakManagerTests(object):
         dummy2 = yield self.manager.load(DummyModel, "foo")
         self.assertEqual(dummy2.get_data(), {"a": 1})
 
+    @Manager.calls_manager
+    def test_store_if_none_match(self):
+        dummy1 = self.mkdummy("foo", {"a": 1})
+        result1 = yield self.manager.store(dummy1, if_none_match=True)
+        self.assertEqual(dummy1, result1)
+
+        dummy2 = self.mkdummy("foo", {"a": 2})
+        try:
+            yield self.manager.store(dummy2, if_none_match=True)
+        except VumiRiakObjectExistsError:
+            pass
+        else:
+            self.fail('Expected VumiRiakObjectExistsError.')
+
+        dummy3 = yield self.manager.load(DummyModel, "foo")
+        self.assertEqual(dummy3.get_data(), {"a": 1})
+
     @Manager.calls_manager
     def test_delete(self):
         dummy1 = self.mkdummy("foo", {"a": 1})
@@ -12,7 +12,8 @@ except ImportError:
     txr = txrp
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, succeed, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, succeed, Deferred, DeferredList, maybeDeferred)
 
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import FakeRedis
@@ -273,6 +274,13 @@ class TxRedisManager(Manager):
         cls._attach_reconnector(manager)
         return manager
 
+    def pipeline(self):
+        """Return a manager that tracks unanswered commands.
+
+        See :class:`TxRedisPipeline` for details.
+        """
+        return TxRedisPipeline(self)
+
     def sub_manager(self, sub_prefix):
         sub_man = super(TxRedisManager, self).sub_manager(sub_prefix)
         self._sub_managers.append(sub_man)
@@ -331,3 +339,75 @@ class TxRedisManager(Manager):
         """Filter results of a redis call.
         """
         return results.addCallback(func)
+
+
+class TxRedisPipeline(Manager):
+    """Manager that sends commands without waiting for earlier replies.
+
+    txredis writes each command to the connection as soon as it is issued,
+    so commands issued together already share a round trip and reach Redis
+    in the order they were issued (including commands issued directly on
+    the manager we were created from). We add no buffering of our own, we
+    just keep track of the commands that haven't been answered yet so that
+    callers can wait for all of them with :meth:`flush`.
+
+    :param TxRedisManager manager:
+        The manager whose connection and key prefix we use.
+    """
+
+    call_decorator = staticmethod(inlineCallbacks)
+
+    def __init__(self, manager):
+        super(TxRedisPipeline, self).__init__(
+            manager._client, manager._config, manager._key_prefix,
+            manager._key_separator)
+        self._manager = manager
+        self._pending = []
+
+    def pipeline(self):
+        return self._manager.pipeline()
+
+    def sub_manager(self, sub_prefix):
+        return TxRedisPipeline(self._manager.sub_manager(sub_prefix))
+
+    def pending_count(self):
+        """Return the number of commands waiting to be answered."""
+        return len(self._pending)
+
+    def flush(self):
+        """Wait for all the commands sent so far to be answered.
+
+        Returns a deferred that fires once they have been. Failures are
+        delivered to the deferreds of the commands that caused them, not to
+        this one.
+        """
+        return DeferredList(list(self._pending)).addCallback(lambda _: None)
+
+    def _close(self):
+        """Wait for any unanswered commands.
+
+        The connection belongs to the manager we were created from, so we
+        leave it alone.
+        """
+        return self.flush()
+
+    def _make_redis_call(self, call, *args, **kw):
+        """Send a redis API call and track it until it is answered.
+        """
+        # The client may have been replaced by a reconnect since we were
+        # created, so we always use the manager's current one.
+        d = maybeDeferred(getattr(self._manager._client, call), *args, **kw)
+        answered_d = Deferred()
+        self._pending.append(answered_d)
+
+        def answered(result):
+            self._pending.remove(answered_d)
+            answered_d.callback(None)
+            return result
+
+        return d.addBoth(answered)
+
+    def _filter_redis_results(self, func, results):
+        """Filter results of a redis call.
+        """
+        return results.addCallback(func)
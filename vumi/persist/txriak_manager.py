@@ -9,7 +9,9 @@ from twisted.internet.threads import deferToThread
 from twisted.internet.defer import (
     inlineCallbacks, returnValue, gatherResults, maybeDeferred, succeed)
 
-from vumi.persist.model import Manager, VumiRiakError
+from vumi.persist.model import (
+    Manager, VumiRiakError, VumiRiakObjectExistsError)
+from vumi.persist.riak_base import is_object_exists_error
 
 
 def to_unicode(text, encoding='utf-8'):
@@ -27,6 +29,13 @@ def riakErrorHandler(failure):
     raise VumiRiakError(e)
 
 
+def objectExistsErrorHandler(failure):
+    failure.trap(RiakError)
+    if is_object_exists_error(failure.value):
+        raise VumiRiakObjectExistsError(failure.value)
+    return failure
+
+
 class VumiTxIndexPage(object):
     """
     Wrapper around a page of index query results.
@@ -159,9 +168,11 @@ class VumiTxRiakObject(object):
 
     # Methods that touch the network.
 
-    def store(self):
-        d = deferToThread(self._riak_obj.store)
+    def store(self, if_none_match=False):
+        d = deferToThread(self._riak_obj.store, if_none_match=if_none_match)
         d.addCallback(type(self))
+        if if_none_match:
+            d.addErrback(objectExistsErrorHandler)
         return d
 
     def reload(self):
@@ -249,7 +260,7 @@ class TxRiakManager(Manager):
             riak_object.set_data({'$VERSION': modelcls.VERSION})
         return riak_object
 
-    def store(self, modelobj):
+    def store(self, modelobj, if_none_match=False):
         riak_object = modelobj._riak_object
         modelcls = type(modelobj)
         model_name = "%s.%s" % (modelcls.__module__, modelcls.__name__)
@@ -261,7 +272,7 @@ class TxRiakManager(Manager):
                 modelcls, self, data_version, reverse=True)
             riak_object = migrator(riak_object).get_riak_object()
             data_version = riak_object.get_data().get('$VERSION', None)
-        d = riak_object.store()
+        d = riak_object.store(if_none_match=if_none_match)
         d.addCallback(lambda _: modelobj)
         return d
 
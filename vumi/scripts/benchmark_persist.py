@@ -5,8 +5,10 @@ from twisted.python import usage
 from twisted.internet import reactor
 from twisted.internet.defer import maybeDeferred, inlineCallbacks, DeferredList
 
+from vumi.components.message_store import MessageStore
 from vumi.message import TransportUserMessage
 from vumi.persist.model import Model
+from vumi.persist.txredis_manager import TxRedisManager
 from vumi.persist.txriak_manager import TxRiakManager
 from vumi.persist.fields import VumiMessage
 
@@ -19,6 +21,12 @@ class Options(usage.Options):
          "Number of messages to read and write concurrently"],
     ]
 
+    optFlags = [
+        ["message-store", None,
+         "Compare MessageStore writes of new messages with and without"
+         " skipping the read of the existing record."],
+    ]
+
     longdesc = """Benchmarks vumi.persist.model.Model"""
 
 
@@ -106,6 +114,41 @@ class WriteReadBenchmark(object):
         yield manager.purge_all()
         print "Messages purged."
 
+
+class StoreWriteBenchmark(WriteReadBenchmark):
+    """
+    Writes new outbound messages to a MessageStore, first loading any
+    existing record before each write and then writing blindly.
+    """
+
+    def write_batch(self, store, msgs, is_new):
+        print "  Writing %d messages." % len(msgs)
+        return DeferredList([
+            store.add_outbound_message(msg, is_new=is_new) for msg in msgs])
+
+    @inlineCallbacks
+    def run(self):
+        manager = TxRiakManager.from_config({'bucket_prefix': 'test.bench.'})
+        # The store only touches Redis for batches, which we don't use here.
+        redis = yield TxRedisManager.from_config({'FAKE_REDIS': True})
+        store = MessageStore(manager, redis)
+        yield manager.purge_all()
+
+        for name, is_new in [("Read-modify-write", False),
+                             ("Blind write", True)]:
+            msg_batches = self.make_batches()
+
+            start = time.time()
+            for batch in msg_batches:
+                yield self.write_batch(store, batch, is_new)
+            write_time = time.time() - start
+            print "%s took %.2f seconds (%.2f msgs/s)" % (
+                name, write_time, self.messages / write_time)
+
+            yield manager.purge_all()
+
+        print "Messages purged."
+
 if __name__ == '__main__':
     try:
         options = Options()
@@ -115,7 +158,10 @@ if __name__ == '__main__':
         print '%s: Try --help for usage details.' % (sys.argv[0])
         sys.exit(1)
 
-    bench = WriteReadBenchmark(options)
+    if options['message-store']:
+        bench = StoreWriteBenchmark(options)
+    else:
+        bench = WriteReadBenchmark(options)
 
     def _eb(f):
         f.printTraceback()
@@ -6,7 +6,9 @@ from copy import deepcopy
 from twisted.python import log
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredSemaphore, DeferredList,
+    succeed)
 from twisted.internet import protocol, reactor
 import txamqp
 from txamqp.client import TwistedDelegate
@@ -14,7 +16,7 @@ from txamqp.content import Content
 from txamqp.protocol import AMQClient
 
 from vumi.errors import VumiError
-from vumi.message import Message
+from vumi.message import Message, JSONMessageCodec
 from vumi.utils import load_class_by_string, vumi_resource_path, build_web_site
 
 
@@ -40,7 +42,7 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
         self.options = worker.options
         self.config = worker.config
         self.spec = get_spec(vumi_resource_path(worker.options['specfile']))
-        self.delegate = TwistedDelegate()
+        self.delegate = WorkerDelegate()
         self.worker = worker
         self.amqp_client = None
 
@@ -74,6 +76,19 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self, connector, reason)
 
 
+class WorkerDelegate(TwistedDelegate):
+    """
+    Passes publisher confirms from the broker to the publisher that owns the
+    channel.
+    """
+
+    def basic_ack(self, ch, msg):
+        ch.publisher.confirmed(msg.delivery_tag, msg.multiple, True)
+
+    def basic_nack(self, ch, msg):
+        ch.publisher.confirmed(msg.delivery_tag, msg.multiple, False)
+
+
 class WorkerAMQClient(AMQClient):
     @inlineCallbacks
     def connectionMade(self):
@@ -84,6 +99,23 @@ class WorkerAMQClient(AMQClient):
         log.msg("Got an authenticated connection")
         yield self.connected_callback(self)
 
+    def channelFailed(self, channel, reason):
+        AMQClient.channelFailed(self, channel, reason)
+        self._channel_closed(channel, reason)
+
+    def close(self, reason):
+        channels = self.channels.values()
+        AMQClient.close(self, reason)
+        for channel in channels:
+            self._channel_closed(channel, reason)
+
+    def _channel_closed(self, channel, reason):
+        # Publishers in confirm mode will never hear about messages that
+        # were waiting for confirmation on this channel.
+        publisher = getattr(channel, 'publisher', None)
+        if publisher is not None:
+            publisher.channel_closed(reason)
+
     @inlineCallbacks
     def get_channel(self, channel_id=None):
         """If channel_id is None a new channel is created"""
@@ -159,6 +191,11 @@ class Worker(MultiService, object):
     as needed.
     """
 
+    # The codec used by consumers and publishers created with consume() and
+    # publish_to(). If this is None, the consumer and publisher defaults are
+    # used.
+    message_codec = None
+
     def __init__(self, options, config=None):
         super(Worker, self).__init__()
         self.options = options
@@ -197,7 +234,8 @@ class Worker(MultiService, object):
 
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False, prefetch_count=None):
+                message_class=None, paused=False, prefetch_count=None,
+                max_concurrency=1, ordering_fields=()):
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -211,8 +249,12 @@ class Worker(MultiService, object):
             'durable': durable,
             'start_paused': paused,
             'prefetch_count': prefetch_count,
+            'max_concurrency': max_concurrency,
+            'ordering_fields': tuple(ordering_fields),
         }
         log.msg('Starting %s with %s' % (class_name, kwargs))
+        if self.message_codec is not None:
+            kwargs['message_codec'] = self.message_codec
         klass = type(class_name, (DynamicConsumer,), kwargs)
         if message_class is not None:
             klass.message_class = message_class
@@ -223,16 +265,21 @@ class Worker(MultiService, object):
 
     def publish_to(self, routing_key,
                    exchange_name='vumi', exchange_type='direct', durable=True,
-                   delivery_mode=2):
+                   delivery_mode=2, confirm=False, max_unconfirmed=100):
         class_name = self.routing_key_to_class_name(routing_key)
+        attrs = {
+            "routing_key": routing_key,
+            "exchange_name": exchange_name,
+            "exchange_type": exchange_type,
+            "durable": durable,
+            "delivery_mode": delivery_mode,
+            "confirm": confirm,
+            "max_unconfirmed": max_unconfirmed,
+        }
+        if self.message_codec is not None:
+            attrs["message_codec"] = self.message_codec
         publisher_class = type(
-            "%sDynamicPublisher" % class_name, (Publisher,), {
-                "routing_key": routing_key,
-                "exchange_name": exchange_name,
-                "exchange_type": exchange_type,
-                "durable": durable,
-                "delivery_mode": delivery_mode,
-            })
+            "%sDynamicPublisher" % class_name, (Publisher,), attrs)
         return self.start_publisher(publisher_class)
 
     def start_publisher(self, publisher_class, *args, **kw):
@@ -258,9 +305,17 @@ class Consumer(object):
     routing_key = "routing_key"
 
     message_class = Message
+    message_codec = JSONMessageCodec()
     start_paused = False
     prefetch_count = None
 
+    # The maximum number of messages processed at the same time. Messages
+    # with the same ordering key (see :meth:`ordering_key`) are still
+    # processed one after the other, in the order they were received.
+    max_concurrency = 1
+    # Payload fields used to build the ordering key, e.g. ('from_addr',).
+    ordering_fields = ()
+
     def __init__(self, channel):
         self.channel = channel
         self._notify_paused_and_quiet = []
@@ -275,6 +330,8 @@ class Consumer(object):
         self.keep_consuming = True
         self.paused = self.start_paused
         self._unpause_d = None
+        self._concurrency = DeferredSemaphore(self.max_concurrency)
+        self._ordered = {}
         if self.prefetch_count is not None:
             yield self.channel.basic_qos(0, self.prefetch_count, False)
         if not self.paused:
@@ -290,7 +347,11 @@ class Consumer(object):
                     break
                 if self.paused:
                     yield self._unpause_d
-                yield self.consume(message)
+                if self.max_concurrency > 1:
+                    yield self._concurrency.acquire()
+                    self._dispatch(message)
+                else:
+                    yield self.consume(message)
         except txamqp.queue.Closed as e:
             log.err("Queue has closed", e)
         except Exception:
@@ -334,12 +395,65 @@ class Consumer(object):
             while self._notify_paused_and_quiet:
                 self._notify_paused_and_quiet.pop(0).callback(None)
 
-    @inlineCallbacks
+    def ordering_key(self, message):
+        """
+        Return the key used to keep related messages in order when
+        ``max_concurrency`` is greater than one, or ``None`` if the message
+        may be processed out of order.
+        """
+        if not self.ordering_fields:
+            return None
+        return tuple(message.get(field) for field in self.ordering_fields)
+
+    def _dispatch(self, message):
+        # Start processing a message without waiting for it to finish. The
+        # caller has already acquired a slot from self._concurrency.
+        self._in_progress += 1
+        try:
+            vumi_message = self.decode_message(message)
+            key = self.ordering_key(vumi_message)
+        except Exception:
+            self._in_progress -= 1
+            self._concurrency.release()
+            raise
+        if key is not None:
+            if key in self._ordered:
+                self._ordered[key].append((message, vumi_message))
+                return
+            self._ordered[key] = []
+        self._process_concurrently(message, vumi_message, key)
+
+    def _process_concurrently(self, message, vumi_message, key):
+        d = self._process(message, vumi_message)
+        d.addErrback(log.err)
+        d.addCallback(self._processed_concurrently, key)
+
+    def _processed_concurrently(self, _, key):
+        self._concurrency.release()
+        if key is not None:
+            pending = self._ordered[key]
+            if pending:
+                message, vumi_message = pending.pop(0)
+                self._process_concurrently(message, vumi_message, key)
+            else:
+                del self._ordered[key]
+        self._check_notify()
+
+    def decode_message(self, message):
+        return self.message_codec.decode(
+            message.content.body, self.message_class)
+
     def consume(self, message):
         self._in_progress += 1
+        return self._process(message)
+
+    @inlineCallbacks
+    def _process(self, message, vumi_message=None):
+        # The caller is responsible for incrementing self._in_progress.
         try:
-            result = yield self.consume_message(
-                self.message_class.from_json(message.content.body))
+            if vumi_message is None:
+                vumi_message = self.decode_message(message)
+            result = yield self.consume_message(vumi_message)
         finally:
             # If we get an exception here the consumer's already pretty much
             # broken, but we still decrement the _in_progress counter so we
@@ -387,6 +501,19 @@ class RoutingKeyError(Exception):
         return repr(self.value)
 
 
+class PublishNackError(VumiError):
+    """
+    Raised when the broker rejects a message published in confirm mode.
+    """
+
+
+class PublishChannelClosedError(VumiError):
+    """
+    Raised when a publisher's channel is closed before the broker has
+    confirmed the messages published on it.
+    """
+
+
 class Publisher(object):
     exchange_name = "vumi"
     exchange_type = "direct"
@@ -394,16 +521,112 @@ class Publisher(object):
     durable = False
     auto_delete = False
     delivery_mode = 2  # save to disk
+    message_codec = JSONMessageCodec()
+
+    # If this is true, the channel is put into confirm mode and the broker
+    # confirms each message. See wait_for_confirms(). This is a RabbitMQ
+    # extension and needs the amqp-spec-0-9-1.xml spec.
+    confirm = False
+    # The maximum number of messages waiting to be confirmed. When the window
+    # is full, publishing waits until the broker confirms earlier messages.
+    max_unconfirmed = 100
 
     def start(self, channel):
         log.msg("Started the publisher")
         self.channel = channel
         self.bound_routing_keys = {}
+        self._publish_seq = 0
+        self._unconfirmed = {}
+        self._window_waiters = []
 
         # There's probably a better way to do this.
         if not hasattr(self, 'vumi_options'):
             self.vumi_options = {}
 
+        if self.confirm:
+            self.channel.publisher = self
+            return self.channel.confirm_select(nowait=False)
+
+    def wait_for_window(self):
+        """
+        Return a deferred that fires when there is room in the window of
+        unconfirmed messages.
+
+        This fires immediately if the publisher isn't in confirm mode.
+        """
+        if not self._window_waiters and not self._window_full():
+            return succeed(None)
+        d = Deferred()
+        self._window_waiters.append(d)
+        return d
+
+    def _window_full(self):
+        return self.confirm and (
+            len(self._unconfirmed) >= self.max_unconfirmed)
+
+    def wait_for_confirms(self):
+        """
+        Return a deferred that fires when the broker has confirmed every
+        message published so far.
+
+        It fails with :class:`PublishNackError` if the broker rejects any of
+        them, or with :class:`PublishChannelClosedError` if the channel is
+        closed first. This fires immediately if the publisher isn't in
+        confirm mode.
+        """
+        if not self._unconfirmed:
+            return succeed(None)
+        ds = []
+        for waiters in self._unconfirmed.itervalues():
+            d = Deferred()
+            waiters.append(d)
+            ds.append(d)
+        d = DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(lambda _: None, lambda f: f.value.subFailure)
+        return d
+
+    def confirmed(self, delivery_tag, multiple, acked):
+        """
+        Called when the broker confirms (or rejects, if ``acked`` is false)
+        the message with sequence number ``delivery_tag``, or all messages up
+        to and including it if ``multiple`` is true.
+        """
+        if multiple:
+            seqs = sorted(s for s in self._unconfirmed if s <= delivery_tag)
+        else:
+            seqs = [delivery_tag]
+        for seq in seqs:
+            waiters = self._unconfirmed.pop(seq, None)
+            if waiters is None:
+                continue
+            if acked:
+                for d in waiters:
+                    d.callback(None)
+                continue
+            reason = "Message %s rejected by broker." % (seq,)
+            if not waiters:
+                log.msg(reason)
+            for d in waiters:
+                d.errback(PublishNackError(reason))
+        while self._window_waiters and not self._window_full():
+            self._window_waiters.pop(0).callback(None)
+
+    def channel_closed(self, reason):
+        """
+        Called when the channel is closed. Anything waiting for messages to
+        be confirmed or for room in the window fails, because no more
+        confirms will arrive.
+        """
+        error = PublishChannelClosedError(
+            "Channel closed before messages were confirmed: %s" % (reason,))
+        unconfirmed, self._unconfirmed = self._unconfirmed, {}
+        for seq in sorted(unconfirmed):
+            for d in unconfirmed[seq]:
+                d.errback(error)
+        window_waiters, self._window_waiters = self._window_waiters, []
+        for d in window_waiters:
+            d.errback(error)
+
     def check_routing_key(self, routing_key):
         if(routing_key != routing_key.lower()):
             raise RoutingKeyError("The routing_key: %s is not all lower case!"
@@ -411,15 +634,35 @@ class Publisher(object):
 
     @inlineCallbacks
     def publish(self, message, **kwargs):
+        """
+        Publish ``message``.
+
+        In confirm mode this first waits for room in the window of
+        unconfirmed messages, but not for the message itself to be
+        confirmed. Use :meth:`wait_for_confirms` for that.
+        """
         exchange_name = kwargs.get('exchange_name') or self.exchange_name
         routing_key = kwargs.get('routing_key') or self.routing_key
         self.check_routing_key(routing_key)
-        yield self.channel.basic_publish(exchange=exchange_name,
-                                         content=message,
-                                         routing_key=routing_key)
+        if not self.confirm:
+            yield self.channel.basic_publish(exchange=exchange_name,
+                                             content=message,
+                                             routing_key=routing_key)
+            return
+        yield self.wait_for_window()
+        self._publish_seq += 1
+        seq = self._publish_seq
+        self._unconfirmed[seq] = []
+        try:
+            yield self.channel.basic_publish(exchange=exchange_name,
+                                             content=message,
+                                             routing_key=routing_key)
+        except Exception:
+            self._unconfirmed.pop(seq, None)
+            raise
 
     def publish_message(self, message, **kwargs):
-        d = self.publish_raw(message.to_json(), **kwargs)
+        d = self.publish_raw(self.message_codec.encode(message), **kwargs)
         d.addCallback(lambda r: message)
         return d
 
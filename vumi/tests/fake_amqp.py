@@ -5,10 +5,9 @@ import re
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 
-from vumi.service import WorkerAMQClient
+from vumi.service import WorkerAMQClient, WorkerDelegate
 from vumi.message import Message as VumiMessage
 
 
@@ -290,6 +289,12 @@ class FakeAMQPChannel(object):
         self.delegate = client.delegate
         self.unacked = []
         self._consumer_prefetch = {}
+        # Publisher confirms. If hold_confirms is set, confirms are only sent
+        # when send_confirms() is called.
+        self.confirming = False
+        self.hold_confirms = False
+        self.unconfirmed = []
+        self._publish_seq = 0
 
     def __repr__(self):
         return '<FakeAMQPChannel: id=%s>' % (self.channel_id,)
@@ -337,7 +342,30 @@ class FakeAMQPChannel(object):
         return Message(mkMethod("cancel-ok", 31))
 
     def basic_publish(self, exchange, routing_key, content):
-        return self.broker.basic_publish(exchange, routing_key, content)
+        resp = self.broker.basic_publish(exchange, routing_key, content)
+        if self.confirming:
+            self._publish_seq += 1
+            self.unconfirmed.append(self._publish_seq)
+            if not self.hold_confirms:
+                self.send_confirms()
+        return resp
+
+    def confirm_select(self, nowait=False):
+        self.confirming = True
+        return Message(mkMethod("select-ok", 11))
+
+    def send_confirms(self, acked=True):
+        """
+        Confirm (or reject, if ``acked`` is false) all unconfirmed messages
+        published on this channel.
+        """
+        method_name, index = ("ack", 80) if acked else ("nack", 120)
+        while self.unconfirmed:
+            msg = Message(mkMethod(method_name, index), [
+                ('delivery_tag', self.unconfirmed.pop(0)),
+                ('multiple', False),
+            ])
+            getattr(self.delegate, "basic_%s" % (method_name,))(self, msg)
 
     def basic_ack(self, delivery_tag, multiple):
         assert delivery_tag in [dtag for dtag, _ctag, _queue in self.unacked]
@@ -474,7 +502,7 @@ class FakeAMQPQueue(object):
 
 class FakeAMQClient(WorkerAMQClient):
     def __init__(self, spec, vumi_options=None, broker=None):
-        WorkerAMQClient.__init__(self, TwistedDelegate(), '', spec)
+        WorkerAMQClient.__init__(self, WorkerDelegate(), '', spec)
         if vumi_options is not None:
             self.vumi_options = vumi_options
         if broker is None:
@@ -14,7 +14,8 @@ from zope.interface import Interface, implements
 
 from vumi.message import TransportUserMessage, TransportEvent
 from vumi.service import get_spec
-from vumi.utils import vumi_resource_path, flatten_generator
+from vumi.utils import (
+    vumi_resource_path, flatten_generator, close_default_http_pool)
 from vumi.tests.fake_amqp import FakeAMQPBroker, FakeAMQClient
 
 
@@ -215,6 +216,9 @@ class VumiTestCase(TestCase):
         if self._cleanup_funcs is not None:
             for cleanup, args, kw in reversed(self._cleanup_funcs):
                 yield cleanup(*args, **kw)
+        # Requests made without a pool of their own leave connections open
+        # in the default pool.
+        yield close_default_http_pool()
         yield self._check_reactor_things()
 
     @inlineCallbacks
@@ -6,6 +6,7 @@ from vumi.connectors import (
 from vumi.tests.utils import LogCatcher
 from vumi.worker import BaseWorker
 from vumi.message import TransportUserMessage
+from vumi.service import PublishNackError
 from vumi.middleware.tests.utils import RecordingMiddleware
 from vumi.tests.helpers import VumiTestCase, MessageHelper, WorkerHelper
 
@@ -101,6 +102,30 @@ class TestBaseConnector(BaseConnectorTestCase):
         conn, consumer = yield self.mk_consumer(prefetch_count=10)
         self.assertEqual(consumer.channel.qos_prefetch_count, 10)
 
+    @inlineCallbacks
+    def test_max_concurrency(self):
+        conn = yield self.mk_connector()
+        self.assertEqual(conn._max_concurrency, 1)
+        self.assertEqual(conn._ordering_fields, ())
+        conn = self.connector_class(
+            conn.worker, 'foo', max_concurrency=3,
+            ordering_fields=['from_addr'])
+        consumer = yield conn._setup_consumer(
+            'inbound', TransportUserMessage, lambda msg: None)
+        self.assertEqual(consumer.max_concurrency, 3)
+        self.assertEqual(consumer.ordering_fields, ('from_addr',))
+
+    @inlineCallbacks
+    def test_publisher_confirms(self):
+        conn = yield self.mk_connector()
+        publisher = yield conn._setup_publisher('outbound')
+        self.assertEqual(publisher.confirm, False)
+        conn = self.connector_class(
+            conn.worker, 'foo', publisher_confirms=True, max_unconfirmed=5)
+        publisher = yield conn._setup_publisher('outbound')
+        self.assertEqual(publisher.confirm, True)
+        self.assertEqual(publisher.max_unconfirmed, 5)
+
     @inlineCallbacks
     def test_setup_raises(self):
         conn = yield self.mk_connector()
@@ -113,6 +138,36 @@ class TestBaseConnector(BaseConnectorTestCase):
         yield conn.teardown()
         self.assertFalse(consumer.keep_consuming)
 
+    @inlineCallbacks
+    def test_teardown_waits_for_confirms(self):
+        conn = yield self.mk_connector()
+        conn = self.connector_class(
+            conn.worker, 'foo', publisher_confirms=True)
+        publisher = yield conn._setup_publisher('outbound')
+        publisher.channel.hold_confirms = True
+        yield conn._publish_message(
+            'outbound', self.msg_helper.make_outbound("outbound"), None)
+        d = conn.teardown()
+        self.assertNoResult(d)
+        publisher.channel.send_confirms()
+        yield d
+
+    @inlineCallbacks
+    def test_teardown_logs_rejected_messages(self):
+        conn = yield self.mk_connector()
+        conn = self.connector_class(
+            conn.worker, 'foo', publisher_confirms=True)
+        publisher = yield conn._setup_publisher('outbound')
+        publisher.channel.hold_confirms = True
+        yield conn._publish_message(
+            'outbound', self.msg_helper.make_outbound("outbound"), None)
+        d = conn.teardown()
+        publisher.channel.send_confirms(acked=False)
+        yield d
+        [err] = self.flushLoggedErrors(PublishNackError)
+        self.assertEqual(
+            err.value.args, ("Message 1 rejected by broker.",))
+
     @inlineCallbacks
     def test_paused(self):
         conn, consumer = yield self.mk_consumer()
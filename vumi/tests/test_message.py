@@ -4,7 +4,8 @@ import json
 from vumi.tests.utils import RegexMatcher, UTCNearNow
 from vumi.message import (
     Message, TransportMessage, TransportEvent, TransportUserMessage,
-    format_vumi_date, parse_vumi_date, from_json, to_json)
+    format_vumi_date, parse_vumi_date, from_json, to_json, JSONMessageCodec,
+    SchemaMessageCodec)
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -95,6 +96,18 @@ class MessageTest(VumiTestCase):
             "thing": "dont_store_me",
         })
 
+    def test_message_copy(self):
+        timestamp = datetime(2015, 1, 2, 23, 14, 11)
+        msg = Message(a=5, b={'c': [1, {'d': timestamp}]}, e=(1, 2))
+        msg_copy = msg.copy()
+        self.assertEqual(msg_copy, msg)
+        self.assertEqual(type(msg_copy), Message)
+        self.assertFalse(msg_copy.payload is msg.payload)
+        self.assertFalse(msg_copy['b'] is msg['b'])
+        self.assertFalse(msg_copy['b']['c'] is msg['b']['c'])
+        self.assertFalse(msg_copy['b']['c'][1] is msg['b']['c'][1])
+        self.assertEqual(msg_copy['b']['c'][1]['d'], timestamp)
+
 
 class TransportMessageTestMixin(object):
     def make_message(self, **fields):
@@ -137,6 +150,14 @@ class TransportMessageTestMixin(object):
         msg.set_routing_endpoint('foo')
         self.assertEqual('foo', msg.routing_metadata['endpoint_name'])
 
+    def test_copy(self):
+        msg = self.make_message(helper_metadata={'foo': {'bar': 1}})
+        msg_copy = msg.copy()
+        self.assertEqual(msg_copy, msg)
+        self.assertEqual(type(msg_copy), type(msg))
+        msg_copy['helper_metadata']['foo']['bar'] = 2
+        self.assertEqual(msg['helper_metadata'], {'foo': {'bar': 1}})
+
 
 class TransportMessageTest(TransportMessageTestMixin, VumiTestCase):
     def make_message(self, **extra_fields):
@@ -470,3 +491,75 @@ class TransportEventTest(TransportMessageTestMixin, VumiTestCase):
         # self.assertEqual('sphex', msg['transport_name'])
         self.assertEqual('delivered', msg['delivery_status'])
         self.assertEqual({}, msg['helper_metadata'])
+
+
+class MessageCodecTestMixin(object):
+    def make_codec(self):
+        raise NotImplementedError()
+
+    def make_msg(self, **kw):
+        return TransportUserMessage(
+            to_addr='123', from_addr='456', transport_name='sphex',
+            transport_type='sms', content='hello', **kw)
+
+    def test_encode(self):
+        msg = self.make_msg()
+        self.assertEqual(
+            json.loads(self.make_codec().encode(msg)),
+            json.loads(msg.to_json()))
+
+    def test_decode(self):
+        msg = self.make_msg()
+        codec = self.make_codec()
+        decoded = codec.decode(codec.encode(msg), TransportUserMessage)
+        self.assertEqual(type(decoded), TransportUserMessage)
+        self.assertEqual(decoded, msg)
+        self.assertTrue(isinstance(decoded['timestamp'], datetime))
+
+    def test_decode_event(self):
+        event = TransportEvent(
+            event_type='ack', user_message_id='abc', sent_message_id='def')
+        codec = self.make_codec()
+        decoded = codec.decode(codec.encode(event), TransportEvent)
+        self.assertEqual(type(decoded), TransportEvent)
+        self.assertEqual(decoded, event)
+
+
+class JSONMessageCodecTest(MessageCodecTestMixin, VumiTestCase):
+    def make_codec(self):
+        return JSONMessageCodec()
+
+    def test_decode_nested_timestamps(self):
+        msg = self.make_msg(helper_metadata={
+            'foo': '2015-01-02 23:14:11.456000'})
+        codec = self.make_codec()
+        decoded = codec.decode(codec.encode(msg), TransportUserMessage)
+        self.assertEqual(
+            decoded['helper_metadata']['foo'],
+            datetime(2015, 1, 2, 23, 14, 11, microsecond=456000))
+
+
+class SchemaMessageCodecTest(MessageCodecTestMixin, VumiTestCase):
+    def make_codec(self):
+        return SchemaMessageCodec()
+
+    def test_decode_nested_timestamps(self):
+        msg = self.make_msg(helper_metadata={
+            'foo': '2015-01-02 23:14:11.456000'})
+        codec = self.make_codec()
+        decoded = codec.decode(codec.encode(msg), TransportUserMessage)
+        self.assertEqual(
+            decoded['helper_metadata']['foo'], '2015-01-02 23:14:11.456000')
+
+    def test_decode_invalid_timestamp(self):
+        codec = self.make_codec()
+        msg = self.make_msg(timestamp='foo')
+        decoded = codec.decode(msg.to_json(), TransportUserMessage)
+        self.assertEqual(decoded['timestamp'], 'foo')
+
+    def test_decode_without_ujson(self):
+        codec = SchemaMessageCodec(use_ujson=False)
+        self.assertEqual(codec.loads, json.loads)
+        msg = self.make_msg()
+        self.assertEqual(
+            codec.decode(codec.encode(msg), TransportUserMessage), msg)
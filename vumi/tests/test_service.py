@@ -1,11 +1,18 @@
 import json
 from collections import namedtuple
 
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, Deferred, gatherResults
+from twisted.internet.task import deferLater
+from twisted.python.failure import Failure
 
-from vumi.message import Message
-from vumi.service import Worker, WorkerCreator
+from vumi.message import (
+    Message, TransportUserMessage, SchemaMessageCodec)
+from vumi.service import (
+    Worker, WorkerCreator, PublishNackError, PublishChannelClosedError,
+    get_spec)
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
+from vumi.utils import vumi_resource_path
 
 
 def fake_amq_message(dictionary, delivery_tag='delivery_tag'):
@@ -15,6 +22,45 @@ def fake_amq_message(dictionary, delivery_tag='delivery_tag'):
                       content=Content(body=json.dumps(dictionary)))
 
 
+def wait0():
+    return deferLater(reactor, 0, lambda: None)
+
+
+class BlockingHandler(object):
+    """
+    A consumer callback that doesn't finish processing a message until told
+    to.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self._waiting = []
+
+    def __call__(self, msg):
+        d = Deferred()
+        self.pending.append((msg, d))
+        self._check_waiting()
+        return d
+
+    def keys(self):
+        return [msg['key'] for msg, _ in self.pending]
+
+    def finish(self, index):
+        self.pending[index][1].callback(None)
+
+    def wait_for(self, count):
+        d = Deferred()
+        self._waiting.append((count, d))
+        self._check_waiting()
+        return d
+
+    def _check_waiting(self):
+        for count, d in self._waiting[:]:
+            if len(self.pending) >= count:
+                self._waiting.remove((count, d))
+                d.callback(None)
+
+
 class TestService(VumiTestCase):
     def setUp(self):
         self.worker_helper = self.add_helper(WorkerHelper())
@@ -90,6 +136,118 @@ class TestService(VumiTestCase):
         [failure] = self.flushLoggedErrors()
         self.assertEqual(failure.getErrorMessage(), "oops")
 
+    @inlineCallbacks
+    def test_consume_concurrently(self):
+        """
+        With max_concurrency set, messages are processed without waiting for
+        earlier messages to finish, up to the limit.
+        """
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        handler = BlockingHandler()
+        consumer = yield worker.consume(
+            'test.routing.key', handler, max_concurrency=2)
+        for i in range(3):
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key',
+                fake_amq_message({"key": i}).content)
+        yield handler.wait_for(2)
+        yield wait0()
+        self.assertEqual(handler.keys(), [0, 1])
+        self.assertEqual(consumer._in_progress, 2)
+
+        handler.finish(1)
+        yield handler.wait_for(3)
+        self.assertEqual(handler.keys(), [0, 1, 2])
+
+        handler.finish(0)
+        handler.finish(2)
+        yield self.worker_helper.broker.wait_delivery()
+        self.assertEqual(consumer._in_progress, 0)
+
+    @inlineCallbacks
+    def test_consume_concurrently_ordered(self):
+        """
+        Messages with the same ordering key are processed in order, one at a
+        time.
+        """
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        handler = BlockingHandler()
+        consumer = yield worker.consume(
+            'test.routing.key', handler, max_concurrency=5,
+            ordering_fields=['from_addr'])
+        for i, from_addr in enumerate(['a', 'b', 'a', 'a']):
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key',
+                fake_amq_message({"key": i, "from_addr": from_addr}).content)
+        yield handler.wait_for(2)
+        yield wait0()
+        self.assertEqual(handler.keys(), [0, 1])
+        self.assertEqual(consumer._in_progress, 4)
+
+        handler.finish(0)
+        yield handler.wait_for(3)
+        yield wait0()
+        self.assertEqual(handler.keys(), [0, 1, 2])
+
+        handler.finish(2)
+        yield handler.wait_for(4)
+        self.assertEqual(handler.keys(), [0, 1, 2, 3])
+
+        handler.finish(1)
+        handler.finish(3)
+        yield self.worker_helper.broker.wait_delivery()
+        self.assertEqual(consumer._in_progress, 0)
+        self.assertEqual(consumer._ordered, {})
+
+    @inlineCallbacks
+    def test_consume_concurrently_pause(self):
+        """
+        Pausing a concurrent consumer waits for all messages in flight.
+        """
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        handler = BlockingHandler()
+        consumer = yield worker.consume(
+            'test.routing.key', handler, max_concurrency=5)
+        for i in range(2):
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key',
+                fake_amq_message({"key": i}).content)
+        yield handler.wait_for(2)
+        yield wait0()
+
+        pause_d = consumer.pause()
+        handler.finish(0)
+        self.assertFalse(pause_d.called)
+        handler.finish(1)
+        self.assertTrue(pause_d.called)
+        yield self.worker_helper.broker.wait_delivery()
+
+    @inlineCallbacks
+    def test_broken_consume_concurrently(self):
+        """
+        If a consumer function throws an exception while processing messages
+        concurrently, the error is logged and later messages are processed.
+        """
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        log = []
+
+        def consume_func(msg):
+            if msg['key'] == 0:
+                raise Exception("oops")
+            log.append(msg)
+
+        consumer = yield worker.consume(
+            'test.routing.key', consume_func, max_concurrency=2)
+        for i in range(2):
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key',
+                fake_amq_message({"key": i}).content)
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(log, [Message(key=1)])
+        self.assertEqual(consumer._in_progress, 0)
+        [failure] = self.flushLoggedErrors()
+        self.assertEqual(failure.getErrorMessage(), "oops")
+
     @inlineCallbacks
     def test_start_publisher(self):
         """The publisher should publish"""
@@ -103,6 +261,142 @@ class TestService(VumiTestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    @inlineCallbacks
+    def test_consume_with_message_codec(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        worker.message_codec = SchemaMessageCodec()
+        log = []
+        consumer = yield worker.consume(
+            'test.routing.key', log.append,
+            message_class=TransportUserMessage)
+        self.assertEqual(consumer.message_codec, worker.message_codec)
+        msg = TransportUserMessage(
+            to_addr='123', from_addr='456', transport_name='sphex',
+            transport_type='sms', helper_metadata={
+                'foo': '2015-01-02 23:14:11.456000'})
+        self.worker_helper.broker.basic_publish(
+            'vumi', 'test.routing.key',
+            fake_amq_message(json.loads(msg.to_json())).content)
+        yield self.worker_helper.broker.wait_delivery()
+        [consumed_msg] = log
+        self.assertEqual(consumed_msg['timestamp'], msg['timestamp'])
+        self.assertEqual(
+            consumed_msg['helper_metadata'],
+            {'foo': '2015-01-02 23:14:11.456000'})
+
+    @inlineCallbacks
+    def test_start_publisher_with_message_codec(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        worker.message_codec = SchemaMessageCodec()
+        publisher = yield worker.publish_to('test.routing.key')
+        self.assertEqual(publisher.message_codec, worker.message_codec)
+        publisher.publish_message(Message(key="value"))
+        [published_msg] = publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+        self.assertEquals(published_msg.body, '{"key": "value"}')
+
+    @inlineCallbacks
+    def test_start_publisher_with_confirms(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to('test.routing.key', confirm=True)
+        self.assertTrue(publisher.channel.confirming)
+        self.assertEqual(publisher.channel.publisher, publisher)
+        publisher.channel.hold_confirms = True
+
+        msg = yield publisher.publish_message(Message(key="value"))
+        self.assertEqual(msg, Message(key="value"))
+        [published_msg] = publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+        self.assertEquals(published_msg.body, '{"key": "value"}')
+        confirms_d = publisher.wait_for_confirms()
+        self.assertFalse(confirms_d.called)
+        publisher.channel.send_confirms()
+        yield confirms_d
+
+    @inlineCallbacks
+    def test_wait_for_confirms_without_confirm_mode(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to('test.routing.key')
+        yield publisher.publish_message(Message(key="value"))
+        self.assertTrue(publisher.wait_for_confirms().called)
+
+    @inlineCallbacks
+    def test_publish_nacked(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to('test.routing.key', confirm=True)
+        publisher.channel.hold_confirms = True
+        yield publisher.publish_message(Message(key="value"))
+        d = publisher.wait_for_confirms()
+        publisher.channel.send_confirms(acked=False)
+        yield self.assertFailure(d, PublishNackError)
+
+    @inlineCallbacks
+    def test_publish_confirm_window(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to(
+            'test.routing.key', confirm=True, max_unconfirmed=2)
+        publisher.channel.hold_confirms = True
+        ds = [publisher.publish_message(Message(key=i)) for i in range(3)]
+        dispatched = publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+        self.assertEqual(len(dispatched), 2)
+        self.assertEqual([d.called for d in ds], [True, True, False])
+        window_d = publisher.wait_for_window()
+        self.assertFalse(window_d.called)
+
+        publisher.confirmed(1, False, True)
+        self.assertTrue(ds[2].called)
+        self.assertEqual(len(dispatched), 3)
+        self.assertFalse(window_d.called)
+
+        publisher.channel.send_confirms()
+        self.assertTrue(window_d.called)
+        msgs = yield gatherResults(ds)
+        self.assertEqual([msg['key'] for msg in msgs], [0, 1, 2])
+
+    @inlineCallbacks
+    def test_publish_confirm_multiple(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to('test.routing.key', confirm=True)
+        publisher.channel.hold_confirms = True
+        yield publisher.publish_message(Message(key=0))
+        d1 = publisher.wait_for_confirms()
+        yield publisher.publish_message(Message(key=1))
+        yield publisher.publish_message(Message(key=2))
+        d2 = publisher.wait_for_confirms()
+        publisher.confirmed(2, True, True)
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+        publisher.confirmed(3, True, True)
+        self.assertTrue(d2.called)
+
+    @inlineCallbacks
+    def test_publish_channel_closed(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to(
+            'test.routing.key', confirm=True, max_unconfirmed=1)
+        publisher.channel.hold_confirms = True
+        yield publisher.publish_message(Message(key="value"))
+        confirms_d = publisher.wait_for_confirms()
+        window_d = publisher.wait_for_window()
+        self.assertFalse(window_d.called)
+
+        client = publisher.channel.client
+        client.channelFailed(
+            publisher.channel, Failure(Exception("channel gone")))
+        yield self.assertFailure(confirms_d, PublishChannelClosedError)
+        yield self.assertFailure(window_d, PublishChannelClosedError)
+        self.assertEqual(publisher._unconfirmed, {})
+
+    def test_publisher_confirm_spec(self):
+        spec = get_spec(vumi_resource_path('amqp-spec-0-9-1.xml'))
+        select = spec.classes.byname['confirm'].methods.byname['select']
+        self.assertEqual(select.response, False)
+        nack = spec.classes.byname['basic'].methods.byname['nack']
+        self.assertEqual(
+            [f.name for f in nack.fields],
+            ['delivery-tag', 'multiple', 'requeue'])
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
@@ -5,13 +5,17 @@ from twisted.internet.defer import Deferred, inlineCallbacks
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.web import http
-from twisted.web.client import WebClientContextFactory, Agent
+from twisted.web.client import (
+    WebClientContextFactory, Agent, ResponseNeverReceived)
 from twisted.internet.protocol import Protocol, Factory
+from twisted.internet.task import Clock
 
 from vumi.utils import (normalize_msisdn, vumi_resource_path, cleanup_msisdn,
                         get_operator_name, http_request, http_request_full,
                         get_first_word, redis_from_config, build_web_site,
-                        LogFilterSite, PkgResources)
+                        LogFilterSite, PkgResources, HttpConnectionPool,
+                        LRUCache, default_http_pool)
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.helpers import VumiTestCase, import_skip
 
@@ -230,6 +234,114 @@ class TestHttpUtils(VumiTestCase):
         self.assertEqual(request.delivered_body, "Yay")
         self.assertEqual(request.code, http.OK)
 
+    def make_pool(self, **kw):
+        pool = HttpConnectionPool(reactor, **kw)
+        self.add_cleanup(pool.closeCachedConnections)
+        return pool
+
+    @inlineCallbacks
+    def test_http_request_full_reuses_connections(self):
+        self.set_render(lambda r: "Yay")
+        pool = self.make_pool()
+        request = yield http_request_full(self.url, '', pool=pool)
+        self.assertEqual(request.delivered_body, "Yay")
+        request = yield http_request_full(self.url, '', pool=pool)
+        self.assertEqual(request.delivered_body, "Yay")
+        self.assertEqual(pool.stats, {
+            'requests': 2,
+            'new_connections': 1,
+            'reused_connections': 1,
+            'retries': 0,
+        })
+
+    @inlineCallbacks
+    def test_http_request_full_uses_default_pool(self):
+        self.set_render(lambda r: "Yay")
+        request = yield http_request_full(self.url, '')
+        self.assertEqual(request.delivered_body, "Yay")
+        request = yield http_request_full(self.url, '')
+        self.assertEqual(request.delivered_body, "Yay")
+        self.assertEqual(default_http_pool().stats, {
+            'requests': 2,
+            'new_connections': 1,
+            'reused_connections': 1,
+            'retries': 0,
+        })
+
+    @inlineCallbacks
+    def test_http_request_full_pool_agent_without_pool(self):
+        self.set_render(lambda r: "Yay")
+        pool = self.make_pool()
+
+        class FakeAgent(Agent):
+            def __init__(slf, reactor, contextFactory=None):
+                super(FakeAgent, slf).__init__(reactor, contextFactory)
+
+        request = yield http_request_full(
+            self.url, '', agent_class=FakeAgent, pool=pool)
+        self.assertEqual(request.delivered_body, "Yay")
+        self.assertEqual(pool.stats['requests'], 0)
+
+    @inlineCallbacks
+    def test_http_request_full_retries_stale_connection(self):
+        requests = []
+
+        def render(request):
+            requests.append(request)
+            if len(requests) == 2:
+                # Close the pooled connection without responding, as a
+                # server dropping an idle connection would.
+                request.transport.loseConnection()
+                return NOT_DONE_YET
+            request.setHeader('Content-Type', 'text/plain')
+            return "Yay"
+
+        self.root.render = render
+        pool = self.make_pool()
+        yield http_request_full(self.url, method='GET', pool=pool)
+        request = yield http_request_full(self.url, method='GET', pool=pool)
+        self.assertEqual(request.delivered_body, "Yay")
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(pool.stats['retries'], 1)
+        self.assertEqual(pool.stats['new_connections'], 1)
+        self.assertEqual(pool.stats['reused_connections'], 1)
+
+    @inlineCallbacks
+    def test_http_request_full_stale_connection_no_retry(self):
+        requests = []
+
+        def render(request):
+            requests.append(request)
+            if len(requests) == 2:
+                request.transport.loseConnection()
+                return NOT_DONE_YET
+            return "Yay"
+
+        self.root.render = render
+        pool = self.make_pool(retry=False)
+        yield http_request_full(self.url, method='GET', pool=pool)
+        d = http_request_full(self.url, method='GET', pool=pool)
+        yield self.assertFailure(d, ResponseNeverReceived)
+        self.assertEqual(len(requests), 2)
+
+    @inlineCallbacks
+    def test_http_connection_pool_metrics(self):
+        self.set_render(lambda r: "Yay")
+        metrics = MetricManager('vumi.test.')
+        pool = self.make_pool(max_per_host=5, idle_timeout=30,
+                              metrics=metrics)
+        self.assertEqual(pool.maxPersistentPerHost, 5)
+        self.assertEqual(pool.cachedConnectionTimeout, 30)
+        yield http_request_full(self.url, '', pool=pool)
+        yield http_request_full(self.url, '', pool=pool)
+        self.assertEqual(
+            len(metrics['http_pool.requests'].poll()), 2)
+        self.assertEqual(
+            len(metrics['http_pool.new_connections'].poll()), 1)
+        self.assertEqual(
+            len(metrics['http_pool.reused_connections'].poll()), 1)
+        self.assertEqual(metrics['http_pool.retries'].poll(), [])
+
     @inlineCallbacks
     def test_http_request_full_headers(self):
         def check_ua(request):
@@ -376,3 +488,63 @@ class TestPkgResources(VumiTestCase):
         pkg = PkgResources("vumi.tests")
         self.assertEqual(os.path.join(self.vumi_tests_path, 'foo/bar'),
                          pkg.path('foo/bar'))
+
+
+class TestLRUCache(VumiTestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue('a' in cache)
+        self.assertEqual(len(cache), 1)
+        cache.set('a', 2)
+        self.assertEqual(cache.get('a'), 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_max_size_zero(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = LRUCache(2, ttl=10, clock=clock)
+        cache.set('a', 1)
+        clock.advance(5)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        clock.advance(5)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_pop(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a', 'default'), 'default')
+        self.assertEqual(len(cache), 0)
+
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('c'), 3)
@@ -1,10 +1,12 @@
 from twisted.internet.defer import inlineCallbacks, succeed, Deferred
+from twisted.internet.task import Clock
 
 from vumi.worker import BaseConfig, BaseWorker
 from vumi.connectors import ReceiveInboundConnector, ReceiveOutboundConnector
 from vumi.tests.utils import LogCatcher
 from vumi.middleware.base import BaseMiddleware
 from vumi.tests.helpers import VumiTestCase, MessageHelper, WorkerHelper
+from vumi.message import JSONMessageCodec, SchemaMessageCodec
 
 
 class DummyWorker(BaseWorker):
@@ -50,6 +52,31 @@ class TestBaseConfig(VumiTestCase):
         config = BaseConfig({'amqp_prefetch_count': 10})
         self.assertEqual(config.amqp_prefetch_count, 10)
 
+    def test_amqp_max_concurrency(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_max_concurrency, 1)
+        self.assertEqual(config.amqp_ordering_fields, [])
+        config = BaseConfig({
+            'amqp_max_concurrency': 5, 'amqp_ordering_fields': ['from_addr']})
+        self.assertEqual(config.amqp_max_concurrency, 5)
+        self.assertEqual(config.amqp_ordering_fields, ['from_addr'])
+
+    def test_amqp_publisher_confirms(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_publisher_confirms, False)
+        self.assertEqual(config.amqp_max_unconfirmed, 100)
+        config = BaseConfig({
+            'amqp_publisher_confirms': True, 'amqp_max_unconfirmed': 10})
+        self.assertEqual(config.amqp_publisher_confirms, True)
+        self.assertEqual(config.amqp_max_unconfirmed, 10)
+
+    def test_message_codec(self):
+        config = BaseConfig({})
+        self.assertEqual(config.message_codec, JSONMessageCodec)
+        config = BaseConfig({
+            'message_codec': 'vumi.message.SchemaMessageCodec'})
+        self.assertEqual(config.message_codec, SchemaMessageCodec)
+
 
 class TestBaseWorker(VumiTestCase):
 
@@ -63,6 +90,7 @@ class TestBaseWorker(VumiTestCase):
     @inlineCallbacks
     def test_start_worker(self):
         worker, calls = self.worker, []
+        worker.setup_http_pool = CallRecorder(worker.setup_http_pool, calls)
         worker.setup_heartbeat = CallRecorder(worker.setup_heartbeat, calls)
         worker.setup_middleware = CallRecorder(worker.setup_middleware, calls)
         worker.setup_connectors = CallRecorder(worker.setup_connectors, calls)
@@ -76,6 +104,7 @@ class TestBaseWorker(VumiTestCase):
                               'worker_name=unnamed',
                               'Started the publisher'])
         self.assertEqual(calls, [
+            ('setup_http_pool', (), {}),
             ('setup_heartbeat', (), {}),
             ('setup_middleware', (), {}),
             ('setup_connectors', (), {}),
@@ -92,6 +121,8 @@ class TestBaseWorker(VumiTestCase):
         worker.teardown_connectors = CallRecorder(worker.teardown_connectors,
                                                   calls)
         worker.teardown_worker = CallRecorder(worker.teardown_worker, calls)
+        worker.teardown_http_pool = CallRecorder(worker.teardown_http_pool,
+                                                 calls)
         yield worker.startWorker()
         with LogCatcher() as lc:
             yield worker.stopWorker()
@@ -101,8 +132,46 @@ class TestBaseWorker(VumiTestCase):
             ('teardown_connectors', (), {}),
             ('teardown_middleware', (), {}),
             ('teardown_heartbeat', (), {}),
+            ('teardown_http_pool', (), {}),
         ])
 
+    @inlineCallbacks
+    def test_setup_http_pool(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'http_pool_max_per_host': 4,
+            'http_pool_idle_timeout': 30,
+            'http_pool_retry': False,
+            'http_pool_metrics_prefix': 'vumi.test.',
+        })
+        pool = worker.http_pool
+        self.assertEqual(pool.maxPersistentPerHost, 4)
+        self.assertEqual(pool.cachedConnectionTimeout, 30)
+        self.assertEqual(pool.retryAutomatically, False)
+        self.assertTrue('http_pool.requests' in worker._http_pool_metrics)
+        self.assertEqual(pool.metrics, worker._http_pool_metrics)
+        yield worker.stopWorker()
+        self.assertEqual(worker.http_pool, None)
+        self.assertEqual(worker._http_pool_metrics, None)
+
+    @inlineCallbacks
+    def test_http_pool_per_worker(self):
+        worker1 = yield self.worker_helper.get_worker(DummyWorker, {
+            'http_pool_max_per_host': 1,
+        })
+        worker2 = yield self.worker_helper.get_worker(DummyWorker, {
+            'http_pool_max_per_host': 3,
+        })
+        self.assertNotEqual(worker1.http_pool, worker2.http_pool)
+        self.assertEqual(worker1.http_pool.maxPersistentPerHost, 1)
+        self.assertEqual(worker2.http_pool.maxPersistentPerHost, 3)
+
+    def test_message_codec(self):
+        self.assertTrue(
+            isinstance(self.worker.message_codec, JSONMessageCodec))
+        worker = self.worker_helper.get_worker_raw(DummyWorker, {
+            'message_codec': 'vumi.message.SchemaMessageCodec'})
+        self.assertTrue(isinstance(worker.message_codec, SchemaMessageCodec))
+
     def test_setup_connectors_raises(self):
         worker = self.worker_helper.get_worker_raw(BaseWorker, {})
         self.assertRaises(NotImplementedError, worker.setup_connectors)
@@ -152,6 +221,59 @@ class TestBaseWorker(VumiTestCase):
         cfg = yield self.worker.get_config(msg)
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
+    @inlineCallbacks
+    def test_get_config_not_cached_by_default(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg1 = yield self.worker.get_config(msg)
+        cfg2 = yield self.worker.get_config(msg)
+        self.assertFalse(cfg1 is cfg2)
+        self.assertEqual(self.worker.config_cache_stats['misses'], 2)
+
+    @inlineCallbacks
+    def test_get_config_cached(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'config_cache_size': 10}, False)
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg1 = yield worker.get_config(msg)
+        cfg2 = yield worker.get_config(msg)
+        self.assertTrue(cfg1 is cfg2)
+        stats = worker.config_cache_stats
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertTrue(stats['build_time'] >= 0)
+
+    @inlineCallbacks
+    def test_get_cached_config(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'config_cache_size': 10}, False)
+        clock = Clock()
+        worker._config_cache.clock = clock
+        cfg1 = worker.get_cached_config('a', lambda: {})
+        cfg2 = worker.get_cached_config('b', lambda: {})
+        self.assertFalse(cfg1 is cfg2)
+        self.assertTrue(worker.get_cached_config('a', None) is cfg1)
+        clock.advance(worker.get_static_config().config_cache_ttl)
+        cfg3 = worker.get_cached_config('a', lambda: {})
+        self.assertFalse(cfg1 is cfg3)
+
+    @inlineCallbacks
+    def test_config_cache_metrics(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'config_cache_size': 10,
+            'config_cache_metrics_prefix': 'vumi.test.',
+        })
+        metrics = worker._config_cache_metrics
+        worker.get_cached_config('a', lambda: {})
+        worker.get_cached_config('a', None)
+        worker.get_cached_config('b', lambda: {})
+        self.assertEqual(
+            [v for _, v in metrics['config_cache.hits'].poll()], [1])
+        self.assertEqual(
+            [v for _, v in metrics['config_cache.misses'].poll()], [1, 1])
+        self.assertEqual(
+            len(metrics['config_cache.build_time'].poll()), 2)
+        yield worker.stopWorker()
+        self.assertEqual(worker._config_cache_metrics, None)
+
     def test__validate_config(self):
         # should call .validate_config()
         self.worker.validate_config = CallRecorder(self.worker.validate_config)
@@ -173,6 +295,29 @@ class TestBaseWorker(VumiTestCase):
         # test setup happened
         self.assertTrue(connector._consumers['inbound'].keep_consuming)
 
+    @inlineCallbacks
+    def test_setup_connector_concurrency(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'amqp_max_concurrency': 5, 'amqp_ordering_fields': ['from_addr'],
+        })
+        connector = yield worker.setup_connector(
+            ReceiveInboundConnector, 'foo')
+        consumer = connector._consumers['inbound']
+        self.assertEqual(consumer.max_concurrency, 5)
+        self.assertEqual(consumer.ordering_fields, ('from_addr',))
+
+    @inlineCallbacks
+    def test_setup_connector_publisher_confirms(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'amqp_publisher_confirms': True, 'amqp_max_unconfirmed': 10,
+        })
+        connector = yield worker.setup_connector(
+            ReceiveInboundConnector, 'foo')
+        publisher = connector._publishers['outbound']
+        self.assertEqual(publisher.confirm, True)
+        self.assertEqual(publisher.max_unconfirmed, 10)
+        self.assertTrue(publisher.channel.confirming)
+
     @inlineCallbacks
     def test_teardown_connector(self):
         connector = yield self.worker.setup_connector(ReceiveInboundConnector,
@@ -198,15 +343,18 @@ class TestBaseWorker(VumiTestCase):
     def test_pause_connectors(self):
         connector = yield self.worker.setup_ri_connector('foo')
         connector.unpause()
+        self.assertFalse(self.worker.connectors_paused)
         self.worker.pause_connectors()
         self.assertTrue(connector.paused)
+        self.assertTrue(self.worker.connectors_paused)
 
     @inlineCallbacks
     def test_unpause_connectors(self):
         connector = yield self.worker.setup_ri_connector('foo')
-        connector.pause()
+        self.worker.pause_connectors()
         self.worker.unpause_connectors()
         self.assertFalse(connector.paused)
+        self.assertFalse(self.worker.connectors_paused)
 
     @inlineCallbacks
     def test_pause_connectors_unprocessed_messages(self):
@@ -140,7 +140,8 @@ class AppositTransport(HttpRpcTransport):
             self.outbound_url,
             data=urlencode(params),
             method='POST',
-            headers={'Content-Type': self.CONTENT_TYPE})
+            headers={'Content-Type': self.CONTENT_TYPE},
+            pool=self.http_pool)
 
         self.emit("Response: (%s) %r" %
                   (response.code, response.delivered_body))
@@ -64,7 +64,8 @@ class CellulantSmsTransport(HttpRpcTransport):
         log.msg("Sending outbound message: %s" % (message,))
         url = '%s?%s' % (self._outbound_url, urlencode(params))
         log.msg("Making HTTP request: %s" % (url,))
-        response = yield http_request_full(url, '', method='GET')
+        response = yield http_request_full(
+            url, '', method='GET', pool=self.http_pool)
         log.msg("Response: (%s) %r" % (response.code, response.delivered_body))
         content = response.delivered_body.strip()
 
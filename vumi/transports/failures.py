@@ -4,9 +4,12 @@ import time
 from datetime import datetime
 from uuid import uuid4
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, maybeDeferred,
+    DeferredSemaphore)
 from twisted.internet.task import LoopingCall
 
+from vumi.blinkenlights.metrics import MetricManager, Metric, Count, LAST
 from vumi.service import Worker
 from vumi.message import TransportMessage, to_json
 from vumi.persist.txredis_manager import TxRedisManager
@@ -57,6 +60,11 @@ class FailureWorker(Worker):
     Base class for transport failure handlers.
 
     Subclasses should implement :meth:`handle_failure`.
+
+    Due retries are claimed from Redis up to ``retry_batch_size`` at a time
+    and published with at most ``retry_concurrency`` publishes in flight.
+    If ``retry_metrics_prefix`` is set, the retry backlog depth and the
+    number of retries delivered are published as metrics.
     """
 
     GRANULARITY = 5  # seconds
@@ -66,10 +74,16 @@ class FailureWorker(Worker):
     INITIAL_DELAY = 1
     DELAY_FACTOR = 3
 
+    BATCH_SIZE = 100
+    CONCURRENCY = 10
+
+    metrics = None
+
     @inlineCallbacks
     def startWorker(self):
         self.configure_retries()
         yield self.set_up_redis()
+        yield self.set_up_metrics()
         retry_rkey = self.get_rkey('retry')
         failures_rkey = self.get_rkey('failures')
         self.retry_publisher = yield self.publish_to(retry_rkey)
@@ -83,11 +97,15 @@ class FailureWorker(Worker):
             self.delivery_loop.stop()
             yield self.delivery_done
         yield self.consumer.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
+        yield self.pipeline.flush()
         yield self.redis.close_manager()
 
     def configure_retries(self):
         for param in ['GRANULARITY', 'MAX_DELAY', 'INITIAL_DELAY',
-                      'DELAY_FACTOR', 'DELIVERY_PERIOD']:
+                      'DELAY_FACTOR', 'DELIVERY_PERIOD', 'BATCH_SIZE',
+                      'CONCURRENCY']:
             setattr(self, param, self.config.get('retry_' + param.lower(),
                                                  getattr(self, param)))
 
@@ -97,6 +115,27 @@ class FailureWorker(Worker):
         redis = yield TxRedisManager.from_config(r_config)
         self.redis = redis.sub_manager("failures:%s" % (
                 self.config['transport_name'],))
+        self._pipeline = None
+
+    @property
+    def pipeline(self):
+        """
+        A pipelined view of our Redis manager. Commands issued through this
+        are sent without waiting for earlier replies, and :meth:`flush` on it
+        waits for any that are unanswered.
+        """
+        if self._pipeline is None:
+            self._pipeline = self.redis.pipeline()
+        return self._pipeline
+
+    @inlineCallbacks
+    def set_up_metrics(self):
+        prefix = self.config.get('retry_metrics_prefix')
+        if prefix is None:
+            return
+        self.metrics = yield self.start_publisher(MetricManager, prefix)
+        self.metrics.register(Metric('retries.backlog', [LAST]))
+        self.metrics.register(Count('retries.delivered'))
 
     def start_retry_delivery(self):
         self.delivery_loop = None
@@ -117,7 +156,7 @@ class FailureWorker(Worker):
         return ".".join(("failure", timestamp, failure_id))
 
     def add_to_failure_set(self, key):
-        return self.redis.sadd("failure_keys", key)
+        return self.pipeline.sadd("failure_keys", key)
 
     def get_failure_keys(self):
         return self.redis.smembers("failure_keys")
@@ -133,6 +172,8 @@ class FailureWorker(Worker):
 
         If ``retry_delay`` is not ``None``, a retry will be scheduled
         approximately ``retry_delay`` seconds in the future.
+
+        All the writes are sent to Redis together.
         """
         message_json = message
         if not isinstance(message, basestring):
@@ -141,29 +182,41 @@ class FailureWorker(Worker):
         key = self.failure_key()
         if not retry_delay:
             retry_delay = 0
-        yield self.redis.hmset(key, {
+        writes = [
+            self.pipeline.hmset(key, {
                 "message": message_json,
                 "reason": reason,
                 "retry_delay": str(retry_delay),
-                })
-        yield self.add_to_failure_set(key)
+                }),
+            self.add_to_failure_set(key),
+            ]
         if retry_delay:
-            yield self.store_retry(key, retry_delay)
+            writes.append(self.store_retry(key, retry_delay))
+        yield gatherResults(writes, consumeErrors=True)
         returnValue(key)
 
     def get_failure(self, failure_key):
-        return self.redis.hgetall(failure_key)
+        return self.pipeline.hgetall(failure_key)
+
+    def get_failures(self, failure_keys):
+        """
+        Fetch several failures in a single round trip.
+        """
+        return gatherResults(
+            [self.get_failure(key) for key in failure_keys],
+            consumeErrors=True)
 
-    @inlineCallbacks
     def store_retry(self, failure_key, retry_delay, now=None):
         timestamp = self.get_next_write_timestamp(retry_delay, now=now)
         bucket_key = "retry_keys." + timestamp
-        yield self.redis.sadd(bucket_key, failure_key)
-        yield self.store_read_timestamp(timestamp)
+        return gatherResults([
+            self.pipeline.sadd(bucket_key, failure_key),
+            self.store_read_timestamp(timestamp),
+            ], consumeErrors=True)
 
     def store_read_timestamp(self, timestamp):
         score = time.mktime(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
-        return self.redis.zadd('retry_timestamps', **{timestamp: score})
+        return self.pipeline.zadd('retry_timestamps', **{timestamp: score})
 
     def get_next_write_timestamp(self, delta, now=None):
         if now is None:
@@ -183,14 +236,40 @@ class FailureWorker(Worker):
 
     @inlineCallbacks
     def get_next_retry_key(self):
+        retry_keys = yield self.get_next_retry_keys(1)
+        if retry_keys:
+            returnValue(retry_keys[0])
+
+    @inlineCallbacks
+    def get_next_retry_keys(self, limit):
+        """
+        Claim up to ``limit`` due retries from the earliest due retry
+        bucket.
+
+        The claims are sent to Redis together, so this costs a single round
+        trip however many retries are claimed.
+        """
         timestamp = yield self.get_next_read_timestamp()
         if not timestamp:
-            return
+            returnValue([])
         bucket_key = "retry_keys." + timestamp
-        failure_key = yield self.redis.spop(bucket_key)
-        if (yield self.redis.scard(bucket_key)) < 1:
+        spop_ds = [self.pipeline.spop(bucket_key) for _ in xrange(limit)]
+        scard_d = self.pipeline.scard(bucket_key)
+        retry_keys = yield gatherResults(spop_ds, consumeErrors=True)
+        if (yield scard_d) < 1:
             yield self.redis.zrem('retry_timestamps', timestamp)
-        returnValue(failure_key)
+        returnValue([key for key in retry_keys if key])
+
+    @inlineCallbacks
+    def get_retry_backlog(self):
+        """
+        Return the number of retries waiting to be delivered.
+        """
+        timestamps = yield self.redis.zrange('retry_timestamps', 0, -1)
+        counts = yield gatherResults([
+            self.pipeline.scard("retry_keys." + timestamp)
+            for timestamp in timestamps], consumeErrors=True)
+        returnValue(sum(counts))
 
     @inlineCallbacks
     def deliver_retry(self, retry_key, publisher):
@@ -198,13 +277,50 @@ class FailureWorker(Worker):
         published = yield publisher.publish_raw(failure['message'])
         returnValue(published)
 
+    def publish_retries(self, failures):
+        """
+        Publish the messages from ``failures`` with at most
+        ``CONCURRENCY`` publishes in flight at a time.
+        """
+        semaphore = DeferredSemaphore(self.CONCURRENCY)
+        return gatherResults([
+            semaphore.run(self.publish_retry, failure)
+            for failure in failures], consumeErrors=True)
+
+    def publish_retry(self, failure):
+        d = maybeDeferred(
+            self.retry_publisher.publish_raw, failure['message'])
+        if self.metrics is not None:
+            d.addCallback(self._count_delivered)
+        return d
+
+    def _count_delivered(self, result):
+        self.metrics['retries.delivered'].inc()
+        return result
+
     @inlineCallbacks
     def deliver_retries(self):
+        """
+        Deliver due retries in batches of ``BATCH_SIZE``, updating the
+        backlog metric after each batch so that it tracks a long drain.
+        """
+        batches = 0
         while True:
-            retry_key = yield self.get_next_retry_key()
-            if not retry_key:
-                return
-            yield self.deliver_retry(retry_key, self.retry_publisher)
+            retry_keys = yield self.get_next_retry_keys(self.BATCH_SIZE)
+            if not retry_keys:
+                break
+            failures = yield self.get_failures(retry_keys)
+            yield self.publish_retries(failures)
+            batches += 1
+            yield self._report_retry_backlog()
+        if not batches:
+            yield self._report_retry_backlog()
+
+    @inlineCallbacks
+    def _report_retry_backlog(self):
+        if self.metrics is not None:
+            backlog = yield self.get_retry_backlog()
+            self.metrics['retries.backlog'].set(backlog)
 
     def next_retry_delay(self, delay):
         if not delay:
@@ -67,7 +67,8 @@ class MediaEdgeGSMTransport(HttpRpcTransport):
             }
 
             url = '%s?%s' % (self._outbound_url, urlencode(params))
-            response = yield http_request_full(url, '', method='GET')
+            response = yield http_request_full(
+                url, '', method='GET', pool=self.http_pool)
             log.msg("Response: (%s) %r" % (response.code,
                 response.delivered_body))
             if response.code == http.OK:
@@ -52,7 +52,8 @@ class MediafoneTransport(HttpRpcTransport):
         log.msg("Sending outbound message: %s" % (message,))
         url = '%s?%s' % (self._outbound_url, urlencode(params))
         log.msg("Making HTTP request: %s" % (url,))
-        response = yield http_request_full(url, '', method='GET')
+        response = yield http_request_full(
+            url, '', method='GET', pool=self.http_pool)
         log.msg("Response: (%s) %r" % (response.code, response.delivered_body))
         if response.code == http.OK:
             yield self.publish_ack(user_message_id=message['message_id'],
@@ -41,7 +41,7 @@ class MTechKenyaTransport(HttpRpcTransport):
         config = self.get_static_config()
         url = '%s?%s' % (config.outbound_url, urlencode(params))
         log.msg("Making HTTP request: %s" % (url,))
-        return http_request_full(url, '', method='POST')
+        return http_request_full(url, '', method='POST', pool=self.http_pool)
 
     @inlineCallbacks
     def handle_outbound_message(self, message):
@@ -103,4 +103,4 @@ class MTechKenyaTransportV2(MTechKenyaTransport):
         config = self.get_static_config()
         return http_request_full(
             config.outbound_url, urlencode(params), method='POST',
-            headers=self.headers)
+            headers=self.headers, pool=self.http_pool)
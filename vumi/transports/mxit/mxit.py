@@ -196,7 +196,8 @@ class MxitTransport(HttpRpcTransport):
             'scope': ' '.join(config.api_auth_scopes)
         })
         response = yield http_request_full(url=url, method='POST',
-                                           headers=headers, data=data)
+                                           headers=headers, data=data,
+                                           pool=self.http_pool)
         data = json.loads(response.delivered_body)
         if 'error' in data:
             raise MxitTransportException(
@@ -225,7 +226,7 @@ class MxitTransport(HttpRpcTransport):
         resp = yield http_request_full(
             config.api_send_url, data=json.dumps(data), headers=headers,
             method="POST", timeout=config.timeout,
-            context_factory=context_factory)
+            context_factory=context_factory, pool=self.http_pool)
 
     @inlineCallbacks
     def render_response(self, message):
@@ -20,6 +20,10 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
     throttle_delay = ConfigFloat(
         "Delay (in seconds) before retrying a message after receiving "
         "`ESME_RTHROTTLED` or `ESME_RMSGQFUL`.", default=0.1, static=True)
+    throttle_retry_batch_size = ConfigInt(
+        "The number of throttled messages to retry at once when checking "
+        "whether the SMSC is still throttling us. Default 1.",
+        default=1, static=True)
     deliver_sm_decoding_error = ConfigText(
         'The error to respond with when we were unable to decode all parts '
         'of a PDU.', default='ESME_RDELIVERYFAILURE', static=True)
@@ -27,6 +31,12 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
         'How long (in seconds) to wait for the SMSC to return with a '
         '`submit_sm_resp`. Defaults to 24 hours.',
         default=(60 * 60 * 24), static=True)
+    sequence_number_cache_ttl = ConfigFloat(
+        'How long (in seconds) to remember sequence number to message ID '
+        'mappings in memory so that most `submit_sm_resp` PDUs can be matched '
+        'to their messages without a Redis lookup. Set to 0 to always use '
+        'Redis. Default 60.',
+        default=60, static=True)
     third_party_id_expiry = ConfigInt(
         'How long (in seconds) to keep 3rd party message IDs around to allow '
         'for matching submit_sm_resp and delivery report messages. Defaults '
@@ -111,10 +121,41 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
         default=55, static=True)
     mt_tps = ConfigInt(
         'Mobile Terminated Transactions per Second. The Maximum Vumi '
-        'messages per second to attempt to put on the wire. '
+        'messages per second to attempt to put on the wire. Messages are '
+        'spread evenly over each second rather than sent in a burst. '
         'Defaults to 0 which means no throttling is applied. '
         '(NOTE: 1 Vumi message may result in multiple PDUs)',
         default=0, static=True, required=False)
+    mt_tps_burst = ConfigInt(
+        'The maximum number of Vumi messages that may be sent in a burst '
+        'after a quiet period when `mt_tps` is set. Defaults to 0 which '
+        'means one second\'s worth of messages (`mt_tps`).',
+        default=0, static=True, required=False)
+    mt_window_size = ConfigInt(
+        'The maximum number of `submit_sm` PDUs that may be waiting for a '
+        '`submit_sm_resp` at once. Defaults to 0 which means no limit.',
+        default=0, static=True, required=False)
+    mt_window_response_timeout = ConfigFloat(
+        'How long (in seconds) to wait for a `submit_sm_resp` before '
+        'assuming it has been lost and freeing its slot in the window set by '
+        '`mt_window_size`. Set to 0 to wait forever. Default 60.',
+        default=60, static=True, required=False)
+    sequence_number_block_size = ConfigInt(
+        'How many SMPP sequence numbers to lease from Redis at a time. '
+        'Leasing blocks of sequence numbers avoids a Redis round trip for '
+        'most PDUs, at the cost of skipping any unused numbers in a block '
+        'when the transport stops. Default 1 (no leasing).',
+        default=1, static=True)
+    pdu_trace_sample_rate = ConfigInt(
+        'Log one in every N PDUs sent or received (if the protocol is '
+        'noisy). PDUs that are not sampled are never formatted for logging. '
+        'Set to 0 to disable PDU logging. Default 1 (log every PDU).',
+        default=1, static=True)
+    pdu_trace_buffer_size = ConfigInt(
+        'The number of recently sent and received PDUs to keep so they can '
+        'be dumped for debugging. These are kept unformatted, so this is '
+        'cheap. Set to 0 to disable. Default 100.',
+        default=100, static=True)
 
     # TODO: Deprecate these fields when confmodel#5 is done.
     host = ConfigText(
@@ -1,4 +1,5 @@
 import binascii
+import struct
 
 from vumi.transports.smpp.smpp_utils import unpacked_pdu_opts
 
@@ -46,3 +47,56 @@ def chop_pdu_stream(data):
     pdu, data = (data[0:cmd_length],
                  data[cmd_length:])
     return pdu, data
+
+
+class PDUBuffer(object):
+    """
+    Frames a stream of bytes into SMPP PDUs.
+
+    Data is appended to a single :class:`bytearray` and complete PDUs are
+    sliced out of it at an advancing offset, so extracting many PDUs from
+    one large read doesn't copy the rest of the buffer for each PDU. The
+    consumed bytes are discarded once per call to :meth:`feed`.
+    """
+
+    HEADER_LENGTH = 16
+    _length_struct = struct.Struct('!I')
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def feed(self, data):
+        """
+        Add received data to the buffer.
+        """
+        if self._offset:
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer.extend(data)
+
+    def next_pdu(self):
+        """
+        Remove and return the next complete PDU in the buffer as a byte
+        string, or ``None`` if there isn't one yet.
+        """
+        buf, offset = self._buffer, self._offset
+        if len(buf) - offset < self.HEADER_LENGTH:
+            return None
+        (cmd_length,) = self._length_struct.unpack_from(buf, offset)
+        if len(buf) - offset < cmd_length:
+            return None
+        self._offset = offset + cmd_length
+        return bytes(buf[offset:self._offset])
+
+    def pdus(self):
+        """
+        Remove and yield each complete PDU in the buffer.
+        """
+        pdu = self.next_pdu()
+        while pdu is not None:
+            yield pdu
+            pdu = self.next_pdu()
@@ -6,7 +6,8 @@ from twisted.internet import reactor
 from twisted.internet.protocol import Protocol, ClientFactory
 from twisted.internet.task import LoopingCall
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, maybeDeferred, DeferredQueue, succeed)
+    inlineCallbacks, returnValue, maybeDeferred, DeferredQueue, succeed,
+    gatherResults)
 
 from smpp.pdu import unpack_pdu
 from smpp.pdu_builder import (
@@ -18,9 +19,8 @@ from smpp.pdu_builder import (
 
 from vumi import log
 from vumi.transports.smpp.pdu_utils import (
-    pdu_ok, seq_no, command_status, command_id, message_id, chop_pdu_stream)
-
-import binascii
+    pdu_ok, seq_no, command_status, command_id, message_id, PDUBuffer)
+from vumi.transports.smpp.tracing import LazyFormat, LazyHex, PDUTracer
 
 GSM_MAX_SMS_BYTES = 140
 GSM_MAX_SMS_7BIT_CHARS = 160
@@ -69,7 +69,11 @@ class EsmeTransceiver(Protocol):
         self.vumi_transport = vumi_transport
         self.config = self.vumi_transport.get_static_config()
 
-        self.buffer = b''
+        self.buffer = PDUBuffer()
+        self.tracer = PDUTracer(
+            sample_rate=self.config.pdu_trace_sample_rate,
+            buffer_size=self.config.pdu_trace_buffer_size,
+            clock=self.clock)
         self.state = self.CLOSED_STATE
 
         self.deliver_sm_processor = self.vumi_transport.deliver_sm_processor
@@ -85,12 +89,13 @@ class EsmeTransceiver(Protocol):
         self.unbind_resp_queue = DeferredQueue()
 
     def emit(self, msg):
+        # msg may be a LazyFormat, which is only formatted here.
         if self.noisy:
-            log.debug(msg)
+            log.debug(str(msg))
 
     def very_noisy_emit(self, msg):
         if self.very_noisy:
-            log.debug(msg)
+            log.debug(str(msg))
 
     def connectionMade(self):
         self.state = self.OPEN_STATE
@@ -207,26 +212,40 @@ class EsmeTransceiver(Protocol):
         :param smpp.pdu_builder.PDU pdu:
             The PDU object to send.
         """
-        self.emit('OUTGOING >> %r' % (pdu.get_obj(),))
-        self.very_noisy_emit('OUTGOING raw >> %s' % (pdu.get_hex(),))
-        return self.transport.write(pdu.get_bin())
+        data = pdu.get_bin()
+        if self.tracer.trace('OUTGOING', pdu.get_obj(), data):
+            self.emit(LazyFormat('OUTGOING >> %r', pdu.get_obj()))
+            self.very_noisy_emit(
+                LazyFormat('OUTGOING raw >> %s', LazyHex(data)))
+        return self.transport.write(data)
 
     def dataReceived(self, data):
-        self.buffer += data
-        data = self.handle_buffer()
-        while data is not None:
-            self.very_noisy_emit(
-                'INCOMING raw << %s' % (binascii.b2a_hex(data),))
-            self.on_pdu(unpack_pdu(data))
-            data = self.handle_buffer()
+        self.buffer.feed(data)
+        for data in self.buffer.pdus():
+            pdu = unpack_pdu(data)
+            if self.tracer.trace('INCOMING', pdu, data):
+                self.very_noisy_emit(
+                    LazyFormat('INCOMING raw << %s', LazyHex(data)))
+                self.emit(LazyFormat('INCOMING << %r', pdu))
+            self.on_pdu(pdu)
 
     def handle_buffer(self):
-        pdu_found = chop_pdu_stream(self.buffer)
-        if pdu_found is None:
-            return
+        return self.buffer.next_pdu()
+
+    def dump_pdu_trace(self):
+        """
+        Log the PDUs most recently sent and received on this bind.
+
+        See the ``pdu_trace_buffer_size`` config option.
 
-        data, self.buffer = pdu_found
-        return data
+        :returns:
+            A list of dicts describing the PDUs, oldest first.
+        """
+        entries = self.tracer.dump()
+        for entry in entries:
+            log.msg('PDU trace: %(timestamp)s %(direction)s %(command_id)s '
+                    '%(sequence_number)s %(hex)s' % entry)
+        return entries
 
     def on_pdu(self, pdu):
         """
@@ -236,7 +255,6 @@ class EsmeTransceiver(Protocol):
             The dict result one gets when calling ``smpp.pdu.unpack_pdu()``
             on the received PDU
         """
-        self.emit('INCOMING << %r' % (pdu,))
         handler = getattr(self, 'handle_%s' % (command_id(pdu),),
                           self.on_unsupported_command_id)
         return maybeDeferred(handler, pdu)
@@ -485,9 +503,13 @@ class EsmeTransceiver(Protocol):
             for key, value in optional_parameters.items():
                 pdu.add_optional_parameter(key, value)
 
-        yield self.vumi_transport.message_stash.set_sequence_number_message_id(
+        # Redis handles our commands in order, so the mapping is stored
+        # before we look it up for the response even if we don't wait for it
+        # before sending the PDU.
+        d = self.vumi_transport.message_stash.set_sequence_number_message_id(
             sequence_number, vumi_message_id)
         self.send_pdu(pdu)
+        yield d
         returnValue([sequence_number])
 
     def submit_sm_long(self, vumi_message_id, destination_addr, long_message,
@@ -559,6 +581,18 @@ class EsmeTransceiver(Protocol):
             message = message[payload_length:]
         return split_msg
 
+    def _gather_parts(self, ds):
+        """
+        Wait for the multipart info deferred and the ``submit_sm`` deferreds
+        for each part in ``ds``, and return the parts' sequence numbers.
+        The first failure, if any, is passed on unwrapped.
+        """
+        d = gatherResults(ds, consumeErrors=True)
+        d.addCallbacks(
+            lambda results: [seq for seqs in results[1:] for seq in seqs],
+            lambda f: f.value.subFailure)
+        return d
+
     @inlineCallbacks
     def submit_csm_sar(self, vumi_message_id, destination_addr, **pdu_params):
         """
@@ -578,23 +612,24 @@ class EsmeTransceiver(Protocol):
                 **pdu_params)
             returnValue(sequence_numbers)
 
-        optional_parameters = pdu_params.pop('optional_parameters', {}).copy()
+        optional_parameters = pdu_params.pop('optional_parameters', {})
         ref_num = yield self.sequence_generator.next()
-        sequence_numbers = []
-        yield self.vumi_transport.message_stash.init_multipart_info(
-            vumi_message_id, len(split_msg))
+        # The parts are submitted without waiting for each other's Redis
+        # commands, which Redis still handles in the order they're sent.
+        ds = [self.vumi_transport.message_stash.init_multipart_info(
+            vumi_message_id, len(split_msg))]
         for i, msg in enumerate(split_msg):
-            pdu_params = pdu_params.copy()
-            optional_parameters.update({
+            part_optional_parameters = optional_parameters.copy()
+            part_optional_parameters.update({
                 # Reference number must be between 00 & FFFF
                 'sar_msg_ref_num': (ref_num % 0xFFFF),
                 'sar_total_segments': len(split_msg),
                 'sar_segment_seqnum': i + 1,
             })
-            sequence_number = yield self.submit_sm(
+            ds.append(self.submit_sm(
                 vumi_message_id, destination_addr, short_message=msg,
-                optional_parameters=optional_parameters, **pdu_params)
-            sequence_numbers.extend(sequence_number)
+                optional_parameters=part_optional_parameters, **pdu_params))
+        sequence_numbers = yield self._gather_parts(ds)
         returnValue(sequence_numbers)
 
     @inlineCallbacks
@@ -627,9 +662,10 @@ class EsmeTransceiver(Protocol):
             returnValue(sequence_numbers)
 
         ref_num = yield self.sequence_generator.next()
-        sequence_numbers = []
-        yield self.vumi_transport.message_stash.init_multipart_info(
-            vumi_message_id, len(split_msg))
+        # The parts are submitted without waiting for each other's Redis
+        # commands, which Redis still handles in the order they're sent.
+        ds = [self.vumi_transport.message_stash.init_multipart_info(
+            vumi_message_id, len(split_msg))]
         for i, msg in enumerate(split_msg):
             # 0x40 is the UDHI flag indicating that this payload contains a
             # user data header.
@@ -653,10 +689,10 @@ class EsmeTransceiver(Protocol):
                 chr(i + 1),
             ])
             short_message = udh + msg
-            sequence_number = yield self.submit_sm(
+            ds.append(self.submit_sm(
                 vumi_message_id, destination_addr, short_message=short_message,
-                **pdu_params)
-            sequence_numbers.extend(sequence_number)
+                **pdu_params))
+        sequence_numbers = yield self._gather_parts(ds)
         returnValue(sequence_numbers)
 
     @require_bind
@@ -1,5 +1,7 @@
 # -*- test-case-name: vumi.transports.smpp.tests.test_sequence -*-
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed)
+from twisted.python.failure import Failure
 
 
 class RedisSequence(object):
@@ -10,11 +12,29 @@ class RedisSequence(object):
 
     This is backed by Redis' atomicity and safe to use in a
     distributed system.
+
+    If ``block_size`` is greater than one, blocks of that many sequence
+    numbers are leased from Redis at a time and handed out locally, so most
+    sequence numbers don't need a Redis round trip. Leased numbers are unique
+    across all processes sharing the Redis key, but they are no longer
+    handed out in strictly increasing order across processes and any
+    numbers left in a block when the process stops are skipped.
+
+    The counter in Redis is never reset, whatever the ``block_size``.
+    Sequence numbers wrap back to 1 after ``rollover_at`` instead, so
+    processes with different block sizes can safely share a Redis key.
     """
 
-    def __init__(self, redis, rollover_at=0xFFFF0000):
+    def __init__(self, redis, rollover_at=0xFFFF0000, block_size=1):
         self.redis = redis
         self.rollover_at = rollover_at
+        self.block_size = block_size
+        # The next counter value to hand out and the end (exclusive) of the
+        # currently leased block.
+        self._lease_next = 0
+        self._lease_end = 0
+        self._leasing = False
+        self._lease_waiters = []
 
     def __iter__(self):
         return self
@@ -22,59 +42,63 @@ class RedisSequence(object):
     def next(self):
         return self.get_next_seq()
 
-    @inlineCallbacks
     def get_next_seq(self):
         """Get the next available SMPP sequence number.
 
         The valid range of sequence number is 0x00000001 to 0xFFFFFFFF.
 
-        We start trying to wrap at 0xFFFF0000 so we can keep returning values
-        (up to 0xFFFF of them) even while someone else is in the middle of
-        resetting the counter.
+        Sequence numbers wrap back to 1 after `rollover_at`.
         """
-        seq = yield self.redis.incr('smpp_last_sequence_number')
+        if self.block_size > 1:
+            return self._get_next_leased_seq()
+        return self._get_next_unleased_seq()
 
-        if seq >= self.rollover_at:
-            # We're close to the upper limit, so try to reset. It doesn't
-            # matter if we actually succeed or not, since we're going to return
-            # `seq` anyway.
-            yield self._reset_seq_counter()
+    @inlineCallbacks
+    def _get_next_unleased_seq(self):
+        counter = yield self.redis.incr('smpp_last_sequence_number')
+        returnValue(self._wrap(counter))
 
-        returnValue(seq)
+    def _wrap(self, counter):
+        """Map a counter value onto the range 1 to `rollover_at`.
 
-    @inlineCallbacks
-    def _reset_seq_counter(self):
-        """Reset the sequence counter in a safe manner.
-
-        NOTE: There is a potential race condition in this implementation. If we
-        acquire the lock and it expires while we still think we hold it, it's
-        possible for the sequence number to be reset by someone else between
-        the final vlue check and the reset call. This seems like a very
-        unlikely situation, so we'll leave it like that for now.
-
-        A better solution is to replace this whole method with a lua script
-        that we send to redis, but scripting support is still very new at the
-        time of writing.
+        The counter in Redis is never reset, so this wraps consistently for
+        every process without any locking.
         """
-        # SETNX can be used as a lock.
-        locked = yield self.redis.setnx('smpp_last_sequence_number_wrap', 1)
-
-        # If someone crashed in exactly the wrong place, the lock may be
-        # held by someone else but have no expire time. A race condition
-        # here may set the TTL multiple times, but that's fine.
-        if (yield self.redis.ttl('smpp_last_sequence_number_wrap')) < 0:
-            # The TTL only gets set if the lock exists and recently had no TTL.
-            yield self.redis.expire('smpp_last_sequence_number_wrap', 10)
-
-        if not locked:
-            # We didn't actually get the lock, so our job is done.
-            return
+        return (counter - 1) % self.rollover_at + 1
+
+    def _get_next_leased_seq(self):
+        if self._lease_next < self._lease_end and not self._lease_waiters:
+            counter = self._lease_next
+            self._lease_next += 1
+            return succeed(self._wrap(counter))
+        d = Deferred()
+        self._lease_waiters.append(d)
+        if not self._leasing:
+            self._lease_block()
+        return d
 
-        if (yield self.redis.get('smpp_last_sequence_number')) < 0xFFFF0000:
-            # Our stored sequence number is no longer outside the allowed
-            # range, so someone else must have reset it before we got the lock.
+    @inlineCallbacks
+    def _lease_block(self):
+        self._leasing = True
+        try:
+            end = yield self.redis.incr(
+                'smpp_last_sequence_number', self.block_size)
+        except Exception:
+            f = Failure()
+            self._leasing = False
+            waiters, self._lease_waiters = self._lease_waiters, []
+            for d in waiters:
+                d.errback(f)
             return
-
-        # We reset the counter by deleting the key. The next INCR will recreate
-        # it for us.
-        yield self.redis.delete('smpp_last_sequence_number')
+        self._lease_next = end - self.block_size + 1
+        self._lease_end = end + 1
+        # Anyone asking for a sequence number while we're handing these out
+        # joins the end of the queue, so we're still leasing until it's empty
+        # or the block runs out.
+        while self._lease_waiters and self._lease_next < self._lease_end:
+            counter = self._lease_next
+            self._lease_next += 1
+            self._lease_waiters.pop(0).callback(self._wrap(counter))
+        self._leasing = False
+        if self._lease_waiters:
+            self._lease_block()
@@ -1,12 +1,13 @@
 # -*- test-case-name: vumi.transports.smpp.tests.test_smpp_transport -*-
 
 import warnings
+from collections import deque
 from uuid import uuid4
 
 from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, maybeDeferred, returnValue, Deferred, succeed)
-from twisted.internet.task import LoopingCall
+    inlineCallbacks, maybeDeferred, returnValue, Deferred, succeed,
+    gatherResults)
 
 from vumi.reconnecting_client import ReconnectingClientService
 from vumi.transports.base import Transport
@@ -18,7 +19,9 @@ from vumi.transports.smpp.deprecated.transport import (
     SmppTransportConfig as OldSmppTransportConfig)
 from vumi.transports.smpp.deprecated.utils import convert_to_new_config
 from vumi.transports.smpp.protocol import EsmeTransceiverFactory
+from vumi.transports.smpp.pdu_utils import command_id, seq_no, command_status
 from vumi.transports.smpp.sequence import RedisSequence
+from vumi.transports.smpp.throttling import TokenBucket, InFlightWindow
 from vumi.transports.failures import FailureMessage
 
 from vumi.persist.txredis_manager import TxRedisManager
@@ -63,6 +66,8 @@ class SmppTransceiverProtocol(EsmeTransceiverFactory.protocol):
             address_range=config.address_range)
 
     def connectionLost(self, reason):
+        # We won't get responses to anything sent on this connection.
+        self.vumi_transport.submit_sm_window.clear()
         d = maybeDeferred(self.vumi_transport.pause_connectors)
         d.addCallback(
             lambda _: EsmeTransceiverFactory.protocol.connectionLost(
@@ -75,8 +80,22 @@ class SmppTransceiverProtocol(EsmeTransceiverFactory.protocol):
         d.addCallback(lambda _: self.vumi_transport.unpause_connectors())
         return d
 
+    def send_pdu(self, pdu):
+        pdu_obj = pdu.get_obj()
+        if command_id(pdu_obj) == 'submit_sm':
+            self.vumi_transport.submit_sm_window.add(seq_no(pdu_obj))
+        return EsmeTransceiverFactory.protocol.send_pdu(self, pdu)
+
+    def handle_generic_nack(self, pdu):
+        # The SMSC couldn't make sense of something we sent, so we won't get
+        # a proper response to it.
+        log.warning('Received generic_nack for sequence number %s: %s' % (
+            seq_no(pdu), command_status(pdu)))
+        self.vumi_transport.submit_sm_window.remove(seq_no(pdu))
+
     def on_submit_sm_resp(self, sequence_number, smpp_message_id,
                           command_status):
+        self.vumi_transport.submit_sm_window.remove(sequence_number)
         cb = {
             'ESME_ROK': self.vumi_transport.handle_submit_sm_success,
             'ESME_RTHROTTLED': self.vumi_transport.handle_submit_sm_throttled,
@@ -84,13 +103,12 @@ class SmppTransceiverProtocol(EsmeTransceiverFactory.protocol):
         }.get(command_status, self.vumi_transport.handle_submit_sm_failure)
         message_stash = self.vumi_transport.message_stash
         d = message_stash.get_sequence_number_message_id(sequence_number)
-        d.addCallback(
-            message_stash.set_remote_message_id, smpp_message_id)
         d.addCallback(
             self._handle_submit_sm_resp_callback, smpp_message_id,
             command_status, cb)
         return d
 
+    @inlineCallbacks
     def _handle_submit_sm_resp_callback(self, message_id, smpp_message_id,
                                         command_status, cb):
         if message_id is None:
@@ -99,8 +117,15 @@ class SmppTransceiverProtocol(EsmeTransceiverFactory.protocol):
             log.warning("Failed to retrieve message id for deliver_sm_resp."
                         " ack/nack from %s discarded."
                         % self.vumi_transport.transport_name)
-        else:
-            return cb(message_id, smpp_message_id, command_status)
+            return
+        # The remote message id is only needed for delivery reports, which
+        # Redis looks it up for after this is stored, so we don't wait for it
+        # before handling the response.
+        remote_d = self.vumi_transport.message_stash.set_remote_message_id(
+            message_id, smpp_message_id)
+        result = yield cb(message_id, smpp_message_id, command_status)
+        yield remote_d
+        returnValue(result)
 
 
 class SmppReceiverProtocol(SmppTransceiverProtocol):
@@ -152,20 +177,37 @@ class SmppService(ReconnectingClientService):
 class SmppMessageDataStash(object):
     """
     Stash message data in Redis.
+
+    Redis commands are sent through a pipeline, so callers can issue commands
+    that don't depend on each other without waiting for earlier replies, and
+    :meth:`flush` can wait for any that are unanswered. Sequence number to
+    message ID mappings are also kept in memory for
+    ``config.sequence_number_cache_ttl`` seconds, because the
+    ``submit_sm_resp`` that needs them usually arrives very soon after the
+    ``submit_sm`` is sent.
     """
 
-    def __init__(self, redis, config):
-        self.redis = redis
+    def __init__(self, redis, config, clock=reactor):
+        self.redis = redis.pipeline()
         self.config = config
+        self.clock = clock
+        self._seq_cache = {}
+        self._seq_cache_expiries = deque()
+
+    def flush(self):
+        """
+        Wait for any unanswered Redis commands.
+        """
+        return maybeDeferred(self.redis.flush)
 
     def init_multipart_info(self, message_id, part_count):
         key = multipart_info_key(message_id)
         expiry = self.config.third_party_id_expiry
-        d = self.redis.hmset(key, {
+        d1 = self.redis.hmset(key, {
             'parts': part_count,
         })
-        d.addCallback(lambda _: self.redis.expire(key, expiry))
-        return d
+        d2 = self.redis.expire(key, expiry)
+        return gatherResults([d1, d2])
 
     def get_multipart_info(self, message_id):
         key = multipart_info_key(message_id)
@@ -193,8 +235,9 @@ class SmppMessageDataStash(object):
             return
         part_key = 'part:%s' % (remote_id,)
         mp_info[part_key] = 'fail'
-        d = self.redis.hset(key, part_key, 'fail')
-        d.addCallback(lambda _: self.redis.hset(key, 'event_result', 'fail'))
+        d1 = self.redis.hset(key, part_key, 'fail')
+        d2 = self.redis.hset(key, 'event_result', 'fail')
+        d = gatherResults([d1, d2])
         d.addCallback(lambda _: mp_info)
         return d
 
@@ -253,12 +296,30 @@ class SmppMessageDataStash(object):
             remote_id)
         return d
 
+    def _prune_seq_cache(self):
+        now = self.clock.seconds()
+        expiries = self._seq_cache_expiries
+        while expiries and expiries[0][0] <= now:
+            _, sequence_number = expiries.popleft()
+            entry = self._seq_cache.get(sequence_number)
+            if entry is not None and entry[0] <= now:
+                del self._seq_cache[sequence_number]
+
     def set_sequence_number_message_id(self, sequence_number, message_id):
+        ttl = self.config.sequence_number_cache_ttl
+        if ttl > 0:
+            self._prune_seq_cache()
+            expires_at = self.clock.seconds() + ttl
+            self._seq_cache[sequence_number] = (expires_at, message_id)
+            self._seq_cache_expiries.append((expires_at, sequence_number))
         key = sequence_number_key(sequence_number)
         expiry = self.config.third_party_id_expiry
         return self.redis.setex(key, expiry, message_id)
 
     def get_sequence_number_message_id(self, sequence_number):
+        entry = self._seq_cache.get(sequence_number)
+        if entry is not None and entry[0] > self.clock.seconds():
+            return succeed(entry[1])
         return self.redis.get(sequence_number_key(sequence_number))
 
     def cache_message(self, message):
@@ -321,24 +382,26 @@ class SmppTransceiverTransport(Transport):
         self.submit_sm_processor = config.submit_short_message_processor(
             self, config.submit_short_message_processor_config)
 
-        self.sequence_generator = self.sequence_class(self.redis)
-        self.message_stash = SmppMessageDataStash(self.redis, config)
+        self.sequence_generator = self.sequence_class(
+            self.redis, block_size=config.sequence_number_block_size)
+        self.message_stash = SmppMessageDataStash(
+            self.redis, config, self.clock)
         self.throttled = None
         self._throttled_message_ids = []
         self._unthrottle_delayedCall = None
+        self.submit_sm_window = InFlightWindow(
+            config.mt_window_size, config.mt_window_response_timeout,
+            self.clock)
+        if self.bind_requires_throttling():
+            self.mt_tps_bucket = TokenBucket(
+                config.mt_tps, config.mt_tps_burst or config.mt_tps,
+                self.clock)
+        else:
+            self.mt_tps_bucket = None
         self.factory = self.factory_class(self)
 
         self.service = self.start_service(self.factory)
 
-        self.tps_counter = 0
-        self.tps_limit = config.mt_tps
-        if config.mt_tps > 0:
-            self.mt_tps_lc = LoopingCall(self.reset_mt_tps)
-            self.mt_tps_lc.clock = self.clock
-            self.mt_tps_lc.start(1, now=True)
-        else:
-            self.mt_tps_lc = None
-
     def start_service(self, factory):
         config = self.get_static_config()
         service = self.service_class(config.twisted_endpoint, factory)
@@ -349,39 +412,19 @@ class SmppTransceiverTransport(Transport):
     def teardown_transport(self):
         if self.service:
             yield self.service.stopService()
-        if self.mt_tps_lc and self.mt_tps_lc.running:
-            self.mt_tps_lc.stop()
+        if self.mt_tps_bucket is not None:
+            self.mt_tps_bucket.stop()
+        self.submit_sm_window.stop()
+        if self._unthrottle_delayedCall is not None:
+            self._unthrottle_delayedCall.cancel()
+            self._unthrottle_delayedCall = None
+        yield self.message_stash.flush()
         yield self.redis._close()
 
-    def reset_mt_tps(self):
-        if self.throttled and self.need_mt_throttling():
-            if not self.service.is_bound():
-                # We don't have a bound SMPP connection, so try again later.
-                log.msg("Can't stop throttling while unbound, trying later.")
-                return
-            self.reset_mt_throttle_counter()
-            self.stop_throttling(quiet=True)
-
-    def reset_mt_throttle_counter(self):
-        self.tps_counter = 0
-
-    def incr_mt_throttle_counter(self):
-        self.tps_counter += 1
-
-    def need_mt_throttling(self):
-        return self.tps_counter >= self.tps_limit
-
     def bind_requires_throttling(self):
         config = self.get_static_config()
         return config.mt_tps > 0
 
-    def check_mt_throttling(self):
-        self.incr_mt_throttle_counter()
-        if self.need_mt_throttling():
-            # We can't yield here, because we need this message to finish
-            # processing before it will return.
-            self.start_throttling(quiet=True)
-
     def _check_address_valid(self, message, field):
         try:
             message[field].encode('ascii')
@@ -395,25 +438,37 @@ class SmppTransceiverTransport(Transport):
 
     @inlineCallbacks
     def handle_outbound_message(self, message):
-        if self.bind_requires_throttling():
-            yield self.check_mt_throttling()
-        protocol = yield self.service.get_protocol()
         if not self._check_address_valid(message, 'to_addr'):
             yield self._reject_for_invalid_address(message, 'to_addr')
             return
         if not self._check_address_valid(message, 'from_addr'):
             yield self._reject_for_invalid_address(message, 'from_addr')
             return
-        yield self.submit_sm_processor.handle_outbound_message(
-            message, protocol)
-        yield self.message_stash.cache_message(message)
+        # Both of these wait rather than pausing the connectors, which keeps
+        # the outbound rate steady instead of stopping and starting.
+        # (NOTE: 1 Vumi message may result in multiple PDUs, so the window
+        # may be overrun by the extra parts of a multipart message.)
+        # The message is cached while it is submitted rather than after, so
+        # the two don't take a Redis round trip each.
+        cache_d = self.message_stash.cache_message(message)
+        if self.mt_tps_bucket is not None:
+            yield self.mt_tps_bucket.acquire()
+        yield self.submit_sm_window.acquire()
+        try:
+            protocol = yield self.service.get_protocol()
+            yield self.submit_sm_processor.handle_outbound_message(
+                message, protocol)
+        finally:
+            self.submit_sm_window.release()
+        yield cache_d
 
     @inlineCallbacks
     def process_submit_sm_event(self, message_id, event_type, remote_id,
                                 command_status):
         if event_type == 'ack':
+            delete_d = self.message_stash.delete_cached_message(message_id)
             yield self.publish_ack(message_id, remote_id)
-            yield self.message_stash.delete_cached_message(message_id)
+            yield delete_d
         else:
             if event_type != 'fail':
                 log.warning(
@@ -435,11 +490,15 @@ class SmppTransceiverTransport(Transport):
     @inlineCallbacks
     def handle_submit_sm_success(self, message_id, smpp_message_id,
                                  command_status):
-        yield self.message_stash.update_multipart_info_success(
+        mp_info = yield self.message_stash.update_multipart_info_success(
             message_id, smpp_message_id)
 
-        event_info = yield self.message_stash.get_multipart_event_info(
-            message_id, 'ack', smpp_message_id)
+        if mp_info:
+            event_info = yield self.message_stash.get_multipart_event_info(
+                message_id, 'ack', smpp_message_id)
+        else:
+            # Not a multipart message, so there's nothing to look up.
+            event_info = (True, 'ack', smpp_message_id)
         event_required, event_type, remote_id = event_info
         if event_required:
             yield self.process_submit_sm_event(
@@ -451,11 +510,15 @@ class SmppTransceiverTransport(Transport):
     @inlineCallbacks
     def handle_submit_sm_failure(self, message_id, smpp_message_id,
                                  command_status):
-        yield self.message_stash.update_multipart_info_failure(
+        mp_info = yield self.message_stash.update_multipart_info_failure(
             message_id, smpp_message_id)
 
-        event_info = yield self.message_stash.get_multipart_event_info(
-            message_id, 'fail', smpp_message_id)
+        if mp_info:
+            event_info = yield self.message_stash.get_multipart_event_info(
+                message_id, 'fail', smpp_message_id)
+        else:
+            # Not a multipart message, so there's nothing to look up.
+            event_info = (True, 'fail', smpp_message_id)
         event_required, event_type, remote_id = event_info
         if event_required:
             yield self.process_submit_sm_event(
@@ -494,14 +557,15 @@ class SmppTransceiverTransport(Transport):
         In more detail:
 
         We recursively process our list of throttled message_ids until either
-        we have none left (at which point we stop throttling) or we find one we
-        can successfully look up in our cache.
+        we have none left (at which point we stop throttling) or we find some
+        we can successfully look up in our cache.
 
-        When we find a message we can retry, we retry it and return. We remain
-        throttled until the SMSC responds. If we're still throttled, the
-        message_id gets appended to our list and another check is scheduled for
-        later. If we're no longer throttled, this method gets called again
-        immediately.
+        We take up to ``throttle_retry_batch_size`` message_ids from the list
+        at a time. When we find messages we can retry, we retry them and
+        return. We remain throttled until the SMSC responds. If we're still
+        throttled, the message_ids get appended to our list and another check
+        is scheduled for later. If we're no longer throttled, this method gets
+        called again immediately.
 
         When there are no more throttled message_ids in our list, we stop
         throttling.
@@ -520,18 +584,34 @@ class SmppTransceiverTransport(Transport):
             self.stop_throttling()
             return
 
-        message_id = self._throttled_message_ids.pop(0)
-        message = yield self.message_stash.get_cached_message(message_id)
-        if message is None:
-            # We can't find this message, so log it and start again.
-            log.warning(
-                "Could not retrieve throttled message: %s" % (message_id,))
+        batch_size = self.get_static_config().throttle_retry_batch_size
+        message_ids = self._throttled_message_ids[:batch_size]
+        del self._throttled_message_ids[:batch_size]
+        messages = yield gatherResults([
+            self.message_stash.get_cached_message(message_id)
+            for message_id in message_ids])
+
+        retries = []
+        for message_id, message in zip(message_ids, messages):
+            if message is None:
+                # We can't find this message, so log it and carry on.
+                log.warning(
+                    "Could not retrieve throttled message: %s" % (message_id,))
+            else:
+                retries.append(message)
+
+        if not retries:
+            # We didn't find anything to retry, so start again.
             self.check_stop_throttling(0)
-        else:
-            # Try handle this message again and leave the rest to our
-            # submit_sm_resp handlers.
-            log.msg("Retrying throttled message: %s" % (message_id,))
-            yield self.handle_outbound_message(message)
+            return
+
+        # Try handle these messages again and leave the rest to our
+        # submit_sm_resp handlers.
+        for message in retries:
+            log.msg(
+                "Retrying throttled message: %s" % (message['message_id'],))
+        yield gatherResults(
+            [self.handle_outbound_message(message) for message in retries])
 
     def start_throttling(self, quiet=False):
         if self.throttled:
@@ -0,0 +1,62 @@
+from smpp.pdu_builder import DeliverSM, EnquireLink
+
+from vumi.tests.helpers import VumiTestCase
+from vumi.transports.smpp.pdu_utils import PDUBuffer, chop_pdu_stream
+
+
+class TestPDUBuffer(VumiTestCase):
+
+    def test_empty(self):
+        buf = PDUBuffer()
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(buf.next_pdu(), None)
+        self.assertEqual(list(buf.pdus()), [])
+
+    def test_single_pdu(self):
+        pdu = EnquireLink(1).get_bin()
+        buf = PDUBuffer()
+        buf.feed(pdu)
+        self.assertEqual(buf.next_pdu(), pdu)
+        self.assertEqual(buf.next_pdu(), None)
+        self.assertEqual(len(buf), 0)
+
+    def test_partial_header(self):
+        pdu = EnquireLink(1).get_bin()
+        buf = PDUBuffer()
+        buf.feed(pdu[:3])
+        self.assertEqual(buf.next_pdu(), None)
+        buf.feed(pdu[3:])
+        self.assertEqual(buf.next_pdu(), pdu)
+
+    def test_partial_body(self):
+        pdu = DeliverSM(1, short_message='foo').get_bin()
+        buf = PDUBuffer()
+        buf.feed(pdu[:20])
+        self.assertEqual(buf.next_pdu(), None)
+        self.assertEqual(len(buf), 20)
+        buf.feed(pdu[20:])
+        self.assertEqual(buf.next_pdu(), pdu)
+
+    def test_many_pdus(self):
+        pdus = [DeliverSM(i, short_message='foo %s' % (i,)).get_bin()
+                for i in range(1, 11)]
+        data = ''.join(pdus)
+        buf = PDUBuffer()
+        buf.feed(data[:-5])
+        self.assertEqual(list(buf.pdus()), pdus[:-1])
+        self.assertEqual(len(buf), len(pdus[-1]) - 5)
+        buf.feed(data[-5:])
+        self.assertEqual(list(buf.pdus()), pdus[-1:])
+        self.assertEqual(len(buf), 0)
+
+    def test_matches_chop_pdu_stream(self):
+        data = ''.join(EnquireLink(i).get_bin() for i in range(1, 4))
+        buf = PDUBuffer()
+        buf.feed(data)
+        while True:
+            pdu_found = chop_pdu_stream(data)
+            if pdu_found is None:
+                break
+            pdu, data = pdu_found
+            self.assertEqual(buf.next_pdu(), pdu)
+        self.assertEqual(buf.next_pdu(), None)
@@ -8,6 +8,7 @@ from twisted.internet.task import Clock
 
 
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+from vumi.tests.utils import LogCatcher
 from vumi.transports.smpp.smpp_transport import SmppTransceiverTransport
 from vumi.transports.smpp.protocol import (
     EsmeTransceiver, EsmeTransceiverFactory,
@@ -544,6 +545,65 @@ class EsmeTestCase(VumiTestCase):
         self.assertEqual(seq_no(handled_pdu), 1)
         self.assertEqual(short_message(handled_pdu), 'foo')
 
+    @inlineCallbacks
+    def test_many_pdus_data_received(self):
+        calls = []
+        self.patch(EsmeTransceiver, 'handle_deliver_sm',
+                   lambda p, pdu: calls.append(pdu))
+        transport, protocol = yield self.setup_bind()
+        data = ''.join(
+            DeliverSM(sequence_number=i, short_message='foo %s' % (i,)
+                      ).get_bin()
+            for i in range(1, 101))
+        # Split the burst somewhere in the middle of a PDU.
+        protocol.dataReceived(data[:-10])
+        self.assertEqual(len(calls), 99)
+        protocol.dataReceived(data[-10:])
+        self.assertEqual([seq_no(pdu) for pdu in calls], range(1, 101))
+        self.assertEqual(short_message(calls[-1]), 'foo 100')
+        self.assertEqual(len(protocol.buffer), 0)
+
+    @inlineCallbacks
+    def test_pdu_trace_sampling(self):
+        transport, protocol = yield self.setup_bind(
+            config={'pdu_trace_sample_rate': 3})
+        # Binding sends and receives four PDUs, so the enquire_link we
+        # receive here is the fifth and our response is the sixth.
+        with LogCatcher(message='INCOMING|OUTGOING') as lc:
+            protocol.dataReceived(EnquireLink(100).get_bin())
+            protocol.dataReceived(EnquireLink(101).get_bin())
+        [outgoing, outgoing_raw] = lc.messages()
+        self.assertTrue(outgoing.startswith('OUTGOING >> '))
+        self.assertTrue("'command_id': 'enquire_link_resp'" in outgoing)
+        self.assertEqual(
+            outgoing_raw,
+            'OUTGOING raw >> %s' % (EnquireLinkResp(100).get_hex(),))
+
+    @inlineCallbacks
+    def test_pdu_trace_disabled(self):
+        transport, protocol = yield self.setup_bind(
+            config={'pdu_trace_sample_rate': 0})
+        with LogCatcher(message='INCOMING|OUTGOING') as lc:
+            protocol.dataReceived(EnquireLink(100).get_bin())
+        self.assertEqual(lc.messages(), [])
+
+    @inlineCallbacks
+    def test_dump_pdu_trace(self):
+        transport, protocol = yield self.setup_bind(
+            config={'pdu_trace_buffer_size': 3})
+        protocol.dataReceived(EnquireLink(100).get_bin())
+        with LogCatcher(message='PDU trace') as lc:
+            entries = protocol.dump_pdu_trace()
+        self.assertEqual(
+            [(e['direction'], e['command_id']) for e in entries], [
+                ('INCOMING', 'enquire_link_resp'),
+                ('INCOMING', 'enquire_link'),
+                ('OUTGOING', 'enquire_link_resp'),
+            ])
+        self.assertEqual(len(lc.messages()), 3)
+        self.assertTrue(
+            lc.messages()[-1].endswith(EnquireLinkResp(100).get_hex()))
+
     @inlineCallbacks
     def test_unsupported_command_id(self):
         calls = []
@@ -1,4 +1,4 @@
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, gatherResults
 
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 from vumi.transports.smpp.sequence import RedisSequence
@@ -36,3 +36,71 @@ class EsmeTestCase(VumiTestCase):
         self.assertEqual((yield sequence_generator.next()), 2)
         self.assertEqual((yield sequence_generator.next()), 3)
         self.assertEqual((yield sequence_generator.next()), 1)
+
+    @inlineCallbacks
+    def test_leased_sequence(self):
+        sequence_generator = RedisSequence(self.redis, block_size=10)
+        seqs = []
+        for i in range(25):
+            seqs.append((yield sequence_generator.next()))
+        self.assertEqual(seqs, range(1, 26))
+        self.assertEqual(
+            (yield self.redis.get('smpp_last_sequence_number')), '30')
+
+    @inlineCallbacks
+    def test_leased_sequence_concurrent(self):
+        sequence_generator = RedisSequence(self.redis, block_size=10)
+        seqs = yield gatherResults(
+            [sequence_generator.next() for i in range(25)])
+        self.assertEqual(seqs, range(1, 26))
+        self.assertEqual(
+            (yield self.redis.get('smpp_last_sequence_number')), '30')
+
+    @inlineCallbacks
+    def test_leased_sequence_shared(self):
+        generator1 = RedisSequence(self.redis, block_size=10)
+        generator2 = RedisSequence(self.redis, block_size=10)
+        seqs1 = yield gatherResults([generator1.next() for i in range(5)])
+        seqs2 = yield gatherResults([generator2.next() for i in range(15)])
+        seqs1.extend((yield gatherResults(
+            [generator1.next() for i in range(10)])))
+        self.assertEqual(seqs1, range(1, 11) + range(31, 36))
+        self.assertEqual(seqs2, range(11, 26))
+
+    @inlineCallbacks
+    def test_leased_rollover(self):
+        sequence_generator = RedisSequence(
+            self.redis, rollover_at=5, block_size=3)
+        seqs = []
+        for i in range(12):
+            seqs.append((yield sequence_generator.next()))
+        self.assertEqual(seqs, [1, 2, 3, 4, 5, 1, 2, 3, 4, 5, 1, 2])
+
+    @inlineCallbacks
+    def test_leased_rollover_at_max_sequence_number(self):
+        sequence_generator = RedisSequence(
+            self.redis, rollover_at=0xFFFFFFFF, block_size=3)
+        yield self.redis.set('smpp_last_sequence_number', 0xFFFFFFFE)
+        seqs = []
+        for i in range(3):
+            seqs.append((yield sequence_generator.next()))
+        self.assertEqual(seqs, [0xFFFFFFFF, 1, 2])
+
+    @inlineCallbacks
+    def test_mixed_block_sizes_rollover(self):
+        generator1 = RedisSequence(self.redis, rollover_at=5)
+        generator2 = RedisSequence(self.redis, rollover_at=5, block_size=3)
+        seqs1 = []
+        seqs2 = []
+        for i in range(2):
+            seqs1.append((yield generator1.next()))
+            seqs2.append((yield generator2.next()))
+        self.assertEqual(seqs1, [1, 5])
+        self.assertEqual(seqs2, [2, 3])
+        self.assertEqual(
+            (yield self.redis.get('smpp_last_sequence_number')), '5')
+        # The counter isn't reset at rollover, so neither generator hands out
+        # a number the other is still holding.
+        self.assertEqual((yield generator1.next()), 1)
+        self.assertEqual((yield generator2.next()), 4)
+        self.assertEqual((yield generator2.next()), 2)
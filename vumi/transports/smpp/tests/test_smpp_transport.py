@@ -4,7 +4,7 @@ import logging
 
 from twisted.test import proto_helpers
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, Deferred, succeed)
+    inlineCallbacks, returnValue, Deferred, succeed, gatherResults)
 from twisted.internet.error import ConnectionDone
 from twisted.internet.task import Clock
 from twisted.application.service import Service
@@ -17,7 +17,7 @@ from vumi.transports.smpp.smpp_transport import (
     SmppTransceiverTransport,
     SmppTransceiverTransportWithOldConfig,
     SmppTransmitterTransport, SmppReceiverTransport,
-    message_key, remote_message_key, SmppService)
+    message_key, remote_message_key, sequence_number_key, SmppService)
 from vumi.transports.smpp.pdu_utils import (
     pdu_ok, short_message, command_id, seq_no, pdu_tlv, unpacked_pdu_opts)
 from vumi.transports.smpp.tests.test_protocol import (
@@ -189,6 +189,17 @@ class SmppTransceiverTransportTestCase(SmppTransportTestCase):
         received_protocol.is_bound = lambda: False
         self.assertEqual(service.is_bound(), False)
 
+    @inlineCallbacks
+    def test_setup_transport_leased_sequence_numbers(self):
+        transport = yield self.get_transport({
+            'sequence_number_block_size': 100,
+        })
+        self.assertEqual(transport.sequence_generator.block_size, 100)
+        protocol = yield transport.service.get_protocol()
+        self.assertTrue(protocol.is_bound())
+        self.assertEqual(
+            (yield transport.redis.get('smpp_last_sequence_number')), '100')
+
     @inlineCallbacks
     def test_setup_transport_host_port_fallback(self):
         self.default_config.pop('twisted_endpoint')
@@ -948,85 +959,123 @@ class SmppTransceiverTransportTestCase(SmppTransportTestCase):
         })
         transport = smpp_helper.transport
 
-        with LogCatcher(message="Throttling outbound messages.") as lc:
-            yield self.tx_helper.make_dispatch_outbound('hello world 1')
-            yield self.tx_helper.make_dispatch_outbound('hello world 2')
-            msg3_d = self.tx_helper.make_dispatch_outbound('hello world 3')
-        [logmsg] = lc.logs
-        self.assertEqual(logmsg['logLevel'], logging.INFO)
+        yield self.tx_helper.make_dispatch_outbound('hello world 1')
+        yield self.tx_helper.make_dispatch_outbound('hello world 2')
+        msg3_d = self.tx_helper.make_dispatch_outbound('hello world 3')
 
-        self.assertTrue(transport.throttled)
+        # We wait for the next token rather than pausing the connectors.
+        self.assertFalse(transport.throttled)
         [submit_sm_pdu1, submit_sm_pdu2] = yield smpp_helper.wait_for_pdus(2)
         self.assertEqual(short_message(submit_sm_pdu1), 'hello world 1')
         self.assertEqual(short_message(submit_sm_pdu2), 'hello world 2')
         self.assertNoResult(msg3_d)
 
-        with LogCatcher(message="No longer throttling outbound") as lc:
-            self.clock.advance(1)
-        [logmsg] = lc.logs
-        self.assertEqual(logmsg['logLevel'], logging.INFO)
-
-        self.assertFalse(transport.throttled)
+        # The next token arrives half a second later.
+        self.clock.advance(0.5)
         yield msg3_d
         [submit_sm_pdu3] = yield smpp_helper.wait_for_pdus(1)
         self.assertEqual(short_message(submit_sm_pdu3), 'hello world 3')
 
     @inlineCallbacks
-    def test_mt_sms_reconnect_while_tps_throttled(self):
-        """
-        If we reconnect while throttled due to the tps limit, we don't try to
-        unthrottle before the connection is in a suitable state.
-        """
+    def test_mt_sms_tps_limits_smooth(self):
         smpp_helper = yield self.get_smpp_helper(config={
-            'mt_tps': 2,
+            'mt_tps': 4,
+            'mt_tps_burst': 1,
         })
-        transport = smpp_helper.transport
 
-        with LogCatcher(message="Throttling outbound messages.") as lc:
-            yield self.tx_helper.make_dispatch_outbound('hello world 1')
-            yield self.tx_helper.make_dispatch_outbound('hello world 2')
-            msg3_d = self.tx_helper.make_dispatch_outbound('hello world 3')
-        [logmsg] = lc.logs
-        self.assertEqual(logmsg['logLevel'], logging.INFO)
+        yield self.tx_helper.make_dispatch_outbound('hello world 1')
+        msg2_d = self.tx_helper.make_dispatch_outbound('hello world 2')
+        [submit_sm_pdu1] = yield smpp_helper.wait_for_pdus(1)
+        self.assertEqual(short_message(submit_sm_pdu1), 'hello world 1')
+        self.assertNoResult(msg2_d)
 
-        self.assertTrue(transport.throttled)
-        [submit_sm_pdu1, submit_sm_pdu2] = yield smpp_helper.wait_for_pdus(2)
+        self.clock.advance(0.2)
+        self.assertNoResult(msg2_d)
+        self.clock.advance(0.05)
+        yield msg2_d
+        [submit_sm_pdu2] = yield smpp_helper.wait_for_pdus(1)
+        self.assertEqual(short_message(submit_sm_pdu2), 'hello world 2')
+
+    @inlineCallbacks
+    def test_mt_sms_window(self):
+        smpp_helper = yield self.get_smpp_helper(config={
+            'mt_window_size': 1,
+        })
+        transport = smpp_helper.transport
+
+        msg1 = self.tx_helper.make_outbound('hello world 1')
+        yield self.tx_helper.dispatch_outbound(msg1)
+        msg2_d = self.tx_helper.make_dispatch_outbound('hello world 2')
+        [submit_sm_pdu1] = yield smpp_helper.wait_for_pdus(1)
         self.assertEqual(short_message(submit_sm_pdu1), 'hello world 1')
+        self.assertEqual(
+            transport.submit_sm_window.in_flight.keys(),
+            [seq_no(submit_sm_pdu1)])
+        self.assertNoResult(msg2_d)
+
+        yield smpp_helper.handle_pdu(
+            SubmitSMResp(sequence_number=seq_no(submit_sm_pdu1),
+                         message_id='foo'))
+        yield msg2_d
+        [submit_sm_pdu2] = yield smpp_helper.wait_for_pdus(1)
         self.assertEqual(short_message(submit_sm_pdu2), 'hello world 2')
-        self.assertNoResult(msg3_d)
+        self.assertEqual(
+            transport.submit_sm_window.in_flight.keys(),
+            [seq_no(submit_sm_pdu2)])
+        [event] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(event['event_type'], 'ack')
+        self.assertEqual(event['user_message_id'], msg1['message_id'])
 
-        # Drop SMPP connection and check throttling.
-        with LogCatcher(message="Can't stop throttling while unbound") as lc:
-            transport.service.stopService()
-            self.clock.advance(1)
-        [logmsg] = lc.logs
-        self.assertEqual(logmsg['logLevel'], logging.INFO)
-        self.assertTrue(transport.throttled)
+    @inlineCallbacks
+    def test_mt_sms_window_connection_lost(self):
+        smpp_helper = yield self.get_smpp_helper(config={
+            'mt_window_size': 1,
+        })
+        transport = smpp_helper.transport
 
-        # Reconnect (but don't bind) and check throttling.
-        with LogCatcher(message="Can't stop throttling while unbound") as lc:
-            smpp_helper.transport.service.startService()
-            protocol = yield transport.service.get_protocol()
-            protocol.makeConnection(self.string_transport)
-            [bind_pdu] = yield smpp_helper.wait_for_pdus(1)
-            self.assertTrue(
-                bind_pdu["header"]["command_id"].startswith("bind_"))
-            self.clock.advance(1)
-        [logmsg] = lc.logs
-        self.assertEqual(logmsg['logLevel'], logging.INFO)
-        self.assertTrue(transport.throttled)
+        yield self.tx_helper.make_dispatch_outbound('hello world 1')
+        self.assertEqual(len(transport.submit_sm_window), 1)
+        yield transport.service.stopService()
+        self.assertEqual(len(transport.submit_sm_window), 0)
 
-        # Bind and check throttling.
-        with LogCatcher(message="No longer throttling outbound") as lc:
-            yield bind_protocol(
-                self.string_transport, protocol, bind_pdu=bind_pdu)
-            self.clock.advance(1)
-        [logmsg] = lc.logs
-        self.assertEqual(logmsg['logLevel'], logging.INFO)
+    @inlineCallbacks
+    def test_mt_sms_throttled_batch_retry(self):
+        smpp_helper = yield self.get_smpp_helper(config={
+            'throttle_retry_batch_size': 2,
+        })
+        transport_config = smpp_helper.transport.get_static_config()
+        msg1 = self.tx_helper.make_outbound('hello world 1')
+        msg2 = self.tx_helper.make_outbound('hello world 2')
 
-        self.assertFalse(transport.throttled)
-        [submit_sm_pdu2] = yield smpp_helper.wait_for_pdus(1)
-        self.assertEqual(short_message(submit_sm_pdu2), 'hello world 3')
+        yield self.tx_helper.dispatch_outbound(msg1)
+        yield self.tx_helper.dispatch_outbound(msg2)
+        [ssm_pdu1, ssm_pdu2] = yield smpp_helper.wait_for_pdus(2)
+        for ssm_pdu in [ssm_pdu1, ssm_pdu2]:
+            yield smpp_helper.handle_pdu(
+                SubmitSMResp(sequence_number=seq_no(ssm_pdu),
+                             message_id='foo',
+                             command_status='ESME_RTHROTTLED'))
+
+        # Both messages are retried together.
+        self.clock.advance(transport_config.throttle_delay)
+        [ssm_pdu1_retry, ssm_pdu2_retry] = yield smpp_helper.wait_for_pdus(2)
+        self.assertEqual(short_message(ssm_pdu1_retry), 'hello world 1')
+        self.assertEqual(short_message(ssm_pdu2_retry), 'hello world 2')
+        for ssm_pdu in [ssm_pdu1_retry, ssm_pdu2_retry]:
+            yield smpp_helper.handle_pdu(
+                SubmitSMResp(sequence_number=seq_no(ssm_pdu),
+                             message_id='bar',
+                             command_status='ESME_ROK'))
+
+        [event1, event2] = yield self.tx_helper.wait_for_dispatched_events(2)
+        self.assertEqual(event1['event_type'], 'ack')
+        self.assertEqual(event1['user_message_id'], msg1['message_id'])
+        self.assertEqual(event2['event_type'], 'ack')
+        self.assertEqual(event2['user_message_id'], msg2['message_id'])
+
+        with LogCatcher(message="No longer throttling outbound") as lc:
+            self.clock.advance(0)
+        self.assertEqual(len(lc.logs), 1)
 
     @inlineCallbacks
     def test_mt_sms_queue_full(self):
@@ -1286,6 +1335,71 @@ class SmppTransceiverTransportTestCase(SmppTransportTestCase):
             None,
             (yield message_stash.get_cached_message(msg['message_id'])))
 
+    @inlineCallbacks
+    def test_message_stash_batching(self):
+        smpp_helper = yield self.get_smpp_helper()
+        message_stash = smpp_helper.transport.message_stash
+        msg = self.tx_helper.make_outbound('hello world')
+        d1 = message_stash.cache_message(msg)
+        d2 = message_stash.set_sequence_number_message_id(
+            3, msg['message_id'])
+        self.assertEqual(message_stash.redis.pending_count(), 2)
+        yield gatherResults([d1, d2])
+        self.assertEqual(message_stash.redis.pending_count(), 0)
+        self.assertEqual(
+            (yield smpp_helper.transport.redis.get(sequence_number_key(3))),
+            msg['message_id'])
+
+    @inlineCallbacks
+    def test_submit_sm_sent_before_sequence_number_stored(self):
+        smpp_helper = yield self.get_smpp_helper()
+        message_stash = smpp_helper.transport.message_stash
+        protocol = smpp_helper.protocol
+        pending_counts = []
+        send_pdu = protocol.send_pdu
+
+        def recording_send_pdu(pdu):
+            pending_counts.append(message_stash.redis.pending_count())
+            return send_pdu(pdu)
+
+        self.patch(protocol, 'send_pdu', recording_send_pdu)
+        yield self.tx_helper.make_dispatch_outbound('hello world')
+        # The submit_sm is sent without waiting for its sequence number
+        # mapping to be stored.
+        self.assertEqual(pending_counts, [1])
+        self.assertEqual(message_stash.redis.pending_count(), 0)
+
+    @inlineCallbacks
+    def test_sequence_number_cache(self):
+        smpp_helper = yield self.get_smpp_helper(config={
+            'sequence_number_cache_ttl': 10,
+        })
+        transport = smpp_helper.transport
+        message_stash = transport.message_stash
+        yield message_stash.set_sequence_number_message_id(3, 'msg-3')
+        # Remove the Redis copy so we know we're using the cached one.
+        yield transport.redis.delete(sequence_number_key(3))
+        self.assertEqual(
+            (yield message_stash.get_sequence_number_message_id(3)), 'msg-3')
+
+        self.clock.advance(10)
+        self.assertEqual(
+            (yield message_stash.get_sequence_number_message_id(3)), None)
+        yield message_stash.set_sequence_number_message_id(4, 'msg-4')
+        self.assertEqual(message_stash._seq_cache.keys(), [4])
+
+    @inlineCallbacks
+    def test_sequence_number_cache_disabled(self):
+        smpp_helper = yield self.get_smpp_helper(config={
+            'sequence_number_cache_ttl': 0,
+        })
+        transport = smpp_helper.transport
+        message_stash = transport.message_stash
+        yield message_stash.set_sequence_number_message_id(3, 'msg-3')
+        yield transport.redis.delete(sequence_number_key(3))
+        self.assertEqual(
+            (yield message_stash.get_sequence_number_message_id(3)), None)
+
     @inlineCallbacks
     def test_link_remote_message_id(self):
         smpp_helper = yield self.get_smpp_helper()
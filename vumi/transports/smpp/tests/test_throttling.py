@@ -0,0 +1,141 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+from vumi.transports.smpp.throttling import TokenBucket, InFlightWindow
+
+
+class TestTokenBucket(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=10, capacity=3, clock=self.clock)
+        for i in range(3):
+            self.successResultOf(bucket.acquire())
+        d = bucket.acquire()
+        self.assertNoResult(d)
+        self.assertEqual(bucket.waiting(), 1)
+
+    def test_smooth_rate(self):
+        bucket = TokenBucket(rate=10, capacity=1, clock=self.clock)
+        self.successResultOf(bucket.acquire())
+        ds = [bucket.acquire() for i in range(3)]
+        fired = []
+        for d in ds:
+            d.addCallback(
+                lambda _: fired.append(round(self.clock.seconds(), 6)))
+        self.clock.pump([0.1] * 3)
+        self.assertEqual(fired, [0.1, 0.2, 0.3])
+        self.assertEqual(bucket.waiting(), 0)
+
+    def test_refill_up_to_capacity(self):
+        bucket = TokenBucket(rate=10, capacity=2, clock=self.clock)
+        self.successResultOf(bucket.acquire())
+        self.successResultOf(bucket.acquire())
+        self.clock.advance(10)
+        self.successResultOf(bucket.acquire())
+        self.successResultOf(bucket.acquire())
+        self.assertNoResult(bucket.acquire())
+
+    def test_waiters_served_in_order(self):
+        bucket = TokenBucket(rate=1, capacity=1, clock=self.clock)
+        self.successResultOf(bucket.acquire())
+        d1 = bucket.acquire()
+        self.clock.advance(0.5)
+        d2 = bucket.acquire()
+        self.clock.advance(0.5)
+        self.successResultOf(d1)
+        self.assertNoResult(d2)
+        self.clock.advance(1)
+        self.successResultOf(d2)
+
+    def test_stop(self):
+        bucket = TokenBucket(rate=1, capacity=1, clock=self.clock)
+        self.successResultOf(bucket.acquire())
+        d = bucket.acquire()
+        bucket.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(1)
+        self.assertNoResult(d)
+
+
+class TestInFlightWindow(VumiTestCase):
+
+    def test_unlimited(self):
+        window = InFlightWindow(0)
+        for i in range(100):
+            self.successResultOf(window.acquire())
+            window.add(i)
+        self.assertEqual(len(window), 100)
+
+    def test_acquire_waits_for_slot(self):
+        window = InFlightWindow(2)
+        self.successResultOf(window.acquire())
+        window.add(1)
+        window.release()
+        self.successResultOf(window.acquire())
+        d = window.acquire()
+        self.assertNoResult(d)
+        window.add(2)
+        window.release()
+        self.assertNoResult(d)
+        self.assertEqual(window.remove(1), None)
+        self.successResultOf(d)
+        self.assertEqual(window.reserved, 1)
+
+    def test_remove_value(self):
+        window = InFlightWindow(2)
+        window.add(1, 'foo')
+        self.assertEqual(window.remove(1), 'foo')
+        self.assertEqual(window.remove(1), None)
+        self.assertEqual(len(window), 0)
+
+    def test_clear(self):
+        window = InFlightWindow(1)
+        self.successResultOf(window.acquire())
+        window.add(1)
+        window.release()
+        d = window.acquire()
+        self.assertNoResult(d)
+        window.clear()
+        self.successResultOf(d)
+        self.assertEqual(len(window), 0)
+        self.assertEqual(window.waiting(), 0)
+
+    def test_lost_response_expires(self):
+        clock = Clock()
+        window = InFlightWindow(1, response_timeout=10, clock=clock)
+        self.successResultOf(window.acquire())
+        window.add(1, 'foo')
+        window.release()
+        d = window.acquire()
+        self.assertNoResult(d)
+        clock.advance(9)
+        self.assertNoResult(d)
+        # The response never arrives, so the slot is freed after the timeout.
+        clock.advance(1)
+        self.successResultOf(d)
+        self.assertEqual(len(window), 0)
+        self.assertEqual(window.remove(1), None)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_response_before_timeout(self):
+        clock = Clock()
+        window = InFlightWindow(2, response_timeout=10, clock=clock)
+        window.add(1, 'foo')
+        clock.advance(5)
+        window.add(2, 'bar')
+        self.assertEqual(window.remove(1), 'foo')
+        clock.advance(5)
+        self.assertEqual(len(window), 1)
+        clock.advance(5)
+        self.assertEqual(len(window), 0)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_stop(self):
+        clock = Clock()
+        window = InFlightWindow(1, response_timeout=10, clock=clock)
+        window.add(1)
+        window.stop()
+        self.assertEqual(clock.getDelayedCalls(), [])
@@ -0,0 +1,87 @@
+from twisted.internet.task import Clock
+
+from smpp.pdu import unpack_pdu
+from smpp.pdu_builder import EnquireLink, EnquireLinkResp
+
+from vumi.tests.helpers import VumiTestCase
+from vumi.transports.smpp.tracing import LazyFormat, LazyHex, PDUTracer
+
+
+class TestLazyFormat(VumiTestCase):
+
+    def test_format(self):
+        msg = LazyFormat('foo %s %r', 'bar', {'baz': 1})
+        self.assertEqual(str(msg), "foo bar {'baz': 1}")
+
+    def test_not_formatted_until_needed(self):
+        calls = []
+
+        class Expensive(object):
+            def __repr__(self):
+                calls.append(1)
+                return 'expensive'
+
+        msg = LazyFormat('%r', Expensive())
+        self.assertEqual(calls, [])
+        self.assertEqual(str(msg), 'expensive')
+        self.assertEqual(calls, [1])
+
+    def test_hex(self):
+        self.assertEqual(str(LazyHex('\x00\xff')), '00ff')
+        self.assertEqual(
+            str(LazyFormat('raw %s', LazyHex('\x01'))), 'raw 01')
+
+
+class TestPDUTracer(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def trace_enquire_links(self, tracer, count):
+        sampled = []
+        for i in range(1, count + 1):
+            pdu = EnquireLink(i)
+            if tracer.trace('OUTGOING', pdu.get_obj(), pdu.get_bin()):
+                sampled.append(i)
+        return sampled
+
+    def test_sample_every_pdu(self):
+        tracer = PDUTracer(sample_rate=1, buffer_size=0, clock=self.clock)
+        self.assertEqual(self.trace_enquire_links(tracer, 3), [1, 2, 3])
+
+    def test_sample_one_in_n(self):
+        tracer = PDUTracer(sample_rate=3, buffer_size=0, clock=self.clock)
+        self.assertEqual(self.trace_enquire_links(tracer, 7), [3, 6])
+
+    def test_sampling_disabled(self):
+        tracer = PDUTracer(sample_rate=0, buffer_size=0, clock=self.clock)
+        self.assertEqual(self.trace_enquire_links(tracer, 3), [])
+
+    def test_dump(self):
+        tracer = PDUTracer(sample_rate=0, buffer_size=10, clock=self.clock)
+        pdu = EnquireLink(1)
+        tracer.trace('OUTGOING', pdu.get_obj(), pdu.get_bin())
+        self.clock.advance(5)
+        data = EnquireLinkResp(1).get_bin()
+        tracer.trace('INCOMING', unpack_pdu(data), data)
+        [outgoing, incoming] = tracer.dump()
+        self.assertEqual(outgoing['timestamp'], 0)
+        self.assertEqual(outgoing['direction'], 'OUTGOING')
+        self.assertEqual(outgoing['command_id'], 'enquire_link')
+        self.assertEqual(outgoing['sequence_number'], 1)
+        self.assertEqual(outgoing['hex'], pdu.get_hex())
+        self.assertEqual(incoming['timestamp'], 5)
+        self.assertEqual(incoming['direction'], 'INCOMING')
+        self.assertEqual(incoming['command_id'], 'enquire_link_resp')
+        self.assertEqual(incoming['pdu'], unpack_pdu(data))
+
+    def test_dump_ring_buffer(self):
+        tracer = PDUTracer(sample_rate=0, buffer_size=3, clock=self.clock)
+        self.trace_enquire_links(tracer, 5)
+        self.assertEqual(
+            [entry['sequence_number'] for entry in tracer.dump()], [3, 4, 5])
+
+    def test_dump_disabled(self):
+        tracer = PDUTracer(sample_rate=0, buffer_size=0, clock=self.clock)
+        self.trace_enquire_links(tracer, 5)
+        self.assertEqual(tracer.dump(), [])
@@ -0,0 +1,237 @@
+# -*- test-case-name: vumi.transports.smpp.tests.test_throttling -*-
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+
+from vumi import log
+
+
+class TokenBucket(object):
+    """
+    A token bucket rate limiter.
+
+    Tokens are added continuously at ``rate`` per second, up to a maximum of
+    ``capacity``. Each call to :meth:`acquire` uses up one token, waiting for
+    one to become available if necessary. This spreads work evenly over time
+    rather than allowing a full second's worth through at once and then
+    stalling until the next second.
+
+    :param float rate:
+        The number of tokens added per second.
+    :param int capacity:
+        The maximum number of tokens that can accumulate while idle, which
+        limits the size of a burst.
+    :param clock:
+        The clock to use for timing.
+    """
+
+    # Allow for floating point rounding when deciding if we have a token.
+    EPSILON = 1e-9
+
+    def __init__(self, rate, capacity, clock):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = float(capacity)
+        self._last_refill = clock.seconds()
+        self._waiters = []
+        self._delayed_call = None
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _has_token(self):
+        return self.tokens >= 1 - self.EPSILON
+
+    def acquire(self):
+        """
+        Use up a token.
+
+        :returns:
+            A deferred that fires when the token is available. Waiters are
+            served in the order they called this.
+        """
+        self._refill()
+        if not self._waiters and self._has_token():
+            self.tokens -= 1
+            return succeed(None)
+        d = Deferred()
+        self._waiters.append(d)
+        self._schedule_release()
+        return d
+
+    def waiting(self):
+        """
+        Return the number of callers waiting for a token.
+        """
+        return len(self._waiters)
+
+    def _schedule_release(self):
+        if self._delayed_call is not None or not self._waiters:
+            return
+        delay = max(0, (1 - self.tokens) / self.rate)
+        self._delayed_call = self.clock.callLater(delay, self._release)
+
+    def _release(self):
+        self._delayed_call = None
+        self._refill()
+        while self._waiters and self._has_token():
+            self.tokens -= 1
+            self._waiters.pop(0).callback(None)
+        self._schedule_release()
+
+    def stop(self):
+        """
+        Stop handing out tokens to waiters.
+        """
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+
+
+class InFlightWindow(object):
+    """
+    Limits the number of PDUs awaiting a response.
+
+    PDUs are tracked by sequence number. Before sending, a slot must be
+    reserved with :meth:`acquire`. The reservation is released once the PDUs
+    it was for have been added with :meth:`add` (or the send has failed) and
+    the slot itself is freed when the response arrives and the PDU is
+    removed with :meth:`remove`.
+
+    If the window is limited and ``response_timeout`` is set, PDUs that have
+    waited longer than that for a response are removed as well, so a lost
+    response doesn't hold its slot forever.
+
+    :param int size:
+        The maximum number of PDUs in flight. If this is ``0``, there is no
+        limit.
+    :param float response_timeout:
+        The number of seconds to wait for a response before freeing a PDU's
+        slot. If this is ``0``, we wait forever.
+    :param clock:
+        The clock to use for timing.
+    """
+
+    def __init__(self, size, response_timeout=0, clock=reactor):
+        self.size = size
+        self.response_timeout = response_timeout
+        self.clock = clock
+        # sequence_number -> (sent_at, value)
+        self.in_flight = {}
+        self.reserved = 0
+        self._waiters = []
+        # (sent_at, sequence_number), oldest first.
+        self._expiries = deque()
+        self._delayed_call = None
+
+    def __len__(self):
+        return len(self.in_flight)
+
+    def _has_slot(self):
+        return not self.size or (
+            len(self.in_flight) + self.reserved < self.size)
+
+    def acquire(self):
+        """
+        Reserve a slot in the window.
+
+        :returns:
+            A deferred that fires when the slot has been reserved.
+        """
+        if not self._waiters and self._has_slot():
+            self.reserved += 1
+            return succeed(None)
+        d = Deferred()
+        self._waiters.append(d)
+        return d
+
+    def release(self):
+        """
+        Release a reservation made with :meth:`acquire`.
+        """
+        self.reserved -= 1
+        self._wake_waiters()
+
+    def add(self, sequence_number, value=None):
+        """
+        Track a PDU that is awaiting a response.
+        """
+        sent_at = self.clock.seconds()
+        self.in_flight[sequence_number] = (sent_at, value)
+        if self.size and self.response_timeout:
+            self._expiries.append((sent_at, sequence_number))
+            self._schedule_expiry()
+
+    def remove(self, sequence_number):
+        """
+        Stop tracking a PDU once its response has arrived.
+
+        :returns:
+            The value the PDU was added with, or ``None`` if we weren't
+            tracking it.
+        """
+        _sent_at, value = self.in_flight.pop(sequence_number, (None, None))
+        self._wake_waiters()
+        return value
+
+    def clear(self):
+        """
+        Stop tracking all PDUs, usually because the connection they were
+        sent on has been lost.
+        """
+        self.in_flight.clear()
+        self._expiries.clear()
+        self._cancel_expiry()
+        self._wake_waiters()
+
+    def waiting(self):
+        """
+        Return the number of callers waiting for a slot.
+        """
+        return len(self._waiters)
+
+    def stop(self):
+        """
+        Stop expiring PDUs.
+        """
+        self._cancel_expiry()
+
+    def _wake_waiters(self):
+        while self._waiters and self._has_slot():
+            self.reserved += 1
+            self._waiters.pop(0).callback(None)
+
+    def _cancel_expiry(self):
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+
+    def _schedule_expiry(self):
+        if self._delayed_call is not None or not self._expiries:
+            return
+        sent_at, _ = self._expiries[0]
+        delay = max(0, sent_at + self.response_timeout - self.clock.seconds())
+        self._delayed_call = self.clock.callLater(delay, self._expire)
+
+    def _expire(self):
+        self._delayed_call = None
+        expired_before = self.clock.seconds() - self.response_timeout
+        expiries = self._expiries
+        while expiries and expiries[0][0] <= expired_before:
+            sent_at, sequence_number = expiries.popleft()
+            entry = self.in_flight.get(sequence_number)
+            if entry is not None and entry[0] == sent_at:
+                del self.in_flight[sequence_number]
+                log.warning(
+                    "No response to PDU with sequence number %s after %s"
+                    " seconds, freeing its slot in the window." % (
+                        sequence_number, self.response_timeout))
+        self._wake_waiters()
+        self._schedule_expiry()
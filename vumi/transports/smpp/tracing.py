@@ -0,0 +1,94 @@
+# -*- test-case-name: vumi.transports.smpp.tests.test_tracing -*-
+
+import binascii
+from collections import deque
+
+from vumi.transports.smpp.pdu_utils import command_id, seq_no
+
+
+class LazyFormat(object):
+    """
+    A log message that is only formatted when it is converted to a string.
+
+    :param str fmt:
+        The format string.
+    :param args:
+        The values to format into ``fmt``.
+    """
+
+    def __init__(self, fmt, *args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt % self.args
+
+
+class LazyHex(object):
+    """
+    Binary data that is only hex encoded when it is converted to a string.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return binascii.b2a_hex(self.data)
+
+
+class PDUTracer(object):
+    """
+    Keeps track of the PDUs sent and received on an SMPP bind.
+
+    The last ``buffer_size`` PDUs are kept in a ring buffer so that they can
+    be dumped when something goes wrong. Only references to the PDUs are
+    kept, so no formatting happens until :meth:`dump` is called.
+
+    :param int sample_rate:
+        Only one in every ``sample_rate`` PDUs is sampled for logging. If this
+        is ``0``, no PDUs are sampled.
+    :param int buffer_size:
+        The number of PDUs to keep in the ring buffer. If this is ``0``, no
+        PDUs are kept.
+    :param clock:
+        Used to timestamp the PDUs in the ring buffer.
+    """
+
+    def __init__(self, sample_rate, buffer_size, clock):
+        self.sample_rate = sample_rate
+        self.clock = clock
+        self.pdu_count = 0
+        self.buffer = deque(maxlen=buffer_size) if buffer_size else None
+
+    def trace(self, direction, pdu, raw):
+        """
+        Record a PDU and return ``True`` if it has been sampled for logging.
+
+        :param str direction:
+            Either ``'INCOMING'`` or ``'OUTGOING'``.
+        :param dict pdu:
+            The unpacked PDU.
+        :param bytes raw:
+            The PDU as it is sent over the wire.
+        """
+        self.pdu_count += 1
+        if self.buffer is not None:
+            self.buffer.append((self.clock.seconds(), direction, pdu, raw))
+        return bool(self.sample_rate) and (
+            self.pdu_count % self.sample_rate == 0)
+
+    def dump(self):
+        """
+        Return a list of dicts describing the PDUs in the ring buffer, oldest
+        first.
+        """
+        if self.buffer is None:
+            return []
+        return [{
+            'timestamp': timestamp,
+            'direction': direction,
+            'command_id': command_id(pdu),
+            'sequence_number': seq_no(pdu),
+            'pdu': pdu,
+            'hex': binascii.b2a_hex(raw),
+        } for timestamp, direction, pdu, raw in self.buffer]
@@ -2,7 +2,7 @@ import time
 import json
 from datetime import datetime, timedelta
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
 
 from vumi.message import Message
 from vumi.transports.failures import FailureWorker
@@ -21,7 +21,7 @@ class TestFailureWorker(VumiTestCase):
         return self.make_worker()
 
     @inlineCallbacks
-    def make_worker(self, retry_delivery_period=0):
+    def make_worker(self, retry_delivery_period=0, **extra_config):
         self.worker_helper = self.add_helper(WorkerHelper('sphex'))
         config = self.persistence_helper.mk_config({
             'transport_name': 'sphex',
@@ -29,6 +29,7 @@ class TestFailureWorker(VumiTestCase):
             'failures_routing_key': 'sms.failures.%(transport_name)s',
             'retry_delivery_period': retry_delivery_period,
         })
+        config.update(extra_config)
         self.worker = yield self.worker_helper.get_worker(
             FailureWorker, config)
         self.redis = self.worker.redis
@@ -329,6 +330,127 @@ class TestFailureWorker(VumiTestCase):
                     'reason': 'bad stuff happened',
                     }] * 3)
 
+    @inlineCallbacks
+    def test_store_failure_with_retry(self):
+        """
+        Storing a failure with a retry delay sends all the writes together.
+        """
+        d = self.worker.store_failure({'message': 'foo'}, "reason", 10)
+        self.assertEqual(self.worker.pipeline.pending_count(), 4)
+        key = yield d
+        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_equal_d(
+            set([key]), self.worker.get_failure_keys())
+        [timestamp] = yield self.redis.zrange('retry_timestamps', 0, 0)
+        yield self.assert_equal_d(
+            set([key]), self.redis.smembers("retry_keys." + timestamp))
+
+    @inlineCallbacks
+    def test_get_next_retry_keys(self):
+        """
+        Claim several due retries at once.
+        """
+        for _ in range(3):
+            yield self.store_retry(0, -5)
+        yield self.store_retry(0, -15)
+        yield self.assert_zcard(2, 'retry_timestamps')
+        keys = yield self.worker.get_next_retry_keys(2)
+        self.assertEqual(len(keys), 1)
+        yield self.assert_zcard(1, 'retry_timestamps')
+        keys = yield self.worker.get_next_retry_keys(2)
+        self.assertEqual(len(keys), 2)
+        yield self.assert_zcard(1, 'retry_timestamps')
+        keys = yield self.worker.get_next_retry_keys(2)
+        self.assertEqual(len(keys), 1)
+        yield self.assert_zcard(0, 'retry_timestamps')
+        yield self.assert_equal_d([], self.worker.get_next_retry_keys(2))
+
+    @inlineCallbacks
+    def test_get_retry_backlog(self):
+        yield self.assert_equal_d(0, self.worker.get_retry_backlog())
+        yield self.store_retry(0, -5)
+        yield self.store_retry(0, -15)
+        yield self.store_retry(10)
+        yield self.assert_equal_d(3, self.worker.get_retry_backlog())
+
+    @inlineCallbacks
+    def test_deliver_retries_in_batches(self):
+        """
+        Delivering many retries claims them in batches.
+        """
+        self.worker.BATCH_SIZE = 2
+        for _ in range(5):
+            yield self.store_retry(0, -5)
+        batches = []
+        orig_get_failures = self.worker.get_failures
+
+        def get_failures(keys):
+            batches.append(len(keys))
+            return orig_get_failures(keys)
+
+        self.worker.get_failures = get_failures
+        yield self.worker.deliver_retries()
+        self.assertEqual(batches, [2, 2, 1])
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }] * 5)
+
+    @inlineCallbacks
+    def test_publish_retries_concurrency(self):
+        """
+        No more than CONCURRENCY retries are published at once.
+        """
+        self.worker.CONCURRENCY = 2
+        pending = []
+
+        def publish_raw(data):
+            d = Deferred()
+            pending.append((data, d))
+            return d
+
+        self.worker.retry_publisher.publish_raw = publish_raw
+        d = self.worker.publish_retries(
+            [{'message': str(i)} for i in range(3)])
+        self.assertEqual([data for data, _ in pending], ['0', '1'])
+        pending[0][1].callback(None)
+        self.assertEqual([data for data, _ in pending], ['0', '1', '2'])
+        pending[1][1].callback(None)
+        pending[2][1].callback(None)
+        yield d
+
+    @inlineCallbacks
+    def test_retry_metrics(self):
+        yield self.worker.stopWorker()
+        yield self.make_worker(retry_metrics_prefix='vumi.test.')
+        metrics = self.worker.metrics
+        self.assertTrue('retries.backlog' in metrics)
+        self.assertTrue('retries.delivered' in metrics)
+        yield self.store_retry(0, -5)
+        yield self.store_retry(0, -5)
+        yield self.store_retry(10)
+        yield self.worker.deliver_retries()
+        self.assertEqual(
+            [v for _, v in metrics['retries.delivered'].poll()], [1.0, 1.0])
+        self.assertEqual(
+            [v for _, v in metrics['retries.backlog'].poll()], [1])
+
+    @inlineCallbacks
+    def test_retry_backlog_metric_per_batch(self):
+        yield self.worker.stopWorker()
+        yield self.make_worker(retry_metrics_prefix='vumi.test.')
+        self.worker.BATCH_SIZE = 1
+        metrics = self.worker.metrics
+        yield self.store_retry(0, -5)
+        yield self.store_retry(0, -5)
+        yield self.store_retry(10)
+        yield self.worker.deliver_retries()
+        self.assertEqual(
+            [v for _, v in metrics['retries.backlog'].poll()], [2, 1])
+        yield self.worker.deliver_retries()
+        self.assertEqual(
+            [v for _, v in metrics['retries.backlog'].poll()], [1])
+
     def test_update_retry_metadata(self):
         """
         Retry metadata should be updated as appropriate.
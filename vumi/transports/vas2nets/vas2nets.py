@@ -271,7 +271,7 @@ class Vas2NetsTransport(Transport):
                 self.config['url'], urlencode(params), {
                     'User-Agent': ['Vumi Vas2Net Transport'],
                     'Content-Type': ['application/x-www-form-urlencoded'],
-                    }, 'POST')
+                    }, 'POST', pool=self.http_pool)
         except ConnectionRefusedError:
             log.msg("Connection failed sending message:", message)
             raise TemporaryFailure('connection refused')
@@ -126,7 +126,8 @@ class GoConversationTransportBase(Transport):
             self.get_url('messages.json'),
             data=json.dumps(params).encode('utf-8'),
             headers=headers,
-            method='PUT')
+            method='PUT',
+            pool=self.http_pool)
 
         if resp.code != http.OK:
             log.warning('Unexpected status code: %s, body: %s' % (
@@ -225,7 +225,8 @@ class WeChatTransport(Transport):
         url = self.make_url('menu/create', {'access_token': access_token})
         response = yield http_request_full(
             url, method='POST', data=json.dumps(menu_structure),
-            headers={'Content-Type': ['application/json']})
+            headers={'Content-Type': ['application/json']},
+            pool=self.http_pool)
         if not http_ok(response):
             raise WeChatApiException(
                 'Received HTTP code: %r when creating the menu.' % (
@@ -461,7 +462,7 @@ class WeChatTransport(Transport):
             lambda url: http_request_full(
                 url, method='POST', data=wc_message.to_json(), headers={
                     'Content-Type': ['application/json']
-                }))
+                }, pool=self.http_pool))
         d.addCallback(self.handle_api_response, vumi_message)
         if vumi_message['session_event'] == TransportUserMessage.SESSION_CLOSE:
             d.addCallback(
@@ -496,7 +497,7 @@ class WeChatTransport(Transport):
             'access_token': access_token,
             'openid': open_id,
             'lang': config.embed_user_profile_lang,
-        }), method='GET')
+        }), method='GET', pool=self.http_pool)
         user_profile = response.delivered_body
         yield self.redis.setex(up_key, config.embed_user_profile_lifetime,
                                user_profile)
@@ -509,7 +510,7 @@ class WeChatTransport(Transport):
             'grant_type': 'client_credential',
             'appid': config.wechat_appid,
             'secret': config.wechat_secret,
-        }), method='GET')
+        }), method='GET', pool=self.http_pool)
         if not http_ok(response):
             raise WeChatApiException(
                 ('Received HTTP status code %r when '
@@ -13,7 +13,8 @@ from twisted.internet import defer
 from twisted.internet import reactor, protocol
 from twisted.internet.defer import succeed
 from twisted.python.failure import Failure
-from twisted.web.client import Agent, ResponseDone, WebClientContextFactory
+from twisted.web.client import (
+    Agent, ResponseDone, WebClientContextFactory, HTTPConnectionPool)
 from twisted.web.server import Site
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
@@ -119,11 +120,130 @@ class SimplishReceiver(protocol.Protocol):
             self.deferred.errback(reason)
 
 
+class _ConnectionCountingEndpoint(object):
+    """
+    Wrap the endpoint a :class:`HttpConnectionPool` is given so the pool can
+    tell when it opens a new connection.
+    """
+
+    def __init__(self, endpoint):
+        self._endpoint = endpoint
+        self.connects = 0
+        self.on_connect = None
+
+    def connect(self, protocolFactory):
+        self.connects += 1
+        if self.on_connect is not None:
+            self.on_connect()
+        return self._endpoint.connect(protocolFactory)
+
+
+class HttpConnectionPool(HTTPConnectionPool):
+    """
+    A pool of persistent HTTP connections that keeps track of how often
+    connections are reused.
+
+    :param int max_per_host:
+        Maximum number of idle persistent connections kept for each host.
+    :param int idle_timeout:
+        Seconds an idle connection is kept before it is closed.
+    :param bool retry:
+        If ``True``, idempotent requests without a body that fail because a
+        pooled connection has gone stale are retried once on a new
+        connection.
+    :param metrics:
+        A :class:`vumi.blinkenlights.metrics.MetricManager` to report pool
+        activity to, or ``None``.
+    """
+
+    METRIC_NAMES = (
+        'requests', 'new_connections', 'reused_connections', 'retries')
+
+    def __init__(self, reactor, max_per_host=2, idle_timeout=240, retry=True,
+                 metrics=None):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = max_per_host
+        self.cachedConnectionTimeout = idle_timeout
+        self.retryAutomatically = retry
+        self.stats = dict((name, 0) for name in self.METRIC_NAMES)
+        self.metrics = metrics
+        if metrics is not None:
+            from vumi.blinkenlights.metrics import Count
+            for name in self.METRIC_NAMES:
+                metrics.register(Count('http_pool.%s' % (name,)))
+
+    def _inc(self, name):
+        self.stats[name] += 1
+        if self.metrics is not None:
+            self.metrics['http_pool.%s' % (name,)].inc()
+
+    def getConnection(self, key, endpoint):
+        endpoint = _ConnectionCountingEndpoint(endpoint)
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        # The pool either hands back a cached connection or connects the
+        # endpoint before returning. Any later connect is a retry.
+        self._inc('requests')
+        if endpoint.connects:
+            self._inc('new_connections')
+        else:
+            self._inc('reused_connections')
+        endpoint.on_connect = lambda: self._inc('retries')
+        return d
+
+
+_default_http_pool = None
+
+
+def default_http_pool():
+    """
+    Return the :class:`HttpConnectionPool` used by :func:`http_request_full`
+    when it isn't given one, creating it if necessary.
+    """
+    global _default_http_pool
+    if _default_http_pool is None:
+        _default_http_pool = HttpConnectionPool(reactor)
+    return _default_http_pool
+
+
+def close_default_http_pool():
+    """
+    Close the connections held by the default :class:`HttpConnectionPool`,
+    if there is one. A new pool is created the next time one is needed.
+    """
+    global _default_http_pool
+    pool, _default_http_pool = _default_http_pool, None
+    if pool is None:
+        return succeed(None)
+    return pool.closeCachedConnections()
+
+
+def build_agent(agent_class, context_factory, pool=None):
+    """
+    Build an HTTP agent that takes its connections from ``pool`` if one is
+    given and ``agent_class`` is :class:`twisted.web.client.Agent`. Other
+    agent classes aren't known to accept a pool and are built without one.
+    """
+    if pool is not None and agent_class is Agent:
+        return agent_class(
+            reactor, contextFactory=context_factory, pool=pool)
+    return agent_class(reactor, contextFactory=context_factory)
+
+
 def http_request_full(url, data=None, headers={}, method='POST',
                       timeout=None, data_limit=None, context_factory=None,
-                      agent_class=Agent):
+                      agent_class=Agent, pool=None):
+    """
+    Make an HTTP request and fetch the whole response body.
+
+    Connections are taken from ``pool`` (usually a worker's
+    :class:`HttpConnectionPool`) or, if none is given, from the pool returned
+    by :func:`default_http_pool`. Agent classes other than
+    :class:`twisted.web.client.Agent` make a new connection for each request.
+    """
+    if pool is None:
+        pool = default_http_pool()
     context_factory = context_factory or WebClientContextFactory()
-    agent = agent_class(reactor, contextFactory=context_factory)
+    agent = build_agent(agent_class, context_factory, pool)
     d = agent.request(method,
                       url,
                       mkheaders(headers),
@@ -449,3 +569,102 @@ def safe_routing_key(routing_key):
 
 def generate_worker_id(system_id, worker_id):
     return "%s:%s" % (system_id, worker_id,)
+
+
+class LRUCache(object):
+    """
+    A cache that holds at most ``max_size`` items and evicts the least
+    recently used item when it is full.
+
+    :param int max_size:
+        Maximum number of items kept in the cache.
+    :param float ttl:
+        If not ``None``, items expire this many seconds after they were
+        added.
+    :param clock:
+        Provider of ``seconds()``, used to expire items. Defaults to the
+        reactor.
+    """
+
+    # Indexes into the linked list entries.
+    PREV, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+    def __init__(self, max_size, ttl=None, clock=reactor):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._links = {}
+        # The root of a circular doubly linked list. The entry after the
+        # root is the least recently used.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return self._get_link(key) is not None
+
+    def _get_link(self, key):
+        link = self._links.get(key)
+        if link is None:
+            return None
+        expires = link[self.EXPIRES]
+        if expires is not None and expires <= self.clock.seconds():
+            self._remove(link)
+            return None
+        return link
+
+    def _remove(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+        del self._links[link[self.KEY]]
+
+    def _append(self, link):
+        last = self._root[self.PREV]
+        link[self.PREV] = last
+        link[self.NEXT] = self._root
+        last[self.NEXT] = self._root[self.PREV] = link
+        self._links[link[self.KEY]] = link
+
+    def get(self, key, default=None):
+        """
+        Return the value for ``key`` and mark it as recently used, or
+        ``default`` if it isn't in the cache.
+        """
+        link = self._get_link(key)
+        if link is None:
+            return default
+        self._remove(link)
+        self._append(link)
+        return link[self.VALUE]
+
+    def set(self, key, value):
+        """
+        Add ``value`` to the cache, evicting the least recently used item if
+        the cache is full.
+        """
+        link = self._links.get(key)
+        if link is not None:
+            self._remove(link)
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock.seconds() + self.ttl
+        self._append([None, None, key, value, expires])
+        while len(self._links) > self.max_size:
+            self._remove(self._root[self.NEXT])
+
+    def pop(self, key, default=None):
+        """
+        Remove ``key`` from the cache and return its value, or ``default`` if
+        it isn't in the cache.
+        """
+        link = self._get_link(key)
+        if link is None:
+            return default
+        self._remove(link)
+        return link[self.VALUE]
+
+    def clear(self):
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None, None, None]
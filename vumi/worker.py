@@ -6,6 +6,7 @@ import time
 import os
 import socket
 
+from twisted.internet import reactor
 from twisted.internet.defer import (
     inlineCallbacks, succeed, maybeDeferred, gatherResults)
 from twisted.python import log
@@ -13,9 +14,12 @@ from twisted.python import log
 from vumi.service import Worker
 from vumi.middleware import setup_middlewares_from_config
 from vumi.connectors import ReceiveInboundConnector, ReceiveOutboundConnector
-from vumi.config import Config, ConfigInt
+from vumi.config import (
+    Config, ConfigInt, ConfigBool, ConfigText, ConfigClassName, ConfigList,
+    ConfigFloat)
 from vumi.errors import DuplicateConnectorError
-from vumi.utils import generate_worker_id
+from vumi.utils import generate_worker_id, HttpConnectionPool, LRUCache
+from vumi.blinkenlights.metrics import MetricManager, Count, Metric
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
                                           HeartBeatMessage)
 
@@ -34,6 +38,66 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    amqp_max_concurrency = ConfigInt(
+        "The number of messages from each AMQP queue that are processed at"
+        " the same time by each worker instance. This should not be larger"
+        " than `amqp_prefetch_count`.",
+        default=1, static=True)
+    amqp_ordering_fields = ConfigList(
+        "Message fields used to keep related messages in order when"
+        " `amqp_max_concurrency` is greater than one. Messages with the same"
+        " values for all these fields (e.g. `from_addr` to keep USSD sessions"
+        " in order) are processed one at a time in the order they arrive.",
+        default=(), static=True)
+    amqp_publisher_confirms = ConfigBool(
+        "If true, messages are published with RabbitMQ publisher confirms."
+        " Publishing a message only waits for room in the window of"
+        " unconfirmed messages (see `amqp_max_unconfirmed`), but connectors"
+        " wait for every message they published to be confirmed when the"
+        " worker stops. This needs the `amqp-spec-0-9-1.xml` spec file.",
+        default=False, static=True)
+    amqp_max_unconfirmed = ConfigInt(
+        "The maximum number of published messages on each connector waiting"
+        " to be confirmed by the broker when `amqp_publisher_confirms` is"
+        " set. Publishing more messages waits for earlier ones to be"
+        " confirmed.",
+        default=100, static=True)
+    message_codec = ConfigClassName(
+        "The class used to encode and decode messages sent and received over"
+        " AMQP. `vumi.message.SchemaMessageCodec` only decodes the fields"
+        " each message class declares as timestamps.",
+        default='vumi.message.JSONMessageCodec', static=True)
+    http_pool_max_per_host = ConfigInt(
+        "The maximum number of idle persistent HTTP connections this worker's"
+        " `http_pool` keeps open to each host.",
+        default=10, static=True)
+    http_pool_idle_timeout = ConfigInt(
+        "The number of seconds an idle persistent HTTP connection is kept"
+        " open before it is closed.",
+        default=60, static=True)
+    http_pool_retry = ConfigBool(
+        "If true, idempotent HTTP requests without a body that fail because a"
+        " persistent connection has been closed by the server are retried on"
+        " a new connection.",
+        default=True, static=True)
+    http_pool_metrics_prefix = ConfigText(
+        "Prefix for HTTP connection pool metrics (requests, new connections,"
+        " reused connections and retries). Set to null to not publish them.",
+        default=None, static=True)
+    config_cache_size = ConfigInt(
+        "The maximum number of per-message config objects kept by"
+        " `get_config`. The default of 0 builds a new config object for every"
+        " message. Only enable this if the config a worker builds for a"
+        " message doesn't change within `config_cache_ttl`.",
+        default=0, static=True)
+    config_cache_ttl = ConfigFloat(
+        "The number of seconds a cached per-message config object is reused"
+        " for before it is built again.",
+        default=60, static=True)
+    config_cache_metrics_prefix = ConfigText(
+        "Prefix for config cache metrics (hits, misses and the time taken to"
+        " build config objects). Set to null to not publish them.",
+        default=None, static=True)
 
 
 class BaseWorker(Worker):
@@ -49,15 +113,28 @@ class BaseWorker(Worker):
     def __init__(self, options, config=None):
         super(BaseWorker, self).__init__(options, config=config)
         self.connectors = {}
+        # True while the worker has paused its own connectors, so that
+        # middleware that pauses them too knows not to unpause them.
+        self.connectors_paused = False
         self.middlewares = []
         self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        self.message_codec = self._static_config.message_codec()
+        self._config_cache = LRUCache(
+            self._static_config.config_cache_size,
+            self._static_config.config_cache_ttl)
+        self.config_cache_stats = {'hits': 0, 'misses': 0, 'build_time': 0.0}
+        self._config_cache_metrics = None
         self._hb_pub = None
         self._worker_id = None
+        self.http_pool = None
+        self._http_pool_metrics = None
 
     def startWorker(self):
         log.msg('Starting a %s worker with config: %s'
                 % (self.__class__.__name__, self.config))
         d = maybeDeferred(self._validate_config)
+        then_call(d, self.setup_config_cache_metrics)
+        then_call(d, self.setup_http_pool)
         then_call(d, self.setup_heartbeat)
         then_call(d, self.setup_middleware)
         then_call(d, self.setup_connectors)
@@ -71,11 +148,49 @@ class BaseWorker(Worker):
         then_call(d, self.teardown_connectors)
         then_call(d, self.teardown_middleware)
         then_call(d, self.teardown_heartbeat)
+        then_call(d, self.teardown_http_pool)
+        then_call(d, self.teardown_config_cache_metrics)
         return d
 
     def setup_connectors(self):
         raise NotImplementedError()
 
+    @inlineCallbacks
+    def setup_config_cache_metrics(self):
+        config = self.get_static_config()
+        if config.config_cache_metrics_prefix is None:
+            return
+        self._config_cache_metrics = yield self.start_publisher(
+            MetricManager, config.config_cache_metrics_prefix)
+        self._config_cache_metrics.register(Count('config_cache.hits'))
+        self._config_cache_metrics.register(Count('config_cache.misses'))
+        self._config_cache_metrics.register(Metric('config_cache.build_time'))
+
+    def teardown_config_cache_metrics(self):
+        if self._config_cache_metrics is not None:
+            self._config_cache_metrics.stop()
+            self._config_cache_metrics = None
+
+    @inlineCallbacks
+    def setup_http_pool(self):
+        config = self.get_static_config()
+        if config.http_pool_metrics_prefix is not None:
+            self._http_pool_metrics = yield self.start_publisher(
+                MetricManager, config.http_pool_metrics_prefix)
+        self.http_pool = HttpConnectionPool(
+            reactor, config.http_pool_max_per_host,
+            config.http_pool_idle_timeout, config.http_pool_retry,
+            metrics=self._http_pool_metrics)
+
+    @inlineCallbacks
+    def teardown_http_pool(self):
+        if self.http_pool is not None:
+            yield self.http_pool.closeCachedConnections()
+            self.http_pool = None
+        if self._http_pool_metrics is not None:
+            self._http_pool_metrics.stop()
+            self._http_pool_metrics = None
+
     @inlineCallbacks
     def setup_heartbeat(self):
         # Disable heartbeats if worker_name is not set. We're
@@ -153,7 +268,39 @@ class BaseWorker(Worker):
         necessary to ensure that workers will continue to work when per-message
         configuration needs to be fetched from elsewhere.
         """
-        return succeed(self.CONFIG_CLASS(self.config))
+        return succeed(self.get_cached_config(None, lambda: self.config))
+
+    def get_cached_config(self, key, get_config_data):
+        """
+        Return a config object for the config data returned by
+        ``get_config_data``, reusing the one built earlier for the same
+        ``key`` if there is one.
+
+        The key must identify the config data, so subclasses that build
+        per-message config data should use the parts of the message the data
+        depends on as the key. Cached config objects are reused for up to
+        ``config_cache_ttl`` seconds. The number of cache hits and misses and
+        the total time spent building config objects are kept in
+        ``config_cache_stats`` and published as metrics if
+        ``config_cache_metrics_prefix`` is set.
+        """
+        metrics = self._config_cache_metrics
+        config = self._config_cache.get(key)
+        if config is not None:
+            self.config_cache_stats['hits'] += 1
+            if metrics is not None:
+                metrics['config_cache.hits'].inc()
+            return config
+        self.config_cache_stats['misses'] += 1
+        start = time.time()
+        config = self.CONFIG_CLASS(get_config_data())
+        build_time = time.time() - start
+        self.config_cache_stats['build_time'] += build_time
+        if metrics is not None:
+            metrics['config_cache.misses'].inc()
+            metrics['config_cache.build_time'].set(build_time)
+        self._config_cache.set(key, config)
+        return config
 
     def _validate_config(self):
         """Once subclasses call `super().validate_config` properly,
@@ -177,12 +324,17 @@ class BaseWorker(Worker):
         if connector_name in self.connectors:
             raise DuplicateConnectorError("Attempt to add duplicate connector"
                                           " with name %r" % (connector_name,))
-        prefetch_count = self.get_static_config().amqp_prefetch_count
+        static_config = self.get_static_config()
         middlewares = self.middlewares if middleware else None
 
-        connector = connector_cls(self, connector_name,
-                                  prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+        connector = connector_cls(
+            self, connector_name,
+            prefetch_count=static_config.amqp_prefetch_count,
+            middlewares=middlewares,
+            max_concurrency=static_config.amqp_max_concurrency,
+            ordering_fields=static_config.amqp_ordering_fields,
+            publisher_confirms=static_config.amqp_publisher_confirms,
+            max_unconfirmed=static_config.amqp_max_unconfirmed)
         self.connectors[connector_name] = connector
 
         d = connector.setup()
@@ -204,9 +356,11 @@ class BaseWorker(Worker):
                                     middleware=middleware)
 
     def pause_connectors(self):
+        self.connectors_paused = True
         return gatherResults([
             connector.pause() for connector in self.connectors.itervalues()])
 
     def unpause_connectors(self):
+        self.connectors_paused = False
         for connector in self.connectors.itervalues():
             connector.unpause()